@@ -0,0 +1,103 @@
+import os
+import socket
+import tempfile
+import threading
+import time
+
+# Benchmark of the TCP data path on the large objects: the old path (1 KiB
+# read + sendall on the client, recv + bytes concatenation + one write at the
+# end on the server) against the current one (sendfile on the client,
+# recv_into a preallocated buffer streamed to disk on the server).
+# Both run over a loopback TCP connection, CPU time is that of the whole
+# process (sender and receiver threads).
+
+OBJECT_DIR = "../objects"
+OBJECT_COUNT = 10
+RECEIVE_CHUNK_SIZE = 256 * 1024
+REPEAT = 3
+
+# allocated once and reused for every object, as the server does per connection
+receive_buffer = bytearray(RECEIVE_CHUNK_SIZE)
+
+
+def old_send(sock, filepath):
+    with open(filepath, 'rb') as file:
+        while True:
+            data = file.read(1024)
+            if not data:
+                break
+            sock.sendall(data)
+
+
+def old_receive(conn, object_size, filename):
+    object_data = b''
+    while len(object_data) < object_size:
+        more_data = conn.recv(object_size - len(object_data))
+        if not more_data:
+            raise Exception("Connection lost while receiving file data.")
+        object_data += more_data
+    with open(filename, 'wb') as file:
+        file.write(object_data)
+
+
+def new_send(sock, filepath):
+    with open(filepath, 'rb') as file:
+        sock.sendfile(file)
+
+
+def new_receive(conn, object_size, filename):
+    view = memoryview(receive_buffer)
+    received = 0
+    with open(filename, 'wb') as file:
+        while received < object_size:
+            nbytes = conn.recv_into(view, min(len(view), object_size - received))
+            if not nbytes:
+                raise Exception("Connection lost while receiving file data.")
+            file.write(view[:nbytes])
+            received += nbytes
+
+
+def connected_pair():
+    # a loopback TCP connection, returns (client side, server side)
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as listener:
+        listener.bind(("127.0.0.1", 0))
+        listener.listen()
+        client = socket.create_connection(listener.getsockname())
+        server, _ = listener.accept()
+    return client, server
+
+
+def run(send, receive, paths, output_dir):
+    client, server = connected_pair()
+    sender = threading.Thread(target=lambda: [send(client, path) for path in paths])
+
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    sender.start()
+    for i, path in enumerate(paths):
+        receive(server, os.path.getsize(path), os.path.join(output_dir, f"{i}.obj"))
+    sender.join()
+    cpu = time.process_time() - cpu_start
+    wall = time.perf_counter() - wall_start
+
+    client.close()
+    server.close()
+    return wall, cpu
+
+
+def main():
+    paths = [os.path.join(OBJECT_DIR, f"large-{i}.obj") for i in range(OBJECT_COUNT)]
+    paths = [path for path in paths if os.path.exists(path)]
+    if not paths:
+        print(f"No large objects found in {OBJECT_DIR}, run generateobjects.sh first")
+        return
+    total_bytes = sum(os.path.getsize(path) for path in paths)
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        for name, send, receive in (("old", old_send, old_receive), ("new", new_send, new_receive)):
+            wall, cpu = min(run(send, receive, paths, output_dir) for _ in range(REPEAT))
+            print(f"{name:>4}: {wall * 1000:8.1f} ms wall  {cpu * 1000:8.1f} ms CPU  {total_bytes / wall / 1e6:8.1f} MB/s  ({len(paths)} objects)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,362 @@
+import argparse
+import csv
+import json
+import math
+import os
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from scheduling import SCHEDULERS
+
+try:
+    import matplotlib
+    matplotlib.use("Agg")
+    from matplotlib import pyplot
+except ImportError:
+    pyplot = None
+HAVE_MATPLOTLIB = pyplot is not None
+
+# Benchmark of the README experiments: the total time to download the 20
+# objects with TCP and with the UDP RDT while one network impairment (delay,
+# loss, corruption, duplication, reordering) is swept over a range of values.
+# Every point is run a number of times per transport. The raw runs are
+# written to results.csv as they finish, the mean and 95% confidence interval
+# of every point to summary.json and, if matplotlib is installed, one plot
+# per parameter with a TCP and a UDP curve to <parameter>.png.
+# The link is impaired in one of two ways:
+#   loopback: servers, clients and netem_proxy.py run on this host, no Docker
+#             or root needed (TCP only sees the delay, see netem_proxy.py)
+#   docker:   the server and client containers of docker-compose.yaml with
+#             tc netem on both, run from the host. Both containers need the
+#             same objects (generate them before building the image), they
+#             are linked to /objects so the clients find them from /app.
+# With --segment-sizes every UDP point is run once per segment size, each
+# size is a curve of its own, e.g. completion time against loss for
+# datagrams that fit the MTU and for ones that are fragmented:
+#   python3 benchmark.py --parameters loss --transports udp --segment-sizes 1454 4096 10240 --mtu 1500
+# (in loopback mode --mtu makes the proxy emulate the fragmentation, in
+# docker mode the containers' own MTU applies).
+# With --schedulers every point is run once per scheduler of the objects
+# (see scheduling.py), each a curve of its own, and the p50 and p99 of the
+# objects' completion times go next to the total time:
+#   python3 benchmark.py --parameters loss --schedulers rr srf wfq priority
+
+CODE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+UDP_DIRECTORY = os.path.join(CODE_DIRECTORY, "udp-part")
+COMPOSE_DIRECTORY = os.path.dirname(CODE_DIRECTORY)
+
+TRANSPORTS = ("tcp", "udp")
+# values of each parameter, in netem units: delay in ms, the others in percent
+SWEEPS = {
+    "delay": [0, 25, 50, 75, 100],
+    "loss": [0, 2.5, 5, 7.5, 10],
+    "corrupt": [0, 2.5, 5, 7.5, 10],
+    "duplicate": [0, 5, 10, 15, 20],
+    "reorder": [0, 10, 20, 30, 40],
+}
+UNITS = {"delay": "ms"}
+# the other sweeps run on this delay (ms), netem only reorders delayed packets
+BASE_DELAY = 10
+REPETITIONS = 5
+# seconds a transfer may take before the run counts as failed
+RUN_TIMEOUT = 300
+# seconds the servers (and the proxy) get to start listening
+STARTUP_TIME = 0.5
+OBJECT_COUNT = 20
+# two-sided 95% quantiles of Student's t distribution by degrees of freedom
+T_QUANTILES = {1: 12.706, 2: 4.303, 3: 3.182, 4: 2.776, 5: 2.571, 6: 2.447, 7: 2.365, 8: 2.306, 9: 2.262,
+               10: 2.228, 12: 2.179, 15: 2.131, 20: 2.086, 30: 2.042}
+
+DOCKER_CODE_DIRECTORY = "/app"
+DOCKER_INTERFACE = "eth0"
+
+RESULT_FIELDS = ["transport", "segment_size", "scheduler", "parameter", "value", "repetition", "seconds", "verified",
+                 "object_p50", "object_p99"]
+
+
+def setting_for(parameter, value):
+    # The full impairment of one point: the swept parameter on top of the base delay
+    setting = {"delay": BASE_DELAY, "loss": 0, "corrupt": 0, "duplicate": 0, "reorder": 0}
+    setting[parameter] = value
+    return setting
+
+
+def free_port():
+    # A port nothing listens on right now
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start(command, directory, log_path):
+    with open(log_path, 'w') as log:
+        return subprocess.Popen(command, cwd=directory, stdout=log, stderr=subprocess.STDOUT,
+                                env=dict(os.environ, PYTHONUNBUFFERED="1"))
+
+
+def stop(process):
+    # SIGTERM first, the UDP server journals its files on it
+    if process.poll() is None:
+        process.terminate()
+        try:
+            process.wait(5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+
+def run_client(command, directory, log_path, timeout):
+    with open(log_path, 'w') as log:
+        try:
+            subprocess.run(command, cwd=directory, stdout=log, stderr=subprocess.STDOUT, timeout=timeout,
+                           env=dict(os.environ, PYTHONUNBUFFERED="1"))
+        except subprocess.TimeoutExpired:
+            pass
+
+
+def read_log(log_path):
+    with open(log_path, errors='replace') as log:
+        return log.read()
+
+
+def transfer_result(transport, client_log, server_log):
+    """
+    (seconds, verified objects, p50, p99) of a run from its logs. seconds
+    is the client's "Total time taken", None if the transfer did not finish,
+    p50 and p99 of the objects' completion times (None as well).
+    The TCP client reports what the server verified, the UDP server
+    reports every verified file itself.
+    """
+    client_output = read_log(client_log)
+    match = re.search(r"Total time taken for file transfer: ([0-9.]+) seconds", client_output)
+    seconds = float(match.group(1)) if match else None
+    if transport == "tcp":
+        match = re.search(r"(\d+) verified by the server", client_output)
+        verified = int(match.group(1)) if match else 0
+    else:
+        verified = read_log(server_log).count("saved, and verified")
+    match = re.search(r"Object completion \(\w+\): p50 ([0-9.]+) s, p99 ([0-9.]+) s", client_output)
+    p50, p99 = (float(match.group(1)), float(match.group(2))) if match else (None, None)
+    return seconds, verified, p50, p99
+
+
+def client_options(segment_size=None, scheduler=None):
+    options = ["--segment-size", str(segment_size)] if segment_size else []
+    if scheduler:
+        options += ["--scheduler", scheduler]
+    return options
+
+
+def run_loopback(transport, setting, seed, timeout, log_prefix, segment_size=None, mtu=None, scheduler=None):
+    # One transfer on this host through netem_proxy.py, fresh ports and output directory every time
+    server_port, proxy_port = free_port(), free_port()
+    impairment = [f"--{name}={value}" for name, value in setting.items()]
+    if mtu:
+        impairment.append(f"--mtu={mtu}")
+    with tempfile.TemporaryDirectory() as output:
+        proxy = start([sys.executable, "netem_proxy.py", "--listen", f"127.0.0.1:{proxy_port}",
+                       "--server", f"127.0.0.1:{server_port}", f"--seed={seed}", *impairment],
+                      CODE_DIRECTORY, log_prefix + "-proxy.log")
+        directory = CODE_DIRECTORY if transport == "tcp" else UDP_DIRECTORY
+        server = start([sys.executable, f"{transport}_server.py", "--host", "127.0.0.1", "--port", str(server_port),
+                        "--output", output], directory, log_prefix + "-server.log")
+        try:
+            time.sleep(STARTUP_TIME)
+            run_client([sys.executable, f"{transport}_client.py", "--server", "127.0.0.1", "--port", str(proxy_port),
+                        *client_options(segment_size, scheduler)], directory, log_prefix + "-client.log", timeout)
+        finally:
+            stop(server)
+            stop(proxy)
+    return transfer_result(transport, log_prefix + "-client.log", log_prefix + "-server.log")
+
+
+def docker_exec(container, command, directory=DOCKER_CODE_DIRECTORY):
+    return ["docker", "exec", "-e", "PYTHONUNBUFFERED=1", "-w", directory, container, *command]
+
+
+def netem_command(setting):
+    command = ["tc", "qdisc", "replace", "dev", DOCKER_INTERFACE, "root", "netem", "delay", f"{setting['delay']}ms"]
+    for name in ("loss", "corrupt", "duplicate", "reorder"):
+        if setting[name]:
+            command += [name, f"{setting[name]}%"]
+    return command
+
+
+def setup_docker():
+    subprocess.run(["docker", "compose", "up", "-d"], cwd=COMPOSE_DIRECTORY, check=True)
+    for container in ("server", "client"):
+        subprocess.run(docker_exec(container, ["sh", "-c", "test -e /objects || ln -s /root/objects /objects"]), check=True)
+
+
+def teardown_docker():
+    for container in ("server", "client"):
+        subprocess.run(docker_exec(container, ["tc", "qdisc", "del", "dev", DOCKER_INTERFACE, "root"]),
+                       stderr=subprocess.DEVNULL)
+
+
+def run_docker(transport, setting, seed, timeout, log_prefix, segment_size=None, mtu=None, scheduler=None):
+    # One transfer between the containers, netem on both of them (it has no seed),
+    # their MTU is the one of the docker network
+    for container in ("server", "client"):
+        subprocess.run(docker_exec(container, netem_command(setting)), check=True)
+    directory = DOCKER_CODE_DIRECTORY if transport == "tcp" else f"{DOCKER_CODE_DIRECTORY}/udp-part"
+    server = start(docker_exec("server", ["python3", f"{transport}_server.py"], directory), CODE_DIRECTORY,
+                   log_prefix + "-server.log")
+    try:
+        time.sleep(STARTUP_TIME)
+        run_client(docker_exec("client", ["python3", f"{transport}_client.py", *client_options(segment_size, scheduler)], directory), CODE_DIRECTORY,
+                   log_prefix + "-client.log", timeout)
+    finally:
+        subprocess.run(docker_exec("server", ["pkill", "-f", f"{transport}_server.py"]))
+        stop(server)
+    return transfer_result(transport, log_prefix + "-client.log", log_prefix + "-server.log")
+
+
+def confidence_interval(samples):
+    # Mean and half width of the 95% confidence interval of the mean (Student's t)
+    mean = statistics.mean(samples)
+    if len(samples) < 2:
+        return mean, 0.0
+    degrees = len(samples) - 1
+    quantile = T_QUANTILES[max(d for d in T_QUANTILES if d <= degrees)] if degrees <= 30 else 1.96
+    return mean, quantile * statistics.stdev(samples) / math.sqrt(len(samples))
+
+
+def summarize(rows):
+    """
+    parameter -> series -> list of points (value, runs, failed, mean, ci95,
+    object_p50, object_p99)
+    A series is a transport, with the segment size and the scheduler if
+    they were set. object_p50 and object_p99 are the means of the runs'
+    completion time percentiles of the objects.
+    A run that did not finish or did not deliver every object counts as
+    failed and is left out of the means.
+    """
+    runs = {}
+    for row in rows:
+        series = row["transport"] + (f" {row['segment_size']} B" if row.get("segment_size") else "")
+        series += f" {row['scheduler']}" if row.get("scheduler") else ""
+        key = (row["parameter"], series, float(row["value"]))
+        runs.setdefault(key, []).append(row)
+    summary = {}
+    for (parameter, transport, value), point_rows in sorted(runs.items()):
+        complete = [row for row in point_rows if row["seconds"] not in ("", None) and int(row["verified"]) == OBJECT_COUNT]
+        times = [float(row["seconds"]) for row in complete]
+        point = {"value": value, "runs": len(point_rows), "failed": len(point_rows) - len(times), "mean": None, "ci95": None,
+                 "object_p50": None, "object_p99": None}
+        if times:
+            point["mean"], point["ci95"] = confidence_interval(times)
+        for field in ("object_p50", "object_p99"):
+            samples = [float(row[field]) for row in complete if row.get(field) not in ("", None)]
+            if samples:
+                point[field] = statistics.mean(samples)
+        summary.setdefault(parameter, {}).setdefault(transport, []).append(point)
+    return summary
+
+
+def plot(summary, directory):
+    if not HAVE_MATPLOTLIB:
+        print("matplotlib is not installed, no plots (summary.json has the numbers)")
+        return
+    for parameter, curves in summary.items():
+        figure, axes = pyplot.subplots()
+        for series, points in sorted(curves.items()):
+            points = [point for point in points if point["mean"] is not None]
+            axes.errorbar([point["value"] for point in points], [point["mean"] for point in points],
+                          yerr=[point["ci95"] for point in points], marker="o", capsize=3, label=series.upper())
+        axes.set_xlabel(f"{parameter} ({UNITS.get(parameter, '%')})")
+        axes.set_ylabel("time to download 20 objects (s)")
+        axes.set_title(f"{parameter}: mean and 95% confidence interval")
+        axes.legend()
+        axes.grid(True, alpha=0.3)
+        path = os.path.join(directory, f"{parameter}.png")
+        figure.savefig(path, dpi=120)
+        pyplot.close(figure)
+        print(f"Plot written to {path}")
+
+
+def write_summary(rows, directory):
+    summary = summarize(rows)
+    with open(os.path.join(directory, "summary.json"), 'w') as file:
+        json.dump(summary, file, indent=2)
+    for parameter, curves in summary.items():
+        for series, points in sorted(curves.items()):
+            for point in points:
+                mean = "failed" if point["mean"] is None else f"{point['mean']:.2f} s +- {point['ci95']:.2f}"
+                if point["object_p50"] is not None:
+                    mean += f", objects p50 {point['object_p50']:.2f} s, p99 {point['object_p99']:.2f} s"
+                print(f"{series} {parameter}={point['value']:g}: {mean} ({point['failed']} of {point['runs']} runs failed)")
+    plot(summary, directory)
+
+
+def run_sweeps(mode, parameters, values, transports, repetitions, timeout, directory, segment_sizes=None, mtu=None,
+               schedulers=None):
+    log_directory = os.path.join(directory, "logs")
+    os.makedirs(log_directory, exist_ok=True)
+    run = run_loopback if mode == "loopback" else run_docker
+    if mode == "docker":
+        setup_docker()
+    rows = []
+    try:
+        with open(os.path.join(directory, "results.csv"), 'w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=RESULT_FIELDS)
+            writer.writeheader()
+            for parameter in parameters:
+                for value in values or SWEEPS[parameter]:
+                    setting = setting_for(parameter, value)
+                    for repetition in range(repetitions):
+                        for transport, segment_size, scheduler in [
+                                (transport, size, scheduler) for transport in transports
+                                for size in (segment_sizes if transport == "udp" and segment_sizes else [None])
+                                for scheduler in (schedulers or [None])]:
+                            name = transport + (f"-{segment_size}" if segment_size else "") + (f"-{scheduler}" if scheduler else "")
+                            log_prefix = os.path.join(log_directory, f"{name}-{parameter}-{value:g}-{repetition}")
+                            # the repetition is the seed, so a point sees the same impairments for both transports
+                            seconds, verified, p50, p99 = run(transport, setting, repetition + 1, timeout, log_prefix, segment_size, mtu,
+                                                              scheduler)
+                            print(f"{name} {parameter}={value:g} run {repetition + 1}/{repetitions}: "
+                                  f"{'timeout' if seconds is None else f'{seconds:.2f} s'}, {verified}/{OBJECT_COUNT} verified"
+                                  + (f", objects p50 {p50:.2f} s, p99 {p99:.2f} s" if p50 is not None else ""))
+                            row = {"transport": transport, "segment_size": segment_size or "", "scheduler": scheduler or "",
+                                   "parameter": parameter, "value": value, "repetition": repetition, "seconds": seconds,
+                                   "verified": verified, "object_p50": p50, "object_p99": p99}
+                            writer.writerow(row)
+                            file.flush()  # an interrupted sweep keeps its runs
+                            rows.append(row)
+    finally:
+        if mode == "docker":
+            teardown_docker()
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="TCP vs UDP RDT benchmark over impaired links")
+    parser.add_argument("--mode", choices=["loopback", "docker"], default="loopback",
+                        help="impair with netem_proxy.py on this host or with tc netem in the docker compose containers")
+    parser.add_argument("--parameters", nargs="+", choices=sorted(SWEEPS), default=list(SWEEPS), help="parameters to sweep")
+    parser.add_argument("--values", nargs="+", type=float, help="values to sweep instead of the defaults (one parameter only)")
+    parser.add_argument("--transports", nargs="+", choices=TRANSPORTS, default=list(TRANSPORTS))
+    parser.add_argument("--repetitions", type=int, default=REPETITIONS, help="runs per point and transport")
+    parser.add_argument("--timeout", type=float, default=RUN_TIMEOUT, help="seconds before a transfer counts as failed")
+    parser.add_argument("--output", default="benchmark_results", help="directory for the results, logs and plots")
+    parser.add_argument("--segment-sizes", nargs="+", type=int, help="run UDP once per segment payload size (bytes)")
+    parser.add_argument("--mtu", type=int, help="MTU whose fragmentation the proxy emulates (loopback mode)")
+    parser.add_argument("--schedulers", nargs="+", choices=SCHEDULERS, help="run every point once per scheduler of the objects")
+    parser.add_argument("--summarize", metavar="RESULTS_CSV", help="only summarize and plot an existing results.csv")
+    args = parser.parse_args()
+
+    if args.summarize:
+        with open(args.summarize, newline='') as file:
+            write_summary(list(csv.DictReader(file)), os.path.dirname(os.path.abspath(args.summarize)))
+        sys.exit(0)
+    if args.values and len(args.parameters) != 1:
+        parser.error("--values needs exactly one parameter in --parameters")
+
+    os.makedirs(args.output, exist_ok=True)
+    rows = run_sweeps(args.mode, args.parameters, args.values, args.transports, args.repetitions, args.timeout, args.output,
+                      args.segment_sizes, args.mtu, args.schedulers)
+    write_summary(rows, args.output)
@@ -0,0 +1,47 @@
+import lzma
+import zlib
+
+# Optional payload compression, shared by the TCP and the UDP transfers.
+# The codec is negotiated per connection (TCP) or session (UDP) and the
+# sender only compresses what actually gets smaller: an object whose first
+# chunk does not shrink below COMPRESSION_THRESHOLD is sent as is, which
+# skips already compressed or random data after one try.
+
+# zlib level 1 is nearly as small as the default level on the base64
+# objects and several times faster
+ZLIB_LEVEL = 1
+COMPRESSION_THRESHOLD = 0.95
+
+# codec name -> (compressor factory, decompressor factory)
+# both follow the zlib streaming interface: compress() / flush() and decompress()
+CODECS = {
+    "zlib": (lambda: zlib.compressobj(ZLIB_LEVEL), zlib.decompressobj),
+    "lzma": (lzma.LZMACompressor, lzma.LZMADecompressor),
+}
+# numbers of the codecs on the wire, 0 means uncompressed
+CODEC_IDS = {"zlib": 1, "lzma": 2}
+CODEC_NAMES = {number: name for name, number in CODEC_IDS.items()}
+
+
+def compressor(codec):
+    return CODECS[codec][0]()
+
+
+def decompressor(codec):
+    return CODECS[codec][1]()
+
+
+def compress(codec, data):
+    # One shot compression of a complete piece of data
+    packer = compressor(codec)
+    return packer.compress(data) + packer.flush()
+
+
+def decompress(codec, data):
+    # One shot decompression of a complete piece of data compressed with compress()
+    return decompressor(codec).decompress(data)
+
+
+def shrinks(original_size, compressed_size):
+    # Whether compressing was worth it
+    return compressed_size < original_size * COMPRESSION_THRESHOLD
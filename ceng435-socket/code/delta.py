@@ -0,0 +1,197 @@
+import hashlib
+import os
+import struct
+import zlib
+
+from journal import ObjectWriter, write_journal, remove_journal
+
+# rsync style delta transfer, shared by the TCP and the UDP part.
+# The server has an old version of an object (the basis) and sends its
+# signature: per BLOCK_SIZE block of the basis a weak rolling checksum
+# (Adler-32) and a strong one (the first bytes of the block's MD5).
+# The client slides a window over the new version one byte at a time,
+# rolling the weak checksum along; where the window matches a block of the
+# basis (weak and strong checksum) it sends "copy that block", everything
+# else is sent as literal data. The server rebuilds the object from the
+# basis and the delta (DeltaWriter) and verifies the result with its MD5.
+# Only whole blocks of the basis are matched, a short last block is sent as data.
+
+BLOCK_SIZE = 8 * 1024
+# weak checksum | strong checksum of one block
+SIGNATURE_ENTRY = struct.Struct("!I8s")
+STRONG_SIZE = 8
+# instructions of the delta stream
+DELTA_END = 0
+DELTA_COPY = 1  # copy count blocks of the basis starting at block index
+DELTA_DATA = 2  # the length bytes that follow
+COPY_INSTRUCTION = struct.Struct("!BII")  # kind | block index | count
+DATA_INSTRUCTION = struct.Struct("!BI")  # kind | length
+# literal data is sent in pieces of at most this size
+MAX_DATA_LENGTH = 64 * 1024
+# the object is rebuilt next to the basis under this suffix, then renamed over it
+DELTA_SUFFIX = ".delta"
+
+ADLER_MOD = 65521
+
+
+def strong_checksum(block):
+    return hashlib.md5(block).digest()[:STRONG_SIZE]
+
+
+def file_signature(path, block_size=BLOCK_SIZE):
+    """
+    Signature of the basis at path: (MD5 digest of the whole file, signature
+    entries of its whole blocks). None if there is no such file.
+    """
+    try:
+        file = open(path, 'rb')
+    except OSError:
+        return None
+    hasher = hashlib.md5()
+    entries = bytearray()
+    with file:
+        while True:
+            block = file.read(block_size)
+            if not block:
+                break
+            hasher.update(block)
+            if len(block) == block_size:
+                entries += SIGNATURE_ENTRY.pack(zlib.adler32(block), strong_checksum(block))
+    return hasher.digest(), bytes(entries)
+
+
+def parse_signature(entries):
+    # weak checksum -> [(strong checksum, block index)] for the lookups of compute_delta
+    blocks = {}
+    for index, (weak, strong) in enumerate(SIGNATURE_ENTRY.iter_unpack(entries)):
+        blocks.setdefault(weak, []).append((strong, index))
+    return blocks
+
+
+def compute_delta(path, entries, block_size=BLOCK_SIZE):
+    """
+    Yield the encoded delta stream that turns the basis with the signature
+    entries into the file at path, in pieces of up to MAX_DATA_LENGTH
+    literal bytes. Consecutive copied blocks become one instruction.
+    The rolling is done in Python, so data that matches nothing costs about
+    a microsecond per byte, matching blocks are skipped whole.
+    """
+    blocks = parse_signature(entries)
+    with open(path, 'rb') as file:
+        data = file.read()
+    size = len(data)
+    literal_start = 0
+    copy_start, copy_count = 0, 0
+
+    def flush_literal(end):
+        # literal data from literal_start up to end, preceded by the pending copy
+        if copy_count:
+            yield COPY_INSTRUCTION.pack(DELTA_COPY, copy_start, copy_count)
+        for start in range(literal_start, end, MAX_DATA_LENGTH):
+            piece = data[start:min(end, start + MAX_DATA_LENGTH)]
+            yield DATA_INSTRUCTION.pack(DELTA_DATA, len(piece)) + piece
+
+    position = 0
+    weak = zlib.adler32(data[:block_size]) if blocks and size >= block_size else None
+    while weak is not None:
+        match = None
+        for strong, index in blocks.get(weak, ()):
+            if strong == strong_checksum(data[position:position + block_size]):
+                match = index
+                break
+        if match is not None:
+            if copy_count and position == literal_start and match == copy_start + copy_count:
+                copy_count += 1  # continues the pending copy
+            else:
+                yield from flush_literal(position)
+                copy_start, copy_count = match, 1
+            position += block_size
+            literal_start = position
+            weak = zlib.adler32(data[position:position + block_size]) if position + block_size <= size else None
+            continue
+        if position + block_size >= size:
+            break
+        # roll the window one byte: drop data[position], add data[position + block_size]
+        a, b = weak & 0xffff, weak >> 16
+        out_byte, in_byte = data[position], data[position + block_size]
+        a = (a - out_byte + in_byte) % ADLER_MOD
+        b = (b - block_size * out_byte + a - 1) % ADLER_MOD
+        weak = (b << 16) | a
+        position += 1
+    yield from flush_literal(size)
+    yield bytes([DELTA_END])
+
+
+def literal_length(instruction):
+    # literal bytes of the object in one instruction as compute_delta yields it,
+    # what a delta transfers of the object itself
+    return len(instruction) - DATA_INSTRUCTION.size if instruction[0] == DELTA_DATA else 0
+
+
+class DeltaWriter(ObjectWriter):
+    """
+    Rebuild an object from its basis at path and a delta stream that is
+    fed to write() in pieces of any size (as it comes off the network).
+    The object is written to path + DELTA_SUFFIX and only replaces the
+    basis once it is verified, offset counts the rebuilt bytes.
+    """
+
+    def __init__(self, path, digest, block_size=BLOCK_SIZE):
+        self.basis = open(path, 'rb')
+        super().__init__(path + DELTA_SUFFIX, digest)
+        self.target = path
+        self.block_size = block_size
+        self.pending = bytearray()  # start of an instruction that is not complete yet
+        self.ended = False
+        self.literal = 0  # bytes that came as literal data, the rest was copied from the basis
+
+    def write(self, data):
+        self.pending += data
+        consumed = 0
+        while consumed < len(self.pending) and not self.ended:
+            kind = self.pending[consumed]
+            if kind == DELTA_COPY:
+                if len(self.pending) - consumed < COPY_INSTRUCTION.size:
+                    break
+                _, index, count = COPY_INSTRUCTION.unpack_from(self.pending, consumed)
+                consumed += COPY_INSTRUCTION.size
+                self.basis.seek(index * self.block_size)
+                for _ in range(count):
+                    super().write(self.basis.read(self.block_size))
+            elif kind == DELTA_DATA:
+                if len(self.pending) - consumed < DATA_INSTRUCTION.size:
+                    break
+                _, length = DATA_INSTRUCTION.unpack_from(self.pending, consumed)
+                end = consumed + DATA_INSTRUCTION.size + length
+                if len(self.pending) < end:
+                    break
+                super().write(self.pending[consumed + DATA_INSTRUCTION.size:end])
+                self.literal += length
+                consumed = end
+            elif kind == DELTA_END:
+                consumed += 1
+                self.ended = True
+            else:
+                raise ValueError(f"unknown delta instruction {kind}")
+        del self.pending[:consumed]
+
+    def delivered(self):
+        # only the literal data was transferred, copied blocks were already here
+        return self.literal
+
+    def close(self):
+        self.basis.close()
+        super().close()
+
+    def verified(self):
+        # A complete, verified object replaces the basis, a broken one is dropped
+        ok = self.ended and super().verified()
+        self.close()
+        remove_journal(self.path)
+        if ok:
+            os.replace(self.path, self.target)
+            write_journal(self.target, self.digest, self.offset)
+            self.path = self.target
+        else:
+            os.remove(self.path)
+        return ok
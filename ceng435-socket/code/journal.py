@@ -0,0 +1,125 @@
+import hashlib
+import os
+import time
+
+# Progress journal of the objects a server receives, shared by the TCP and
+# the UDP part so an interrupted transfer can be resumed instead of repeated.
+# Both servers write every object front to back, so the progress of an
+# object is a single byte offset: everything before it is on disk.
+# Next to each object file there is a small journal file "<object>.journal"
+# holding the MD5 digest (hex) the object is expected to have and that offset.
+# It is rewritten every JOURNAL_INTERVAL bytes and when the object is closed,
+# always after the object data was flushed, so it never claims bytes the
+# file does not have. A finished object keeps its journal (offset = size),
+# an object that failed verification loses it.
+
+JOURNAL_SUFFIX = ".journal"
+# bytes written between two journal updates
+JOURNAL_INTERVAL = 256 * 1024
+# the kept part of a resumed object is hashed again in chunks of this size
+REHASH_CHUNK_SIZE = 1024 * 1024
+
+
+def journal_path(path):
+    return path + JOURNAL_SUFFIX
+
+
+def read_journal(path, digest):
+    """
+    Offset the object at path can be resumed from, 0 if there is nothing to resume.
+    digest is the hex MD5 of the object about to be sent, the journal of a
+    different object under the same name is ignored. The offset never goes
+    past what is actually on disk.
+    """
+    try:
+        with open(journal_path(path), 'r') as file:
+            journal_digest, offset = file.read().split()
+        offset = int(offset)
+        size = os.path.getsize(path)
+    except (OSError, ValueError):
+        return 0
+    if journal_digest != digest:
+        return 0
+    return min(offset, size)
+
+
+def write_journal(path, digest, offset):
+    # written to a temporary file and renamed over the old journal, so a
+    # crash in the middle leaves either the old or the new journal
+    temporary_path = journal_path(path) + ".tmp"
+    with open(temporary_path, 'w') as file:
+        file.write(f"{digest} {offset}\n")
+    os.replace(temporary_path, journal_path(path))
+
+
+def remove_journal(path):
+    try:
+        os.remove(journal_path(path))
+    except FileNotFoundError:
+        pass
+
+
+class ObjectWriter:
+    """
+    Sequential writer of one received object that keeps its journal and
+    the running MD5 of everything written.
+    With offset > 0 the first offset bytes already on disk are kept (and
+    hashed again, so the digest still covers the whole object) and writing
+    continues after them.
+    """
+
+    def __init__(self, path, digest, offset=0):
+        self.path = path
+        self.digest = digest
+        self.hasher = hashlib.md5()
+        if offset:
+            self.file = open(path, 'r+b')
+            remaining = offset
+            while remaining:
+                data = self.file.read(min(REHASH_CHUNK_SIZE, remaining))
+                if not data:
+                    break  # shorter than the journal said, the digest will not match
+                self.hasher.update(data)
+                remaining -= len(data)
+            self.file.seek(offset)
+            self.file.truncate()
+        else:
+            self.file = open(path, 'wb')
+        self.offset = offset  # bytes of the object on disk
+        self.journaled = offset  # offset in the journal
+        # where and when this attempt started, for its goodput
+        self.start_offset = offset
+        self.started = time.time()
+
+    def write(self, data):
+        self.file.write(data)
+        self.hasher.update(data)
+        self.offset += len(data)
+        if self.offset - self.journaled >= JOURNAL_INTERVAL:
+            self.checkpoint()
+
+    def delivered(self):
+        # bytes of the object this attempt got, what its goodput is made of
+        return self.offset - self.start_offset
+
+    def checkpoint(self):
+        # the data first, then the journal that refers to it
+        self.file.flush()
+        write_journal(self.path, self.digest, self.offset)
+        self.journaled = self.offset
+
+    def close(self):
+        # also called for unfinished objects, their journal gets the exact offset
+        if self.file.closed:
+            return
+        self.checkpoint()
+        self.file.close()
+
+    def verified(self):
+        # Close the object and compare its MD5 with the expected one,
+        # a corrupted object is not resumed from
+        self.close()
+        if self.hasher.hexdigest() == self.digest:
+            return True
+        remove_journal(self.path)
+        return False
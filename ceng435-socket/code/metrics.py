@@ -0,0 +1,211 @@
+import bisect
+import collections
+import json
+import logging
+import socket
+import struct
+import sys
+import threading
+import time
+
+# Instrumentation shared by the TCP and the UDP part.
+# A Metrics object collects the counters, gauges, histograms and time series of one
+# transfer (a client run, a UDP server session, a TCP server run) and the
+# completion time and goodput of every object. Counting is a dictionary
+# update, so it stays on in the hot paths; at the end the whole set is
+# exported as JSON lines or as a Prometheus style text dump, appended to a
+# file so a server can add one set per session.
+# The per segment / per ACK messages go through a leveled logger that only
+# formats them when its level is "debug", the default level "info" keeps
+# them off the hot path.
+
+EXPORT_FORMATS = ("json", "prometheus")
+LOG_LEVELS = ("debug", "info", "warning", "error")
+# every metric name in the Prometheus dump starts with this
+PROMETHEUS_PREFIX = "rdt_"
+
+# upper bounds of the histogram buckets, 4 per decade from 10 microseconds
+# (RTTs are in seconds) up to 10 Gbit/s (goodput is in bits per second)
+BUCKETS = tuple(10 ** (exponent / 4) for exponent in range(-20, 41))
+QUANTILES = (0.5, 0.9, 0.99)
+
+# struct tcp_info of Linux up to tcpi_total_retrans: 8 one byte fields, then 24 unsigned ints
+TCP_INFO = struct.Struct("8B24I")
+TCP_INFO_RTT = 8 + 15  # tcpi_rtt, in microseconds
+TCP_INFO_CWND = 8 + 18  # tcpi_snd_cwnd, in segments
+TCP_INFO_TOTAL_RETRANS = 8 + 23
+
+logger = logging.getLogger("transfer")
+
+
+def setup_logging(level="info"):
+    # Messages go to stdout without decoration, like the prints around them
+    logging.basicConfig(level=level.upper(), format="%(message)s", stream=sys.stdout)
+
+
+class Histogram:
+    """
+    Distribution of the observed values in fixed buckets (see BUCKETS),
+    plus their exact count, sum, minimum and maximum. Quantiles are
+    interpolated inside the bucket that holds them.
+    """
+
+    def __init__(self, bounds=BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # the last bucket is above every bound
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = max(self.bounds[i - 1] if i else self.min, self.min)
+                upper = min(self.bounds[i] if i < len(self.bounds) else self.max, self.max)
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.max
+
+
+class Metrics:
+    """
+    Counters, gauges, histograms and time series of one transfer. labels (e.g.
+    transport, role, session) identify it in the export. Safe to update
+    from several threads, the TCP connections share one.
+    """
+
+    def __init__(self, **labels):
+        self.labels = labels
+        self.start_time = time.time()
+        self.counters = collections.Counter()
+        self.gauges = {}  # name -> last value set
+        self.histograms = {}
+        self.series = {}  # name -> [(seconds since start, value)]
+        self.objects = []  # one record per finished object
+        self.lock = threading.Lock()
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def set(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def observe(self, name, value):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+
+    def record(self, name, value, at=None):
+        # a point of a time series, at is the time since the start (now by default)
+        if at is None:
+            at = time.time() - self.start_time
+        with self.lock:
+            self.series.setdefault(name, []).append((at, value))
+
+    def object_done(self, name, size, seconds, verified=True, completed=None):
+        # completion time and goodput of an object, size is the object data transferred
+        # completed is when it completed, seconds from the start of the transfer
+        goodput = size * 8 / seconds if seconds > 0 else 0.0
+        self.observe("object_seconds", seconds)
+        self.observe("object_goodput_bps", goodput)
+        record = {"object": name, "bytes": size, "seconds": seconds, "goodput_bps": goodput, "verified": verified}
+        if completed is not None:
+            self.observe("object_completion_seconds", completed)
+            record["completed_seconds"] = completed
+        with self.lock:
+            self.objects.append(record)
+
+    def elapsed(self):
+        return time.time() - self.start_time
+
+    def records(self):
+        """
+        The export as a list of JSON-ready dicts: one per counter, gauge,
+        histogram, time series and object, each with the labels.
+        """
+        with self.lock:
+            records = [{"metric": name, "type": "counter", "value": value} for name, value in sorted(self.counters.items())]
+            records += [{"metric": name, "type": "gauge", "value": value} for name, value in sorted(self.gauges.items())]
+            for name, histogram in sorted(self.histograms.items()):
+                record = {"metric": name, "type": "histogram", "count": histogram.count, "sum": histogram.sum,
+                          "min": histogram.min, "max": histogram.max}
+                for q in QUANTILES:
+                    record[f"p{round(q * 100)}"] = histogram.quantile(q)
+                records.append(record)
+            records += [{"metric": name, "type": "series", "points": points} for name, points in sorted(self.series.items())]
+            records += [dict(metric="object", type="object", **record) for record in self.objects]
+            records.append({"metric": "elapsed_seconds", "type": "gauge", "value": self.elapsed()})
+        return [dict(record, labels=self.labels) for record in records]
+
+    def prometheus(self):
+        # Prometheus text exposition: counters, gauges, histograms, and the last value of every time series
+        label_text = ",".join(f'{key}="{value}"' for key, value in sorted(self.labels.items()))
+
+        def labelled(extra=""):
+            text = ",".join(part for part in (label_text, extra) if part)
+            return "{" + text + "}" if text else ""
+
+        lines = []
+        with self.lock:
+            for name, value in sorted(self.counters.items()):
+                lines += [f"# TYPE {PROMETHEUS_PREFIX}{name}_total counter", f"{PROMETHEUS_PREFIX}{name}_total{labelled()} {value}"]
+            for name, value in sorted(self.gauges.items()):
+                lines += [f"# TYPE {PROMETHEUS_PREFIX}{name} gauge", f"{PROMETHEUS_PREFIX}{name}{labelled()} {value}"]
+            for name, histogram in sorted(self.histograms.items()):
+                metric = PROMETHEUS_PREFIX + name
+                lines.append(f"# TYPE {metric} histogram")
+                cumulative = 0
+                # only the buckets between the smallest and the largest value, the rest say nothing
+                used = [i for i, count in enumerate(histogram.counts[:-1]) if count]
+                for i, bound in enumerate(histogram.bounds):
+                    cumulative += histogram.counts[i]
+                    if used and used[0] <= i <= used[-1]:
+                        lines.append(f"{metric}_bucket{labelled('le=%s' % json.dumps(f'{bound:.6g}'))} {cumulative}")
+                lines += [f"{metric}_bucket{labelled('le=' + json.dumps('+Inf'))} {histogram.count}",
+                          f"{metric}_sum{labelled()} {histogram.sum}", f"{metric}_count{labelled()} {histogram.count}"]
+            for name, points in sorted(self.series.items()):
+                lines += [f"# TYPE {PROMETHEUS_PREFIX}{name} gauge", f"{PROMETHEUS_PREFIX}{name}{labelled()} {points[-1][1]}"]
+        lines += [f"# TYPE {PROMETHEUS_PREFIX}elapsed_seconds gauge", f"{PROMETHEUS_PREFIX}elapsed_seconds{labelled()} {self.elapsed()}"]
+        return "\n".join(lines) + "\n"
+
+    def export(self, path, export_format="json"):
+        # Append the metrics to path, in one write so concurrent exporters do not interleave
+        if export_format == "json":
+            text = "".join(json.dumps(record) + "\n" for record in self.records())
+        else:
+            text = self.prometheus()
+        with open(path, 'a') as file:
+            file.write(text)
+
+
+def record_tcp_info(metrics, sock):
+    """
+    Add what the kernel knows about a TCP connection (Linux TCP_INFO): an
+    RTT sample, the congestion window and the retransmitted segments.
+    Does nothing where TCP_INFO is not available.
+    """
+    if not hasattr(socket, "TCP_INFO"):
+        return
+    try:
+        info = TCP_INFO.unpack(sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, TCP_INFO.size))
+    except (OSError, struct.error):
+        return
+    metrics.observe("rtt_seconds", info[TCP_INFO_RTT] / 1e6)
+    metrics.record("cwnd", info[TCP_INFO_CWND])
+    metrics.count("retransmits", info[TCP_INFO_TOTAL_RETRANS])
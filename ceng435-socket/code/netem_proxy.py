@@ -0,0 +1,322 @@
+import argparse
+import collections
+import heapq
+import queue
+import random
+import selectors
+import signal
+import socket
+import sys
+import threading
+import time
+
+# Userspace stand-in for tc netem, so the transfers can be reproduced and
+# measured on one host without Docker or root, e.g. in CI:
+#   python3 netem_proxy.py --listen 127.0.0.1:9000 --server 127.0.0.1:8000 --loss 5 --seed 3
+#   python3 tcp_client.py --server 127.0.0.1 --port 9000  (or udp-part/udp_client.py)
+# The proxy listens on one port for both UDP and TCP and relays to the server.
+# UDP datagrams are impaired in both directions like netem on both hosts:
+# loss (independent or in Gilbert-Elliott bursts), duplication, corruption
+# (one bit flipped), a rate limit with a bounded queue, and delay with
+# jitter, a reordered datagram skips the delay (netem's reorder). Every
+# client gets its own upstream socket so the server still tells them apart.
+# With --mtu a datagram larger than the MTU is treated as the IP fragments
+# it would be cut into: every fragment may be lost on its own, the datagram
+# is lost with any of them, and it is corrupted if any fragment is.
+# TCP is relayed with the delay, jitter (without reordering the stream) and
+# rate limit only: loss, corruption and the rest happen to IP packets, which
+# a userspace relay of the byte stream never sees.
+# Every direction has its own random generator derived from --seed, so a run
+# with the same seed gives the same fate to the n-th datagram of a direction.
+# Settings use the netem units: delay in milliseconds, rate in kbit/s, the
+# rest in percent.
+
+DATAGRAM_SIZE = 65535
+TCP_CHUNK_SIZE = 64 * 1024
+# TCP chunks waiting out their delay per direction, reading stops when it is full
+TCP_QUEUE_CHUNKS = 64
+# datagrams read from a socket in one go before the due ones are sent
+RECEIVE_BATCH = 64
+# packets the rate limited link may queue before it drops (netem's default limit)
+QUEUE_LIMIT = 1000
+IP_HEADER_SIZE = 20
+UDP_HEADER_SIZE = 8
+
+
+class Impairment:
+    """
+    What happens to the packets of one direction of the link, in netem's
+    order: loss, duplication, corruption, the rate limit and then delay,
+    jitter and reordering. Random decisions come from rng.
+    """
+
+    def __init__(self, rng, delay=0.0, jitter=0.0, loss=0.0, burst=None, burst_loss=100.0, corrupt=0.0,
+                 duplicate=0.0, reorder=0.0, rate=0.0, limit=QUEUE_LIMIT, mtu=0):
+        self.rng = rng
+        self.delay = delay / 1000
+        self.jitter = jitter / 1000
+        self.loss = loss / 100
+        # Gilbert-Elliott: per packet probability of going from the good to
+        # the bad state and back, the loss is burst_loss in the bad state
+        self.burst = (burst[0] / 100, burst[1] / 100) if burst else None
+        self.burst_loss = burst_loss / 100
+        self.bad = False
+        self.corrupt = corrupt / 100
+        self.duplicate = duplicate / 100
+        self.reorder = reorder / 100
+        self.rate = rate * 1000 / 8  # bytes per second, 0 for no limit
+        self.limit = limit  # None for no limit
+        # UDP data bytes per IP fragment (a multiple of 8), 0 for no fragmentation
+        self.fragment_size = (mtu - IP_HEADER_SIZE) // 8 * 8 if mtu else 0
+        self.link_free = 0.0  # when the link is done sending what is queued
+        self.queued = collections.deque()  # times the queued packets leave the link
+        self.stats = collections.Counter()
+
+    def lost(self):
+        if self.burst:
+            p, r = self.burst
+            self.bad = self.rng.random() >= r if self.bad else self.rng.random() < p
+            return self.rng.random() < (self.burst_loss if self.bad else self.loss)
+        return self.rng.random() < self.loss
+
+    def fragments(self, size):
+        # IP fragments a datagram with size bytes of payload is sent in
+        if not self.fragment_size:
+            return 1
+        return max(1, -(-(size + UDP_HEADER_SIZE) // self.fragment_size))
+
+    def latency(self):
+        # delay with uniform jitter, never negative
+        if not self.jitter:
+            return self.delay
+        return max(0.0, self.delay + self.rng.uniform(-self.jitter, self.jitter))
+
+    def transmit(self, size, now):
+        # When the rate limited link is done sending size bytes queued now, None if the queue is full
+        if not self.rate:
+            return now
+        while self.queued and self.queued[0] <= now:
+            self.queued.popleft()
+        if self.limit is not None and len(self.queued) >= self.limit:
+            return None
+        self.link_free = max(self.link_free, now) + size / self.rate
+        self.queued.append(self.link_free)
+        return self.link_free
+
+    def schedule(self, data, now):
+        """
+        Fate of one datagram: a list of (delivery time, datagram), empty if
+        it is lost, two entries if it is duplicated.
+        """
+        self.stats['received'] += 1
+        fragments = self.fragments(len(data))
+        self.stats['fragmented'] += fragments > 1
+        # every fragment is drawn, so a burst goes on through the fragments of one datagram
+        if any([self.lost() for _ in range(fragments)]):
+            self.stats['lost'] += 1
+            return []
+        copies = 2 if self.rng.random() < self.duplicate else 1
+        self.stats['duplicated'] += copies - 1
+        deliveries = []
+        for _ in range(copies):
+            datagram = data
+            if self.rng.random() < 1 - (1 - self.corrupt) ** fragments and datagram:
+                corrupted = bytearray(datagram)
+                bit = self.rng.randrange(len(corrupted) * 8)
+                corrupted[bit // 8] ^= 1 << (bit % 8)
+                datagram = bytes(corrupted)
+                self.stats['corrupted'] += 1
+            # drawn before the queue is looked at, so the random sequence does not depend on timing
+            reordered = self.rng.random() < self.reorder
+            delay = 0 if reordered else self.latency()
+            sent = self.transmit(len(datagram), now)
+            if sent is None:
+                self.stats['overflowed'] += 1
+                continue
+            self.stats['reordered'] += reordered
+            deliveries.append((sent + delay, datagram))
+        return deliveries
+
+
+class UDPRelay:
+    """
+    Relay of the UDP datagrams between the clients and the server, driven
+    by run(): a selector for the sockets and a heap of the datagrams that
+    are waiting out their delay. upstream impairs what the clients send,
+    downstream what the server sends.
+    """
+
+    def __init__(self, listen_address, server_address, upstream, downstream):
+        self.server_address = server_address
+        self.impairments = {'upstream': upstream, 'downstream': downstream}
+        self.listen_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.listen_socket.bind(listen_address)
+        self.listen_socket.setblocking(False)
+        self.upstream = {}  # client address -> socket connected to the server
+        self.clients = {}  # upstream socket -> client address
+        self.pending = []  # (delivery time, sequence, socket, datagram, address or None)
+        self.sequence = 0
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.listen_socket, selectors.EVENT_READ)
+        self.relayed = 0
+
+    def _upstream_socket(self, client_address):
+        if client_address not in self.upstream:
+            upstream_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            upstream_socket.connect(self.server_address)
+            upstream_socket.setblocking(False)
+            self.upstream[client_address] = upstream_socket
+            self.clients[upstream_socket] = client_address
+            self.selector.register(upstream_socket, selectors.EVENT_READ)
+        return self.upstream[client_address]
+
+    def _impair(self, impairment, data, destination_socket, address, now):
+        for delivery_time, datagram in impairment.schedule(data, now):
+            self.sequence += 1
+            heapq.heappush(self.pending, (delivery_time, self.sequence, destination_socket, datagram, address))
+
+    def _receive(self, sock, now):
+        # Drain up to RECEIVE_BATCH datagrams of a readable socket
+        for _ in range(RECEIVE_BATCH):
+            try:
+                if sock is self.listen_socket:
+                    data, client_address = sock.recvfrom(DATAGRAM_SIZE)
+                    self._impair(self.impairments['upstream'], data, self._upstream_socket(client_address), None, now)
+                else:
+                    data = sock.recv(DATAGRAM_SIZE)
+                    self._impair(self.impairments['downstream'], data, self.listen_socket, self.clients[sock], now)
+            except BlockingIOError:
+                break
+            except ConnectionRefusedError:
+                pass  # the server is not up (yet), like a lost datagram
+
+    def run(self):
+        while True:
+            timeout = max(0, self.pending[0][0] - time.time()) if self.pending else None
+            for key, _ in self.selector.select(timeout):
+                self._receive(key.fileobj, time.time())
+            now = time.time()
+            while self.pending and self.pending[0][0] <= now:
+                _, _, sock, datagram, address = heapq.heappop(self.pending)
+                try:
+                    if address is None:
+                        sock.send(datagram)
+                    else:
+                        sock.sendto(datagram, address)
+                    self.relayed += 1
+                except OSError:
+                    pass
+
+    def print_stats(self):
+        for direction, impairment in self.impairments.items():
+            counts = ", ".join(f"{count} {name}" for name, count in sorted(impairment.stats.items()))
+            print(f"UDP {direction}: {counts or 'nothing received'}")
+        print(f"UDP datagrams relayed: {self.relayed}")
+
+
+def pump(source, destination, impairment):
+    # Copy one direction of a TCP connection, every chunk waits out its delay
+    # in a queue so a slow link does not slow down reading until the queue is full
+    chunks = queue.Queue(TCP_QUEUE_CHUNKS)
+
+    def forward():
+        while True:
+            delivery_time, data = chunks.get()
+            time.sleep(max(0, delivery_time - time.time()))
+            if not data:
+                break
+            try:
+                destination.sendall(data)
+            except OSError:
+                break
+        try:
+            destination.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+    forwarder = threading.Thread(target=forward, daemon=True)
+    forwarder.start()
+    last_delivery = 0.0
+    while True:
+        try:
+            data = source.recv(TCP_CHUNK_SIZE)
+        except OSError:
+            data = b""
+        now = time.time()
+        # a stream stays in order, jitter only ever adds to the previous chunk's delivery time
+        sent = impairment.transmit(len(data), now) if data else now
+        last_delivery = max(last_delivery, sent + impairment.latency())
+        chunks.put((last_delivery, data))
+        if not data:
+            break
+    forwarder.join()
+
+
+def relay_connection(client, server_address, upstream, downstream):
+    with client:
+        try:
+            server = socket.create_connection(server_address)
+        except OSError:
+            return
+        with server:
+            back = threading.Thread(target=pump, args=(server, client, downstream), daemon=True)
+            back.start()
+            pump(client, server, upstream)
+            back.join()
+
+
+def run_tcp_relay(listen_address, server_address, seed, delay, jitter, rate):
+    listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listen_socket.bind(listen_address)
+    listen_socket.listen()
+    connection = 0
+    while True:
+        client, _ = listen_socket.accept()
+        connection += 1
+        upstream, downstream = (Impairment(random.Random(f"{seed}:tcp{connection}:{direction}"), delay=delay,
+                                           jitter=jitter, rate=rate, limit=None)
+                                for direction in ("upstream", "downstream"))
+        threading.Thread(target=relay_connection, args=(client, server_address, upstream, downstream), daemon=True).start()
+
+
+def parse_address(text):
+    host, _, port = text.rpartition(":")
+    return socket.gethostbyname(host or "127.0.0.1"), int(port)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="UDP/TCP relay that emulates an impaired link")
+    parser.add_argument("--listen", type=parse_address, default="127.0.0.1:9000", help="HOST:PORT to listen on (UDP and TCP)")
+    parser.add_argument("--server", type=parse_address, default="127.0.0.1:8000", help="HOST:PORT of the server")
+    parser.add_argument("--delay", type=float, default=0.0, help="one way delay in ms")
+    parser.add_argument("--jitter", type=float, default=0.0, help="the delay varies uniformly by up to this many ms")
+    parser.add_argument("--loss", type=float, default=0.0, help="loss in percent (UDP), in the good state with --burst")
+    parser.add_argument("--burst", type=float, nargs=2, metavar=("P", "R"),
+                        help="Gilbert-Elliott loss (UDP): percent chance per datagram to enter and to leave the bad state")
+    parser.add_argument("--burst-loss", type=float, default=100.0, help="loss in percent in the bad state of --burst")
+    parser.add_argument("--corrupt", type=float, default=0.0, help="corrupted datagrams in percent (UDP)")
+    parser.add_argument("--duplicate", type=float, default=0.0, help="duplicated datagrams in percent (UDP)")
+    parser.add_argument("--reorder", type=float, default=0.0, help="datagrams sent without the delay in percent (UDP)")
+    parser.add_argument("--rate", type=float, default=0.0, help="rate limit in kbit/s per direction, 0 for none")
+    parser.add_argument("--limit", type=int, default=QUEUE_LIMIT, help="datagrams queued by the rate limit before it drops (UDP)")
+    parser.add_argument("--mtu", type=int, default=0, help="emulate IP fragmentation of the datagrams larger than this MTU (UDP)")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the random decisions, the same seed gives the same impairments")
+    args = parser.parse_args()
+
+    upstream, downstream = (Impairment(random.Random(f"{args.seed}:udp:{direction}"), args.delay, args.jitter, args.loss,
+                                       args.burst, args.burst_loss, args.corrupt, args.duplicate, args.reorder,
+                                       args.rate, args.limit, args.mtu)
+                            for direction in ("upstream", "downstream"))
+    threading.Thread(target=run_tcp_relay, args=(args.listen, args.server, args.seed, args.delay, args.jitter, args.rate),
+                     daemon=True).start()
+    relay = UDPRelay(args.listen, args.server, upstream, downstream)
+    print(f"Relaying {args.listen} -> {args.server}")
+    # the statistics are printed on SIGTERM too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        relay.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        relay.print_stats()
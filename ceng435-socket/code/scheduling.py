@@ -0,0 +1,145 @@
+import heapq
+import os
+
+# Scheduling of the objects of a transfer, shared by the TCP and the UDP part.
+# The UDP client interleaves the segments of all objects in one stream, a
+# scheduler picks the object the next segment comes from:
+#   rr        round-robin, one segment of every object in turn
+#   srf       shortest remaining first, the object with the fewest segments
+#             left (so the small objects go first, one after the other)
+#   wfq       weighted fair queuing, every object gets a share of the stream
+#             proportional to its weight (the object with the smallest
+#             virtual finish time of its next segment goes next)
+#   priority  strict priority, lower classes only get segments when no
+#             object of a higher one has any left, round-robin within a class
+# The TCP client sends whole objects one after the other, the same
+# schedulers only decide the order (see object_order).
+# Priorities and weights are given per object class, the part of the file
+# name before the "-" ("small", "large").
+# Every choice only depends on the object's own progress, ties go to the
+# lower object id, so any subset of the objects is scheduled in the same
+# relative order as in the whole transfer (the UDP pipeline relies on it).
+
+SCHEDULERS = ("rr", "srf", "wfq", "priority")
+DEFAULT_SCHEDULER = "rr"
+# lower is more urgent
+DEFAULT_PRIORITIES = {"small": 0, "large": 1}
+DEFAULT_WEIGHTS = {"small": 4.0, "large": 1.0}
+
+
+class Stream:
+    """
+    The segments (any iterator) of one object, size of them in total, and
+    what the schedulers order it by. sent and remaining count the segments
+    taken so far and still expected.
+    """
+
+    def __init__(self, object_id, segments, size, priority=0, weight=1.0):
+        self.object_id = object_id
+        self.segments = segments
+        self.remaining = size
+        self.sent = 0
+        self.priority = priority
+        self.weight = weight
+
+
+# the key each scheduler orders the streams by, the smallest goes next
+SCHEDULER_KEYS = {
+    "rr": lambda stream: (stream.sent,),
+    "srf": lambda stream: (stream.remaining,),
+    "wfq": lambda stream: ((stream.sent + 1) / stream.weight,),
+    "priority": lambda stream: (stream.priority, stream.sent),
+}
+# the same for whole objects (see object_order), stable sorting keeps the given order on ties
+OBJECT_ORDER_KEYS = {
+    "rr": lambda stream: 0,
+    "srf": lambda stream: stream.remaining,
+    "wfq": lambda stream: stream.remaining / stream.weight,
+    "priority": lambda stream: stream.priority,
+}
+
+
+def schedule(streams, scheduler=DEFAULT_SCHEDULER):
+    """
+    Yield the segments of the streams in the order of the scheduler.
+    A stream whose iterator runs out is dropped.
+    """
+    key = SCHEDULER_KEYS[scheduler]
+    heap = [(key(stream), stream.object_id, i) for i, stream in enumerate(streams)]
+    heapq.heapify(heap)
+    while heap:
+        _, object_id, i = heapq.heappop(heap)
+        stream = streams[i]
+        segment = next(stream.segments, None)
+        if segment is None:
+            continue
+        stream.sent += 1
+        stream.remaining -= 1
+        heapq.heappush(heap, (key(stream), object_id, i))
+        yield segment
+
+
+def object_order(streams, scheduler=DEFAULT_SCHEDULER):
+    """
+    The order to send whole objects in, one after the other: the order in
+    which they would complete if their segments were scheduled together.
+    rr keeps the given order (sending whole objects cannot take turns),
+    srf is smallest first, wfq orders by size over weight (the order of
+    completion under fair queuing), priority by class, in the given order
+    within a class. size is in whatever unit the caller uses (bytes).
+    """
+    return sorted(streams, key=OBJECT_ORDER_KEYS[scheduler])
+
+
+def object_class(name):
+    # "small" for "small-3.obj" (or a path to it)
+    return os.path.basename(name).split("-", 1)[0]
+
+
+def parse_classes(text, convert=float):
+    # "small=4,large=1" -> {"small": 4.0, "large": 1.0}, raises ValueError
+    classes = {}
+    for item in text.split(","):
+        name, separator, value = item.partition("=")
+        if not separator or not name:
+            raise ValueError(f"expected CLASS=VALUE, got {item!r}")
+        classes[name.strip()] = convert(value)
+    return classes
+
+
+def parse_priorities(text):
+    return parse_classes(text, int)
+
+
+def parse_weights(text):
+    weights = parse_classes(text)
+    if any(weight <= 0 for weight in weights.values()):
+        raise ValueError("weights have to be positive")
+    return weights
+
+
+def percentile(values, q):
+    # of a sorted list, interpolated between the closest ranks
+    position = (len(values) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def completion_report(objects):
+    """
+    p50 and p99 of the completion times of the objects (Metrics.objects,
+    seconds from the start of the transfer) and the mean per object class,
+    what a scheduler trades off. None if no object has one.
+    Exact, the histograms' buckets are too coarse for 20 objects.
+    """
+    completions = sorted(record["completed_seconds"] for record in objects if "completed_seconds" in record)
+    if not completions:
+        return None
+    classes = {}
+    for record in objects:
+        if "completed_seconds" in record:
+            classes.setdefault(object_class(record["object"]), []).append(record["completed_seconds"])
+    means = ", ".join(f"{name} mean {sum(times) / len(times):.3f} s" for name, times in sorted(classes.items()))
+    return (f"p50 {percentile(completions, 0.5):.3f} s, p99 {percentile(completions, 0.99):.3f} s, "
+            f"{means} ({len(completions)} objects)")
@@ -1,53 +1,313 @@
 import socket
 import os
+import time
+import queue
+import threading
+import argparse
+from tcp_protocol import (pack_frame_header, pack_chunk, receive_frame_header, receive_exact, file_digest, ProtocolError,
+                          FRAME_OBJECT, FRAME_END, FRAME_ACK, FRAME_HELLO, FRAME_RESUME, FRAME_SIGNATURE, FRAME_DELTA,
+                          FRAME_HEADER_SIZE, CHUNK_HEADER, NO_DIGEST)
+from compression import CODECS, CODEC_IDS, CODEC_NAMES, compress, shrinks
+from delta import compute_delta, literal_length
+from metrics import Metrics, record_tcp_info, EXPORT_FORMATS
+from scheduling import (Stream, object_order, object_class, parse_priorities, parse_weights, completion_report,
+                        SCHEDULERS, DEFAULT_SCHEDULER, DEFAULT_PRIORITIES, DEFAULT_WEIGHTS)
 
-def send_object(sock, filepath):
+# number of TCP connections the objects are spread over
+DEFAULT_CONNECTIONS = 1
+# objects are compressed in independent chunks of this size
+COMPRESS_CHUNK_SIZE = 256 * 1024
+
+def send_object(sock, filepath, codec=None, offset=0):
+    # Sends one object frame, compressed with codec if it was negotiated and
+    # the object compresses. Only the data from offset on is sent, the server
+    # already has the rest. Returns the number of bytes put on the wire and
+    # of object data sent, (0, 0) if the object could not be sent.
 
     if not os.path.exists(filepath): # Check if the file exists
         print(f"File not found: {filepath}")
-        return False
+        return 0, 0
 
     try:
         file_size = os.path.getsize(filepath) # Get the size of the file
-        # Send the size of the object first
-        sock.sendall(file_size.to_bytes(4, 'big')) # Convert int to bytes and send
+        # The frame header carries the name, the 64 bit size and the MD5 of
+        # the object so the server can verify it while it streams to disk
+        name = os.path.basename(filepath).encode()
+        digest = file_digest(filepath)
 
-        # Send the object data
         with open(filepath, 'rb') as file: # Open the file as binary
-            while True: # Keep sending until all is sent
-                data = file.read(1024)  # Read in chunks
-                if not data: # EOF
-                    break
-                sock.sendall(data) # Send the chunk
-        
-        # Wait for acknowledgment
-        ack = sock.recv(1024) # Receive acknowledgment
-        print(f"Acknowledged: {ack.decode()}") # Print acknowledgment
+            file.seek(offset)
+            chunk = b''
+            if codec:
+                # the first chunk decides whether the object is worth compressing
+                chunk = file.read(COMPRESS_CHUNK_SIZE)
+                packed = compress(codec, chunk)
+            if chunk and shrinks(len(chunk), len(packed)):
+                # every chunk is compressed on its own and sent with its length
+                header = pack_frame_header(FRAME_OBJECT, file_size, name, digest, CODEC_IDS[codec], offset)
+                sock.sendall(header)
+                wire_bytes = len(header)
+                while chunk:
+                    sock.sendall(pack_chunk(packed))
+                    wire_bytes += CHUNK_HEADER.size + len(packed)
+                    chunk = file.read(COMPRESS_CHUNK_SIZE)
+                    packed = compress(codec, chunk)
+                sock.sendall(pack_chunk(b''))
+                wire_bytes += CHUNK_HEADER.size
+            else:
+                header = pack_frame_header(FRAME_OBJECT, file_size, name, digest, offset=offset)
+                sock.sendall(header)
+                # Send the object data, sendfile lets the kernel copy the file straight
+                # into the socket (falls back to large read/send chunks where unsupported)
+                sock.sendfile(file, offset)
+                wire_bytes = len(header) + file_size - offset
+        # no acknowledgment per object, the next frame follows right away
+        print(f"Sent {filepath}")
     except Exception as e:
         print(f"Error sending object: {e}") # Print error message
-        return False
-    return True
+        return 0, 0
+    return wire_bytes, file_size - offset
 
-def start_client():
-    # HOST = "127.0.0.1"
-    HOST = socket.gethostbyname("server")  # Use this if you are using docker compose
-    PORT = 8000
+def send_delta(sock, filepath, signature, codec=None):
+    # Sends one object as a DELTA frame: the delta stream against the server's
+    # copy with the given signature (see delta.py), in chunks that are
+    # compressed with codec if it was negotiated.
+    # Returns the number of bytes put on the wire and of object data sent (the
+    # literal data of the delta), (0, 0) if the object could not be sent.
+    try:
+        header = pack_frame_header(FRAME_DELTA, os.path.getsize(filepath), os.path.basename(filepath).encode(),
+                                   file_digest(filepath), CODEC_IDS[codec] if codec else 0)
+        sock.sendall(header)
+        wire_bytes = len(header)
+        literal = 0
+        chunk = bytearray()
+        for instruction in compute_delta(filepath, signature):
+            chunk += instruction
+            literal += literal_length(instruction)
+            if len(chunk) >= COMPRESS_CHUNK_SIZE:
+                packed = compress(codec, chunk) if codec else bytes(chunk)
+                sock.sendall(pack_chunk(packed))
+                wire_bytes += CHUNK_HEADER.size + len(packed)
+                chunk = bytearray()
+        if chunk:
+            packed = compress(codec, chunk) if codec else bytes(chunk)
+            sock.sendall(pack_chunk(packed))
+            wire_bytes += CHUNK_HEADER.size + len(packed)
+        sock.sendall(pack_chunk(b''))
+        wire_bytes += CHUNK_HEADER.size
+        print(f"Sent the delta of {filepath}")
+    except Exception as e:
+        print(f"Error sending delta: {e}")
+        return 0, 0
+    return wire_bytes, literal
+
+def negotiate_codec(sock, codec):
+    # HELLO exchange, returns the codec the server accepted or None
+    sock.sendall(pack_frame_header(FRAME_HELLO, codec=CODEC_IDS[codec]))
+    frame = receive_frame_header(sock)
+    if frame is None or frame[0] != FRAME_HELLO:
+        raise ProtocolError("no answer to the HELLO frame")
+    return CODEC_NAMES.get(frame[1])
 
+def query_objects(address, filepaths, frame_type):
+    """
+    Ask the server about every object with one frame_type frame (name, size
+    and digest of the object). All questions are sent at once on a
+    connection of their own and the answers come back in the same order.
+    Returns a dict filepath -> (answer frame, signature following it).
+    """
+    filepaths = [filepath for filepath in filepaths if os.path.exists(filepath)]
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.connect((HOST, PORT)) # Connect to the server
-        
-        for i in range(10):
-            # Send small and large objects
-            if not send_object(s, f"../objects/small-{i}.obj"): # Send small object
-                print(f"Error in sending small-{i}.obj. Ending transmission.")
-                break # Break if an error occurs
-            if not send_object(s, f"../objects/large-{i}.obj"): # Send large object
-                print(f"Error in sending large-{i}.obj. Ending transmission.")
-                break # Break if an error occurs
-
-        # Send an end-of-transmission message
-        s.sendall(b"END") 
+        s.connect(address)
+        for filepath in filepaths:
+            name = os.path.basename(filepath).encode()
+            s.sendall(pack_frame_header(frame_type, os.path.getsize(filepath), name, file_digest(filepath)))
+        s.sendall(pack_frame_header(FRAME_END))
+        answers = {}
+        for filepath in filepaths:
+            frame = receive_frame_header(s)
+            if frame is None or frame[0] != frame_type:
+                raise ProtocolError(f"no answer to frame type {frame_type}")
+            signature = b''
+            if frame_type == FRAME_SIGNATURE and frame[2]:
+                signature = receive_exact(s, frame[2])
+                if signature is None:
+                    raise ProtocolError("connection closed before the signature")
+            answers[filepath] = (frame, bytes(signature))
+        receive_frame_header(s)  # the ACK of the END frame
+    return answers
+
+def query_offsets(address, filepaths):
+    # RESUME: filepath -> offset to send the object from (how much of it the server has)
+    return {filepath: frame[3] for filepath, (frame, _) in query_objects(address, filepaths, FRAME_RESUME).items()}
+
+def query_signatures(address, filepaths):
+    # SIGNATURE: filepath -> (MD5 digest, block signature) of the server's copy, for the objects it has a copy of
+    answers = query_objects(address, filepaths, FRAME_SIGNATURE)
+    return {filepath: (frame[5], signature) for filepath, (frame, signature) in answers.items() if frame[5] != NO_DIGEST}
+
+def send_objects(address, pending, results, metrics, codec=None):
+    # One connection of the pool: keeps taking the next object from the shared
+    # queue until it is empty, so a small object never waits behind the large
+    # objects of another connection.
+    # The time to send an object ends when its last byte is in the socket
+    # buffer, so the last objects of a connection look a little faster.
+    # The objects are taken in the order they were queued (see start_client).
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.connect(address) # Connect to the server
+        metrics.count('connections')
+        wire_bytes = 0
+        if codec:
+            try:
+                accepted = negotiate_codec(s, codec)
+            except (ProtocolError, OSError) as e:
+                print(f"Error negotiating compression: {e}")
+                return
+            if accepted != codec:
+                print(f"The server does not support {codec} compression, sending uncompressed.")
+            codec = accepted
+            wire_bytes += FRAME_HEADER_SIZE
+
+        sent = 0
+        payload_bytes = 0
+        while True:
+            try:
+                filepath, offset, signature = pending.get_nowait()
+            except queue.Empty:
+                break
+            started = time.time()
+            if signature is not None:
+                object_wire_bytes, object_bytes = send_delta(s, filepath, signature, codec)
+            else:
+                object_wire_bytes, object_bytes = send_object(s, filepath, codec, offset)
+            if not object_wire_bytes:
+                print(f"Error in sending {filepath}. Ending transmission on this connection.")
+                return # the server sees the connection close
+            sent += 1
+            # only what this run sent counts, not what a resume or delta left out
+            payload_bytes += object_bytes
+            wire_bytes += object_wire_bytes
+            metrics.object_done(os.path.basename(filepath), object_bytes, time.time() - started, completed=metrics.elapsed())
+
+        # Send an end-of-transmission frame, the server answers it with the
+        # number of objects it verified on this connection
+        s.sendall(pack_frame_header(FRAME_END))
+        wire_bytes += FRAME_HEADER_SIZE
         print("End of transmission message sent.")
+        try:
+            frame = receive_frame_header(s)
+        except (ProtocolError, OSError) as e:
+            print(f"Error receiving acknowledgment: {e}")
+            return
+        if frame is None or frame[0] != FRAME_ACK:
+            print("Server closed the connection without acknowledging.")
+            return
+        print(f"Acknowledged: {frame[2]} of {sent} objects verified")
+        # everything was delivered, the kernel's view of the connection is final
+        record_tcp_info(metrics, s)
+        results.append((sent, frame[2], payload_bytes, wire_bytes))
+
+def start_client(connections=DEFAULT_CONNECTIONS, codec=None, resume=False, delta=False, server="server", port=8000,
+                 metrics_path=None, metrics_format="json", scheduler=DEFAULT_SCHEDULER, priorities=DEFAULT_PRIORITIES,
+                 weights=DEFAULT_WEIGHTS):
+    # metrics_path is the file the metrics of the transfer are appended to,
+    # as JSON lines or a Prometheus text dump (metrics_format, see metrics.py)
+    # scheduler picks the order the objects are queued in, with the
+    # priorities and weights of the object classes (see scheduling.py).
+    # The objects are sent whole, so only their order changes.
+    # HOST = "127.0.0.1"
+    HOST = socket.gethostbyname(server)  # "server" if you are using docker compose
+    PORT = port
+
+    filepaths = []
+    for i in range(10):
+        # Send small and large objects
+        filepaths.append(f"../objects/small-{i}.obj")
+        filepaths.append(f"../objects/large-{i}.obj")
+
+    results = []  # (objects sent, objects verified, payload bytes, wire bytes) per connection, list.append is thread safe
+    metrics = Metrics(transport="tcp", role="client")
+    start_time = time.time()
+
+    # with resume the objects an earlier, interrupted run left on the server are only completed
+    offsets = {}
+    if resume:
+        try:
+            offsets = query_offsets((HOST, PORT), filepaths)
+        except (ProtocolError, OSError) as e:
+            print(f"Error querying the server for resumable objects: {e}, sending everything")
+        print(f"Resuming: {sum(offsets.values())} bytes are already on the server")
+
+    # with delta the objects the server has an older copy of are sent as a delta
+    # against that copy, and the ones it already has not at all
+    signatures = {}
+    if delta:
+        try:
+            signatures = query_signatures((HOST, PORT), filepaths)
+        except (ProtocolError, OSError) as e:
+            print(f"Error querying the server for object signatures: {e}, sending everything")
+        for filepath, (basis_digest, _) in signatures.items():
+            if basis_digest == file_digest(filepath):
+                offsets[filepath] = os.path.getsize(filepath)
+        print(f"Delta: {len(offsets)} objects unchanged, {len(signatures) - len(offsets)} sent as a delta")
+
+    # the bytes left to send of every object decide where srf and wfq queue it
+    streams = [Stream(i, None, max(0, os.path.getsize(filepath) - offsets.get(filepath, 0)) if os.path.exists(filepath) else 0,
+                      priorities.get(object_class(filepath), 0), weights.get(object_class(filepath), 1.0))
+               for i, filepath in enumerate(filepaths)]
+    pending = queue.Queue()
+    for stream in object_order(streams, scheduler):
+        filepath = filepaths[stream.object_id]
+        # an unchanged object goes as an empty OBJECT frame, the server verifies its copy
+        signature = signatures[filepath][1] if filepath in signatures and filepath not in offsets else None
+        pending.put((filepath, offsets.get(filepath, 0), signature))
+
+    # every connection runs in its own thread and pulls objects from the queue
+    threads = [threading.Thread(target=send_objects, args=((HOST, PORT), pending, results, metrics, codec)) for _ in range(connections)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    elapsed_time = time.time() - start_time
+    verified = sum(result[1] for result in results)
+    print(f"Sent {sum(result[0] for result in results)} objects over {connections} connection(s), {verified} verified by the server")
+    print(f"Total time taken for file transfer: {elapsed_time} seconds")
+    payload_bytes = sum(result[2] for result in results)
+    wire_bytes = sum(result[3] for result in results)
+    print(f"Payload bytes: {payload_bytes}, wire bytes: {wire_bytes} ({wire_bytes / max(payload_bytes, 1):.2f} of the payload)")
+    print(f"Average goodput: {payload_bytes * 8 / elapsed_time} bits per second")
+    report = completion_report(metrics.objects)
+    if report:
+        print(f"Object completion ({scheduler}): {report}")
+    if 'rtt_seconds' in metrics.histograms:  # from TCP_INFO, Linux only
+        rtt = metrics.histograms['rtt_seconds']
+        print(f"Retransmitted segments: {metrics.counters['retransmits']}, RTT: {rtt.sum / rtt.count * 1000:.2f} ms (kernel estimate)")
+
+    if metrics_path:
+        metrics.count('objects_sent', sum(result[0] for result in results))
+        metrics.count('objects_verified', verified)
+        metrics.count('payload_bytes', payload_bytes)
+        metrics.count('wire_bytes', wire_bytes)
+        metrics.observe('goodput_bps', payload_bytes * 8 / elapsed_time)
+        metrics.export(metrics_path, metrics_format)
 
 if __name__ == "__main__":
-    start_client()
+    parser = argparse.ArgumentParser(description="TCP client")
+    parser.add_argument("--connections", type=int, default=DEFAULT_CONNECTIONS, help="number of parallel TCP connections")
+    parser.add_argument("--compress", choices=sorted(CODECS), help="compress the objects that compress")
+    transfer = parser.add_mutually_exclusive_group()
+    transfer.add_argument("--resume", action="store_true", help="only send what the server is missing from an interrupted run")
+    transfer.add_argument("--delta", action="store_true", help="only send what changed since the copies the server has")
+    parser.add_argument("--server", default="server", help="server host name or address (default: the docker compose host name)")
+    parser.add_argument("--port", type=int, default=8000, help="server port")
+    parser.add_argument("--metrics", metavar="FILE", help="append the metrics of the transfer to this file")
+    parser.add_argument("--metrics-format", choices=EXPORT_FORMATS, default="json", help="JSON lines or Prometheus text")
+    parser.add_argument("--scheduler", choices=SCHEDULERS, default=DEFAULT_SCHEDULER, help="order the objects are sent in")
+    parser.add_argument("--priorities", metavar="CLASS=LEVEL,...", type=parse_priorities, default=DEFAULT_PRIORITIES,
+                        help="priority of every object class for --scheduler priority, lower goes first (default: small=0,large=1)")
+    parser.add_argument("--weights", metavar="CLASS=WEIGHT,...", type=parse_weights, default=DEFAULT_WEIGHTS,
+                        help="weight of every object class for --scheduler wfq (default: small=4,large=1)")
+    args = parser.parse_args()
+    start_client(args.connections, args.compress, args.resume, args.delta, args.server, args.port, args.metrics, args.metrics_format,
+                 args.scheduler, args.priorities, args.weights)
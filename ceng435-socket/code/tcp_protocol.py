@@ -0,0 +1,128 @@
+import hashlib
+import struct
+
+# Framing of the TCP object stream.
+# Every frame starts with a fixed size header, an object frame is followed
+# by the object name and then the object data: exactly size bytes if the
+# codec field is 0, otherwise a sequence of compressed chunks, each one a
+# 4 byte length followed by that many bytes, ended by a zero length.
+# size is always the size of the original object, offset the position in
+# the object the data starts at (0 unless the object is resumed).
+# All fields are in network byte order.
+# A client that wants compression starts with a HELLO frame naming the
+# codec, the server answers with a HELLO frame naming the codec it accepts
+# (0 if none). Then the client sends its objects back to back without
+# waiting for anything, then an END frame. The server answers the END frame
+# with one ACK frame whose size field is the number of objects it received
+# and verified.
+# To resume an interrupted transfer the client first sends a RESUME frame
+# (name, size and digest) per object and the END frame, the server answers
+# every RESUME frame with a RESUME frame whose offset field says how much of
+# that object it already has (see journal.py), then the ACK frame. The
+# objects are then sent from these offsets.
+# A delta transfer (see delta.py) starts the same way with a SIGNATURE frame
+# per object, the server answers each with a SIGNATURE frame carrying the
+# MD5 of its copy of the object (NO_DIGEST if it has none) and, in the size
+# field, the length of the block signature of that copy that follows it.
+# An object the server already has is then sent as an OBJECT frame with
+# offset = size, a changed one as a DELTA frame followed by the delta stream
+# in chunks (compressed like the object data if a codec is set).
+
+MAGIC = b"C435"
+VERSION = 3
+
+FRAME_OBJECT = 1
+FRAME_END = 2
+FRAME_ACK = 3
+FRAME_HELLO = 4
+FRAME_RESUME = 5
+FRAME_SIGNATURE = 6
+FRAME_DELTA = 7
+
+# magic | version | frame type | codec | name length | object size | offset | MD5 digest of the object
+FRAME_HEADER = struct.Struct("!4sBBBHQQ16s")
+FRAME_HEADER_SIZE = FRAME_HEADER.size
+# length of a compressed chunk
+CHUNK_HEADER = struct.Struct("!I")
+
+DIGEST_SIZE = 16
+NO_DIGEST = bytes(DIGEST_SIZE)
+
+
+class ProtocolError(Exception):
+    # The peer sent something that is not a valid frame
+    pass
+
+
+def pack_frame_header(frame_type, size=0, name=b"", digest=NO_DIGEST, codec=0, offset=0):
+    # Encode a frame header followed by the object name
+    return FRAME_HEADER.pack(MAGIC, VERSION, frame_type, codec, len(name), size, offset, digest) + name
+
+
+def pack_chunk(data):
+    # Encode a compressed chunk, an empty one ends the object
+    return CHUNK_HEADER.pack(len(data)) + data
+
+
+def receive_exact(conn, size):
+    """
+    Read exactly size bytes from the connection.
+    recv can return fewer bytes than asked for, so this keeps reading into
+    one preallocated buffer. Returns None if the connection is closed before
+    the first byte, raises ProtocolError if it is closed in the middle.
+    """
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        nbytes = conn.recv_into(view[received:])
+        if not nbytes:
+            if received == 0:
+                return None
+            raise ProtocolError(f"connection closed after {received} of {size} bytes")
+        received += nbytes
+    return buffer
+
+
+def receive_frame_header(conn):
+    """
+    Read and check one frame header and the name that follows it.
+    Returns (frame type, codec, object size, offset, name, digest), or None if the
+    connection was closed cleanly between two frames.
+    """
+    header = receive_exact(conn, FRAME_HEADER_SIZE)
+    if header is None:
+        return None
+    magic, version, frame_type, codec, name_length, size, offset, digest = FRAME_HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ProtocolError(f"bad magic {magic!r}")
+    if version != VERSION:
+        raise ProtocolError(f"unsupported protocol version {version}")
+    name = b""
+    if name_length:
+        name = receive_exact(conn, name_length)
+        if name is None:
+            raise ProtocolError("connection closed before the object name")
+    if offset > size:
+        raise ProtocolError(f"offset {offset} past the end of a {size} byte object")
+    return frame_type, codec, size, offset, bytes(name).decode(), digest
+
+
+def receive_chunk_length(conn):
+    # Length of the next compressed chunk, 0 at the end of the object
+    header = receive_exact(conn, CHUNK_HEADER.size)
+    if header is None:
+        raise ProtocolError("connection closed inside a compressed object")
+    return CHUNK_HEADER.unpack(header)[0]
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    # MD5 of a file, the same digest the objects are shipped with
+    hash_obj = hashlib.md5()
+    with open(path, 'rb') as file:
+        while True:
+            data = file.read(chunk_size)
+            if not data:
+                break
+            hash_obj.update(data)
+    return hash_obj.digest()
@@ -1,62 +1,215 @@
 import socket
 import os
+import threading
+import time
+import argparse
+import zlib
+import lzma
+from tcp_protocol import (receive_frame_header, receive_chunk_length, pack_frame_header, ProtocolError,
+                          FRAME_OBJECT, FRAME_END, FRAME_ACK, FRAME_HELLO, FRAME_RESUME, FRAME_SIGNATURE, FRAME_DELTA,
+                          FRAME_HEADER_SIZE, CHUNK_HEADER)
+from compression import CODEC_NAMES, decompressor
+from journal import ObjectWriter, read_journal
+from delta import DeltaWriter, file_signature
+from metrics import Metrics, record_tcp_info, EXPORT_FORMATS
 
-# Function to receive a file object from the connection
-def receive_object(conn, filename):
+# the client sends 10 small and 10 large objects
+OBJECT_COUNT = 20
+# object data is received into a preallocated buffer of this size and written out as it arrives
+RECEIVE_CHUNK_SIZE = 256 * 1024
+
+# Function to receive the data of a file object from the connection
+def receive_object(conn, filename, object_size, digest, buffer, codec=None, offset=0, delta=False):
+    # Read the object data straight into the receive buffer and stream it
+    # to the file, nothing is accumulated in memory. Compressed objects come
+    # in chunks that are decompressed piece by piece as they arrive.
+    # A resumed object keeps its first offset bytes and the data continues after them.
+    # With delta the chunks are a delta stream that rebuilds the object from
+    # our old copy of it (see delta.py).
+    # The MD5 is updated on the written data and compared with the digest
+    # from the frame header, the progress is journaled (see journal.py).
+    # Returns (verified, number of data bytes read from the connection, payload
+    # bytes of the object written or applied: after the offset of a resumed
+    # object, only the literal data of a delta).
+    # Raises ProtocolError if the connection is lost in the middle.
+    view = memoryview(buffer)
+    wire_bytes = 0
+    writer = DeltaWriter(filename, digest.hex()) if delta else ObjectWriter(filename, digest.hex(), offset)
     try:
-        # Receive the first 4 bytes, which indicate the size of the incoming file
-        object_size_bytes = conn.recv(4)
-        if not object_size_bytes:
-            return False # Return False if no data is received
-        object_size = int.from_bytes(object_size_bytes, 'big') # Convert bytes to integer
-
-        # Read the object data
-        object_data = b'' # Initialize an empty byte string
-        while len(object_data) < object_size:
-            # Keep receiving data until the full file is received
-            more_data = conn.recv(object_size - len(object_data))
-            if not more_data:
-                raise Exception("Connection lost while receiving file data.")
-            object_data += more_data # Append received data
-
-        # Write the received data to a file
-        with open(filename, 'wb') as file:
-            file.write(object_data)
-
-        print(f"Received object of size: {len(object_data)} and saved to {filename}")
-        # Send acknowledgment to the client
-        conn.sendall(b"Ack")
-    except Exception as e:
-        print(f"Error receiving object: {e}")
-        return False # Return False if an error occurs
-    return True   # Return True if the file is received successfully
-
-def start_server():
-    HOST = "server"
-    #HOST = "127.0.0.1"
-    PORT = 8000
+        if codec or delta:
+            while True:
+                remaining = receive_chunk_length(conn)
+                wire_bytes += CHUNK_HEADER.size + remaining
+                if remaining == 0:
+                    break
+                unpacker = decompressor(codec) if codec else None # every chunk was compressed on its own
+                while remaining:
+                    nbytes = conn.recv_into(view, min(len(view), remaining))
+                    if not nbytes:
+                        raise ProtocolError("Connection lost while receiving file data.")
+                    writer.write(unpacker.decompress(view[:nbytes]) if unpacker else view[:nbytes])
+                    remaining -= nbytes
+        else:
+            while writer.offset < object_size:
+                # Keep receiving data until the full file is received
+                nbytes = conn.recv_into(view, min(len(view), object_size - writer.offset))
+                if not nbytes:
+                    raise ProtocolError("Connection lost while receiving file data.")
+                writer.write(view[:nbytes])
+                wire_bytes += nbytes
+    finally:
+        # an interrupted object keeps what it got for the next attempt
+        writer.close()
+
+    received = writer.offset
+    if received != object_size or not writer.verified():
+        print(f"Received object of size: {received} saved to {filename} but it failed verification")
+        return False, wire_bytes, writer.delivered()
+    how = ""
+    if delta:
+        how = " (rebuilt from a delta)"
+    elif offset:
+        how = f" (resumed at {offset})"
+    print(f"Received object of size: {received}{how}, saved to {filename} and verified")
+    return True, wire_bytes, writer.delivered()
+
+def serve_connection(conn, addr, received_dir, progress, metrics):
+    # Receives the pipelined objects of one client connection until its END frame,
+    # the counters and object times go to the metrics shared by all connections.
+    # progress counts the objects received and the connections still open,
+    # a connection that closes or breaks before its END frame counts as dropped.
+    buffer = bytearray(RECEIVE_CHUNK_SIZE) # reused for every object of the connection
+    verified = 0
+    payload_bytes = 0
+    wire_bytes = 0
+    ended = False
+    with conn:
+        print(f"Connected by {addr}")
+        metrics.count('connections')
+        while True:
+            try:
+                frame = receive_frame_header(conn)
+                if frame is None:
+                    # the client closes first, so the TIME_WAIT state stays on its side
+                    if not ended:
+                        print(f"Connection from {addr} closed before the end of transmission.")
+                    break
+                frame_type, codec, object_size, offset, name, digest = frame
+                wire_bytes += FRAME_HEADER_SIZE + len(name.encode())
+                filename = f"{received_dir}/received_{os.path.basename(name)}"
+                if frame_type == FRAME_RESUME:
+                    # tell the client how much of this object we already have
+                    offset = min(read_journal(filename, digest.hex()), object_size)
+                    conn.sendall(pack_frame_header(FRAME_RESUME, object_size, offset=offset))
+                    continue
+                if frame_type == FRAME_SIGNATURE:
+                    # the block signature of our copy of the object, if we have one
+                    signature = file_signature(filename)
+                    if signature is None:
+                        conn.sendall(pack_frame_header(FRAME_SIGNATURE))
+                    else:
+                        basis_digest, entries = signature
+                        conn.sendall(pack_frame_header(FRAME_SIGNATURE, len(entries), digest=basis_digest) + entries)
+                    continue
+                if frame_type == FRAME_HELLO:
+                    # accept the codec if we know it, 0 tells the client to send uncompressed
+                    accepted = codec if codec in CODEC_NAMES else 0
+                    conn.sendall(pack_frame_header(FRAME_HELLO, codec=accepted))
+                    continue
+                if frame_type == FRAME_END:
+                    # Send one acknowledgment for everything received on this connection
+                    conn.sendall(pack_frame_header(FRAME_ACK, verified))
+                    print(f"End of transmission from {addr}, {verified} objects verified.")
+                    print(f"Payload bytes: {payload_bytes}, wire bytes: {wire_bytes}")
+                    record_tcp_info(metrics, conn)
+                    ended = True
+                    continue
+                if frame_type not in (FRAME_OBJECT, FRAME_DELTA):
+                    raise ProtocolError(f"unexpected frame type {frame_type}")
+                if codec and codec not in CODEC_NAMES:
+                    raise ProtocolError(f"unknown codec {codec}")
+                started = time.time()
+                ok, object_wire_bytes, object_payload_bytes = receive_object(conn, filename, object_size, digest, buffer, CODEC_NAMES.get(codec), offset,
+                                                       frame_type == FRAME_DELTA)
+                if ok:
+                    verified += 1
+                payload_bytes += object_payload_bytes
+                wire_bytes += object_wire_bytes
+                metrics.count('objects_verified' if ok else 'objects_failed')
+                metrics.count('payload_bytes', object_payload_bytes)
+                metrics.count('wire_bytes', FRAME_HEADER_SIZE + len(name.encode()) + object_wire_bytes)
+                metrics.object_done(os.path.basename(name), object_payload_bytes, time.time() - started, ok)
+            except (ProtocolError, OSError, ValueError, zlib.error, lzma.LZMAError) as e:
+                # a broken compressed chunk or delta stream is as fatal as a broken frame
+                print(f"Error receiving object: {e}")
+                break
+            with progress['lock']:
+                progress['received'] += 1
+                progress['failed'] += not ok
+    with progress['lock']:
+        progress['active'] -= 1
+        progress['dropped'] += not ended
+
+def finished(progress):
+    # every connection has ended, and either all objects arrived or a
+    # connection was dropped (its objects will not come any more)
+    with progress['lock']:
+        return not progress['active'] and (progress['received'] >= OBJECT_COUNT or progress['dropped'] > 0)
+
+def start_server(host="server", port=8000, received_dir="./received", metrics_path=None, metrics_format="json"):
+    # metrics_path is the file the metrics of the run are appended to once
+    # every object arrived, as JSON lines or a Prometheus text dump (see metrics.py)
+    # host = "127.0.0.1"
 
     # Create a directory to save received files
-    received_dir = "./received"
     if not os.path.exists(received_dir):
         os.makedirs(received_dir)
 
+    # shared between the connection threads: objects received (failed ones
+    # included), connections still open and connections dropped before their END frame
+    progress = {'received': 0, 'failed': 0, 'active': 0, 'dropped': 0, 'lock': threading.Lock()}
+    metrics = Metrics(transport="tcp", role="server")
+    threads = []
+
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.bind((HOST, PORT)) # Bind the socket to the address and port
+        s.bind((host, port)) # Bind the socket to the address and port
         s.listen() # Listen for incoming connections
-        print(f"Server listening on {HOST}:{PORT}")
-
-        conn, addr = s.accept() # Accept a new connection
-        with conn:
-            print(f"Connected by {addr}")
-            for i in range(10):  # Expecting 10 small and 10 large objects
-                # Receive and save small objects
-                if not receive_object(conn, f"{received_dir}/received_small-{i}.obj"):
-                    break # Break if an error occurs
-                # Receive and save large objects
-                if not receive_object(conn, f"{received_dir}/received_large-{i}.obj"):
-                    break # Break if an error occurs
-            print("Server has finished receiving files.")
+        s.settimeout(0.5) # wake up regularly to check whether the transfer is over
+        print(f"Server listening on {host}:{port}")
+
+        # Every connection is served by its own thread, the client may open several.
+        # The check only runs once no connection waited for half a second, so a
+        # connection of the client that is not accepted yet is not missed.
+        while True:
+            try:
+                conn, addr = s.accept() # Accept a new connection
+            except socket.timeout:
+                if finished(progress):
+                    break
+                continue
+            with progress['lock']:
+                progress['active'] += 1
+            thread = threading.Thread(target=serve_connection, args=(conn, addr, received_dir, progress, metrics))
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+        received = progress['received']
+        missing = max(0, OBJECT_COUNT - received)
+        print(f"Server has finished receiving files: {received - progress['failed']} of {OBJECT_COUNT} objects verified, "
+              f"{progress['failed']} failed, {missing} missing, {progress['dropped']} connection(s) dropped.")
+        metrics.count('objects_missing', missing)
+        metrics.count('connections_dropped', progress['dropped'])
+        if metrics_path:
+            metrics.export(metrics_path, metrics_format)
 
 if __name__ == "__main__":
-    start_server()
+    parser = argparse.ArgumentParser(description="TCP server")
+    parser.add_argument("--host", default="server", help="address to listen on (default: the docker compose host name)")
+    parser.add_argument("--port", type=int, default=8000, help="port to listen on")
+    parser.add_argument("--output", default="./received", help="directory the received objects are written to")
+    parser.add_argument("--metrics", metavar="FILE", help="append the metrics of the run to this file")
+    parser.add_argument("--metrics-format", choices=EXPORT_FORMATS, default="json", help="JSON lines or Prometheus text")
+    args = parser.parse_args()
+    start_server(args.host, args.port, args.output, args.metrics, args.metrics_format)
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# the modules under test live next to this directory (TCP part and shared
+# modules) and in udp-part, which is not a package
+CODE_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [CODE_DIRECTORY, os.path.join(CODE_DIRECTORY, "udp-part")]
@@ -0,0 +1,43 @@
+import socket
+import pytest
+from batch_io import BatchSender, BatchReceiver, HAVE_MMSG
+
+PATHS = [False, pytest.param(True, marks=pytest.mark.skipif(not HAVE_MMSG, reason="no sendmmsg/recvmmsg"))]
+
+
+@pytest.fixture
+def sockets():
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sender.setblocking(False)
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(("127.0.0.1", 0))
+    receiver.setblocking(False)
+    yield sender, receiver
+    sender.close()
+    receiver.close()
+
+
+@pytest.mark.parametrize("use_mmsg", PATHS)
+def test_batch_round_trip(sockets, use_mmsg):
+    sender, receiver = sockets
+    batch_sender = BatchSender(sender, use_mmsg=use_mmsg)
+    for i in range(10):
+        batch_sender.add(bytes([i]) * 100, receiver.getsockname())
+    assert batch_sender.flush() == 10
+    received = BatchReceiver(receiver, use_mmsg=use_mmsg).receive(block=True)
+    assert [bytes(view) for view, _ in received] == [bytes([i]) * 100 for i in range(10)]
+    assert received[0][1] == ("127.0.0.1", sender.getsockname()[1])
+
+
+@pytest.mark.parametrize("use_mmsg", PATHS)
+def test_failing_datagram_is_skipped(sockets, use_mmsg):
+    # a datagram the kernel refuses (EMSGSIZE) must not take the rest of the batch with it
+    sender, receiver = sockets
+    batch_sender = BatchSender(sender, use_mmsg=use_mmsg)
+    batch_sender.add(b"first", receiver.getsockname())
+    batch_sender.add(bytearray(66000), receiver.getsockname())
+    batch_sender.add(b"last", receiver.getsockname())
+    assert batch_sender.flush() == 2
+    assert batch_sender.dropped == 1
+    received = BatchReceiver(receiver, use_mmsg=use_mmsg).receive(block=True)
+    assert [bytes(view) for view, _ in received] == [b"first", b"last"]
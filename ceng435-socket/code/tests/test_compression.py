@@ -0,0 +1,67 @@
+import os
+import socket
+import threading
+import pytest
+from compression import CODECS, CODEC_IDS, compress, decompress, shrinks
+from metrics import Metrics
+from packet import FLAG_COMPRESSED, FLAG_LAST_SEGMENT, SEGMENT_HEADER_SIZE
+from tcp_client import negotiate_codec
+from tcp_protocol import pack_frame_header, receive_frame_header, FRAME_HELLO
+from tcp_server import serve_connection
+from udp_client import create_segment_for_file
+from udp_server import open_flow
+
+TEXT = b"the quick brown fox jumps over the lazy dog " * 200
+
+
+@pytest.mark.parametrize("codec", sorted(CODECS))
+def test_round_trip(codec):
+    packed = compress(codec, TEXT)
+    assert shrinks(len(TEXT), len(packed))
+    assert decompress(codec, packed) == TEXT
+
+
+def test_random_data_does_not_shrink():
+    data = os.urandom(4096)
+    assert not shrinks(len(data), len(compress("zlib", data)))
+
+
+def test_segments_are_only_compressed_while_it_pays(tmp_path):
+    path = tmp_path / "small-0.obj"
+    path.write_bytes(TEXT + os.urandom(2000))
+    text_segments = list(create_segment_for_file(str(path), 1000, 0, "zlib"))
+    assert text_segments[0][2] & FLAG_COMPRESSED
+    assert text_segments[-1][2] & FLAG_LAST_SEGMENT
+    assert b"".join(decompress("zlib", bytes(buffer)[SEGMENT_HEADER_SIZE:]) if flags & FLAG_COMPRESSED
+                    else bytes(buffer)[SEGMENT_HEADER_SIZE:] for _, buffer, flags in text_segments) == path.read_bytes()
+    random_path = tmp_path / "large-0.obj"
+    random_path.write_bytes(os.urandom(3000))
+    assert not any(flags & FLAG_COMPRESSED for _, _, flags in create_segment_for_file(str(random_path), 1000, 1, "zlib"))
+
+
+@pytest.mark.parametrize("asked, accepted", [("zlib", "zlib"), ("lzma", "lzma"), ("brotli", None), (None, None)])
+def test_udp_negotiation(tmp_path, asked, accepted):
+    options = {"mode": "SR"}
+    if asked:
+        options["compress"] = asked
+    flow = open_flow(("127.0.0.1", 1), 0x1234, options, str(tmp_path))
+    try:
+        assert flow.codec == accepted
+        assert flow.options.get("compress") == accepted
+    finally:
+        flow.close()
+
+
+def test_tcp_negotiation(tmp_path):
+    client, server = socket.socketpair()
+    progress = {'received': 0, 'failed': 0, 'active': 1, 'dropped': 0, 'lock': threading.Lock()}
+    thread = threading.Thread(target=serve_connection, args=(server, "test", str(tmp_path), progress, Metrics()))
+    thread.start()
+    with client:
+        assert negotiate_codec(client, "zlib") == "zlib"
+        assert negotiate_codec(client, "lzma") == "lzma"
+        # a codec the server does not know is answered with 0: send uncompressed
+        client.sendall(pack_frame_header(FRAME_HELLO, codec=max(CODEC_IDS.values()) + 1))
+        assert receive_frame_header(client)[1] == 0
+    thread.join(timeout=5)
+    assert progress['active'] == 0
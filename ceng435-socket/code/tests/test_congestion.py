@@ -0,0 +1,63 @@
+import pytest
+from congestion import CongestionController
+
+
+def test_slow_start_adds_a_segment_per_ack():
+    congestion = CongestionController(initial_window=2, max_window=256)
+    congestion.on_ack(3)
+    assert congestion.cwnd == 5
+
+
+def test_congestion_avoidance_adds_a_segment_per_window():
+    congestion = CongestionController(initial_window=2, max_window=256)
+    congestion.ssthresh = 10
+    congestion.cwnd = 10.0
+    congestion.on_ack(10)
+    assert congestion.cwnd == pytest.approx(11, abs=0.05)
+
+
+def test_window_is_capped():
+    congestion = CongestionController(initial_window=2, max_window=8)
+    congestion.on_ack(100)
+    assert congestion.cwnd == 8
+
+
+def test_fast_retransmit_halves_the_window():
+    congestion = CongestionController(initial_window=2, max_window=256)
+    congestion.cwnd = 20.0
+    congestion.on_fast_retransmit()
+    assert congestion.ssthresh == 10
+    assert congestion.cwnd == 10
+
+
+def test_timeout_goes_back_to_the_initial_window():
+    congestion = CongestionController(initial_window=2, max_window=256)
+    congestion.cwnd = 20.0
+    congestion.on_timeout()
+    assert congestion.ssthresh == 10
+    assert congestion.cwnd == 2
+    # slow start again up to ssthresh
+    congestion.on_ack(8)
+    assert congestion.cwnd == 10
+
+
+def test_ssthresh_never_drops_below_two():
+    congestion = CongestionController(initial_window=2, max_window=256)
+    congestion.on_timeout()
+    assert congestion.ssthresh == 2
+
+
+def test_advertised_window_limits_the_window():
+    congestion = CongestionController(initial_window=2, max_window=256)
+    congestion.cwnd = 50.0
+    assert congestion.window(16) == 16
+    assert congestion.window(0) == 1  # a zero window still lets one probe out
+
+
+def test_history_only_when_asked_for():
+    assert CongestionController().history is None
+    congestion = CongestionController(initial_window=2, record_history=True)
+    congestion.on_ack(2)
+    congestion.on_timeout()
+    assert [cwnd for _, cwnd in congestion.history] == [2, 4, 2]
+    assert congestion.max_cwnd == 4
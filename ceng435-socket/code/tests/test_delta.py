@@ -0,0 +1,103 @@
+import hashlib
+import os
+import random
+import socket
+import pytest
+from delta import (file_signature, compute_delta, DeltaWriter, SIGNATURE_ENTRY, COPY_INSTRUCTION, DATA_INSTRUCTION,
+                   DELTA_COPY, DELTA_DATA, DELTA_SUFFIX)
+from tcp_protocol import pack_chunk, CHUNK_HEADER
+from tcp_server import receive_object
+
+BLOCK = 1024
+
+
+def rebuild(tmp_path, basis, new, piece_size=None):
+    # the delta of new against basis, applied to basis; returns (verified, rebuilt file, delta stream)
+    basis_path, new_path = tmp_path / "basis.obj", tmp_path / "new.obj"
+    basis_path.write_bytes(basis)
+    new_path.write_bytes(new)
+    _, entries = file_signature(str(basis_path), BLOCK)
+    stream = b"".join(compute_delta(str(new_path), entries, BLOCK))
+    writer = DeltaWriter(str(basis_path), hashlib.md5(new).hexdigest(), BLOCK)
+    piece_size = piece_size or len(stream)
+    for start in range(0, len(stream), piece_size):
+        writer.write(stream[start:start + piece_size])
+    return writer.verified(), basis_path.read_bytes(), stream
+
+
+def literal_bytes(stream):
+    # literal data carried by a delta stream
+    total, position = 0, 0
+    while stream[position] in (DELTA_COPY, DELTA_DATA):
+        if stream[position] == DELTA_COPY:
+            position += COPY_INSTRUCTION.size
+        else:
+            length = DATA_INSTRUCTION.unpack_from(stream, position)[1]
+            total += length
+            position += DATA_INSTRUCTION.size + length
+    return total
+
+
+def test_signature_covers_whole_blocks(tmp_path):
+    path = tmp_path / "basis.obj"
+    data = os.urandom(3 * BLOCK + 100)
+    path.write_bytes(data)
+    digest, entries = file_signature(str(path), BLOCK)
+    assert digest == hashlib.md5(data).digest()
+    assert len(entries) == 3 * SIGNATURE_ENTRY.size
+    assert file_signature(str(tmp_path / "missing.obj")) is None
+
+
+def test_unchanged_file_is_all_copies(tmp_path):
+    data = os.urandom(8 * BLOCK)
+    ok, rebuilt, stream = rebuild(tmp_path, data, data)
+    assert ok and rebuilt == data
+    assert literal_bytes(stream) == 0
+    assert len(stream) == COPY_INSTRUCTION.size + 1  # consecutive blocks are one instruction
+
+
+def test_insertion_only_sends_what_changed(tmp_path):
+    basis = os.urandom(16 * BLOCK)
+    new = basis[:5 * BLOCK + 17] + b"inserted bytes" + basis[5 * BLOCK + 17:]
+    ok, rebuilt, stream = rebuild(tmp_path, basis, new)
+    assert ok and rebuilt == new
+    # the rolling checksum finds the blocks after the insertion again
+    assert literal_bytes(stream) < 2 * BLOCK
+
+
+@pytest.mark.parametrize("piece_size", [1, 7, 1000])
+def test_stream_may_arrive_in_any_pieces(tmp_path, piece_size):
+    rng = random.Random(1)
+    basis = bytes(rng.getrandbits(8) for _ in range(6 * BLOCK))
+    new = basis[BLOCK:3 * BLOCK] + bytes(rng.getrandbits(8) for _ in range(500)) + basis[:BLOCK]
+    ok, rebuilt, _ = rebuild(tmp_path, basis, new, piece_size)
+    assert ok and rebuilt == new
+
+
+def test_broken_delta_keeps_the_basis(tmp_path):
+    basis_path = tmp_path / "basis.obj"
+    basis = os.urandom(4 * BLOCK)
+    basis_path.write_bytes(basis)
+    writer = DeltaWriter(str(basis_path), hashlib.md5(b"something else").hexdigest(), BLOCK)
+    writer.write(COPY_INSTRUCTION.pack(DELTA_COPY, 0, 2) + b"\0")
+    assert not writer.verified()
+    assert basis_path.read_bytes() == basis
+    assert not os.path.exists(str(basis_path) + DELTA_SUFFIX)
+
+
+def test_tcp_server_counts_the_literal_bytes_of_a_delta(tmp_path):
+    basis = os.urandom(16 * BLOCK)
+    new = basis[:3 * BLOCK] + os.urandom(700) + basis[3 * BLOCK:]
+    path, new_path = tmp_path / "received_large-0.obj", tmp_path / "large-0.obj"
+    path.write_bytes(basis)
+    new_path.write_bytes(new)
+    _, entries = file_signature(str(path))
+    stream = b"".join(compute_delta(str(new_path), entries))
+    client, server = socket.socketpair()
+    with client, server:
+        client.sendall(pack_chunk(stream) + pack_chunk(b""))
+        ok, wire_bytes, payload_bytes = receive_object(server, str(path), len(new), hashlib.md5(new).digest(),
+                                                       bytearray(4096), delta=True)
+    assert ok and path.read_bytes() == new
+    assert wire_bytes == len(stream) + 2 * CHUNK_HEADER.size
+    assert 700 <= payload_bytes == literal_bytes(stream) < len(new)
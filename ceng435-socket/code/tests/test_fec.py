@@ -0,0 +1,87 @@
+import pytest
+from fec import FECEncoder, FECDecoder, XorAccumulator, parse_fec
+from packet import pack_segment
+
+SESSION_ID = 0x01020304
+
+
+def segments(count):
+    # data segments of different lengths, as the sender encodes them
+    return [bytes(pack_segment(SESSION_ID, 0, seq, 0, bytes([seq % 251]) * (100 + 37 * seq))) for seq in range(count)]
+
+
+def encode(datagrams, block_size, parity_count):
+    encoder = FECEncoder(SESSION_ID, block_size, parity_count)
+    parity = []
+    for seq, datagram in enumerate(datagrams):
+        parity += encoder.add(seq, datagram)
+    return parity + encoder.finish()
+
+
+@pytest.mark.parametrize("lost", [0, 3, 7])
+def test_single_loss_is_rebuilt(lost):
+    datagrams = segments(8)
+    parity = encode(datagrams, 8, 1)
+    decoder = FECDecoder(8, 1)
+    rebuilt = []
+    for seq, datagram in enumerate(datagrams):
+        if seq != lost:
+            rebuilt += decoder.add_data(seq, datagram)
+    for datagram in parity:
+        rebuilt += decoder.add_parity(memoryview(datagram))
+    assert rebuilt == [datagrams[lost]]
+    assert decoder.recovered == 1
+
+
+def test_burst_up_to_m_losses_is_rebuilt():
+    datagrams = segments(8)
+    parity = encode(datagrams, 8, 2)
+    decoder = FECDecoder(8, 2)
+    rebuilt = []
+    for datagram in parity:
+        rebuilt += decoder.add_parity(memoryview(datagram))  # parity first, the data completes the stripes
+    for seq, datagram in enumerate(datagrams):
+        if seq not in (4, 5):
+            rebuilt += decoder.add_data(seq, datagram)
+    assert sorted(rebuilt) == sorted([datagrams[4], datagrams[5]])
+
+
+def test_two_losses_in_a_stripe_are_not_rebuilt():
+    datagrams = segments(8)
+    decoder = FECDecoder(8, 1)
+    rebuilt = []
+    for seq, datagram in enumerate(datagrams):
+        if seq not in (1, 2):
+            rebuilt += decoder.add_data(seq, datagram)
+    for datagram in encode(datagrams, 8, 1):
+        rebuilt += decoder.add_parity(memoryview(datagram))
+    assert rebuilt == []
+
+
+def test_short_last_block():
+    datagrams = segments(11)
+    parity = encode(datagrams, 8, 1)
+    assert len(parity) == 2
+    decoder = FECDecoder(8, 1)
+    rebuilt = []
+    for seq, datagram in enumerate(datagrams):
+        if seq != 10:
+            rebuilt += decoder.add_data(seq, datagram)
+    for datagram in parity:
+        rebuilt += decoder.add_parity(memoryview(datagram))
+    assert rebuilt == [datagrams[10]]
+
+
+def test_xor_accumulator_pads_with_zeros():
+    accumulator = XorAccumulator()
+    accumulator.add(b"\x0f\x0f\x0f")
+    accumulator.add(b"\xff")
+    assert accumulator.to_bytes(4) == b"\xf0\x0f\x0f\x00"
+    assert accumulator.length_xor == 3 ^ 1
+
+
+def test_parse_fec():
+    assert parse_fec("8,2") == (8, 2)
+    for text in ("8", "2,8", "0,0", "300,1", "a,b"):
+        with pytest.raises(ValueError):
+            parse_fec(text)
@@ -0,0 +1,102 @@
+import hashlib
+import os
+import socket
+import threading
+import journal
+from journal import ObjectWriter, read_journal, write_journal, journal_path
+
+DATA = os.urandom(100 * 1024)
+DIGEST = hashlib.md5(DATA).hexdigest()
+
+
+def test_interrupted_object_is_journaled_at_its_exact_offset(tmp_path):
+    path = str(tmp_path / "large-0.obj")
+    writer = ObjectWriter(path, DIGEST)
+    writer.write(DATA[:12345])
+    writer.close()
+    assert read_journal(path, DIGEST) == 12345
+    assert os.path.getsize(path) == 12345
+
+
+def test_resume_continues_and_verifies(tmp_path):
+    path = str(tmp_path / "large-0.obj")
+    writer = ObjectWriter(path, DIGEST)
+    writer.write(DATA[:40000])
+    writer.close()
+    offset = read_journal(path, DIGEST)
+    writer = ObjectWriter(path, DIGEST, offset)
+    writer.write(DATA[offset:])
+    assert writer.verified()
+    assert open(path, 'rb').read() == DATA
+    assert read_journal(path, DIGEST) == len(DATA)  # a finished object keeps its journal
+
+
+def test_checkpoints_while_writing(tmp_path, monkeypatch):
+    monkeypatch.setattr(journal, "JOURNAL_INTERVAL", 1000)
+    path = str(tmp_path / "large-0.obj")
+    writer = ObjectWriter(path, DIGEST)
+    for start in range(0, 3500, 500):
+        writer.write(DATA[start:start + 500])
+    # without a close (a crash) the journal has the last checkpoint
+    assert read_journal(path, DIGEST) == 3000
+    writer.close()
+
+
+def test_journal_of_another_object_is_ignored(tmp_path):
+    path = str(tmp_path / "large-0.obj")
+    writer = ObjectWriter(path, DIGEST)
+    writer.write(DATA[:1000])
+    writer.close()
+    assert read_journal(path, hashlib.md5(b"other").hexdigest()) == 0
+
+
+def test_offset_never_goes_past_the_file(tmp_path):
+    path = str(tmp_path / "large-0.obj")
+    open(path, 'wb').write(DATA[:500])
+    write_journal(path, DIGEST, 5000)
+    assert read_journal(path, DIGEST) == 500
+
+
+def test_failed_verification_drops_the_journal(tmp_path):
+    path = str(tmp_path / "large-0.obj")
+    writer = ObjectWriter(path, DIGEST)
+    writer.write(DATA[:-1] + b"x")
+    assert not writer.verified()
+    assert not os.path.exists(journal_path(path))
+    assert read_journal(path, DIGEST) == 0
+
+
+def test_udp_server_finds_the_resumable_files(tmp_path, monkeypatch):
+    import udp_server
+    # the expected checksums come from the .md5 files of the objects
+    monkeypatch.setattr(udp_server, "expected_checksum", lambda file_type, file_number: DIGEST)
+    path = str(tmp_path / "small-3.obj")
+    writer = ObjectWriter(path, DIGEST)
+    writer.write(DATA[:777])
+    writer.close()
+    assert udp_server.resumable_offsets(str(tmp_path)) == {udp_server.file_id_of("small-3.obj"): 777}
+
+
+def receive_over_socketpair(path, data, offset):
+    # the TCP server receiving data (the part of the object after offset) from a client
+    from tcp_server import receive_object
+    client, server = socket.socketpair()
+    sender = threading.Thread(target=client.sendall, args=(data,))
+    sender.start()
+    try:
+        return receive_object(server, path, len(DATA), bytes.fromhex(DIGEST), bytearray(4096), offset=offset)
+    finally:
+        sender.join()
+        client.close()
+        server.close()
+
+
+def test_tcp_server_counts_only_the_resumed_part(tmp_path):
+    path = str(tmp_path / "received_large-0.obj")
+    writer = ObjectWriter(path, DIGEST)
+    writer.write(DATA[:40000])
+    writer.close()
+    assert receive_over_socketpair(path, DATA[40000:], 40000) == (True, len(DATA) - 40000, len(DATA) - 40000)
+    # the object is complete now, a second resume gets no data at all
+    assert receive_over_socketpair(path, b"", len(DATA)) == (True, 0, 0)
+    assert open(path, 'rb').read() == DATA
@@ -0,0 +1,116 @@
+from packet import (pack_segment, pack_segment_into, finish_segment, unpack_segment, pack_ack_into, unpack_ack,
+                    pack_control_into, unpack_control, pack_parity, unpack_parity, unpack_prefix, encode_options,
+                    decode_options, TYPE_DATA, TYPE_ACK, TYPE_SYN, TYPE_PARITY, FLAG_LAST_SEGMENT, FLAG_COMPRESSED,
+                    SEGMENT_HEADER_SIZE, ACK_SIZE, MAX_CONTROL_PAYLOAD, SACK_BITS, sack_bitmap, sacked_sequence_numbers)
+from common import RECEIVE_WINDOW
+
+SESSION_ID = 0xdeadbeef
+
+
+def test_segment_round_trip():
+    segment = pack_segment(SESSION_ID, 7, 123456, FLAG_LAST_SEGMENT | FLAG_COMPRESSED, b"payload")
+    view = memoryview(segment)
+    assert unpack_prefix(view) == (TYPE_DATA, SESSION_ID)
+    file_id, sequence_number, flags, payload = unpack_segment(view)
+    assert (file_id, sequence_number, flags, bytes(payload)) == (7, 123456, FLAG_LAST_SEGMENT | FLAG_COMPRESSED, b"payload")
+
+
+def test_empty_segment_round_trip():
+    segment = pack_segment(SESSION_ID, 0, 0, FLAG_LAST_SEGMENT, b"")
+    assert len(segment) == SEGMENT_HEADER_SIZE
+    assert bytes(unpack_segment(memoryview(segment))[3]) == b""
+
+
+def test_pack_segment_into_offset():
+    buffer = bytearray(100)
+    written = pack_segment_into(buffer, SESSION_ID, 1, 2, 0, b"abc", offset=10)
+    assert written == SEGMENT_HEADER_SIZE + 3
+    assert pack_segment(SESSION_ID, 1, 2, 0, b"abc") == buffer[10:10 + written]
+
+
+def test_finish_segment_matches_pack_segment():
+    # the client reads the payload straight behind the header space
+    buffer = bytearray(SEGMENT_HEADER_SIZE) + b"data"
+    assert finish_segment(buffer, SESSION_ID, 3, 9, 0) == pack_segment(SESSION_ID, 3, 9, 0, b"data")
+
+
+def test_segment_length_mismatch():
+    segment = pack_segment(SESSION_ID, 1, 1, 0, b"abcdef")
+    assert unpack_segment(memoryview(segment)[:-1]) is None
+    assert unpack_segment(memoryview(segment)[:SEGMENT_HEADER_SIZE - 1]) is None
+
+
+def test_ack_round_trip():
+    buffer = bytearray(ACK_SIZE)
+    assert pack_ack_into(buffer, SESSION_ID, 42, 0b1011, 128) == ACK_SIZE
+    view = memoryview(buffer)
+    assert unpack_prefix(view) == (TYPE_ACK, SESSION_ID)
+    assert unpack_ack(view) == (42, 0b1011, 128)
+    assert unpack_ack(view[:-1]) is None
+
+
+def test_control_round_trip():
+    buffer = bytearray(MAX_CONTROL_PAYLOAD + 64)
+    length = pack_control_into(buffer, TYPE_SYN, SESSION_ID, b"mode=SR")
+    view = memoryview(buffer)[:length]
+    assert unpack_prefix(view) == (TYPE_SYN, SESSION_ID)
+    assert bytes(unpack_control(view)) == b"mode=SR"
+
+
+def test_parity_round_trip():
+    parity = pack_parity(SESSION_ID, 100, 8, 2, 1, 0x1234, b"\x01\x02")
+    view = memoryview(parity)
+    assert unpack_prefix(view) == (TYPE_PARITY, SESSION_ID)
+    first_seq, block_size, parity_count, index, length_xor, data = unpack_parity(view)
+    assert (first_seq, block_size, parity_count, index, length_xor, bytes(data)) == (100, 8, 2, 1, 0x1234, b"\x01\x02")
+
+
+def test_options_round_trip():
+    options = {"mode": "SR", "segment": "1454", "fec": "8,1"}
+    assert decode_options(encode_options(options)) == options
+    assert decode_options(b"mode=GBN;garbage;x=") == {"mode": "GBN", "x": ""}
+
+
+def test_corrupt_payload_is_rejected():
+    segment = pack_segment(SESSION_ID, 1, 1, 0, b"some payload")
+    for position in (0, 5, SEGMENT_HEADER_SIZE - 1, len(segment) - 1):
+        damaged = bytearray(segment)
+        damaged[position] ^= 0x10
+        assert unpack_prefix(memoryview(damaged)) is None, position
+
+
+def test_corrupt_ack_is_rejected():
+    buffer = bytearray(ACK_SIZE)
+    pack_ack_into(buffer, SESSION_ID, 42, 0, 128)
+    buffer[9] ^= 0x01
+    assert unpack_prefix(memoryview(buffer)) is None
+
+
+def test_truncated_or_unknown_datagrams_are_rejected():
+    segment = pack_segment(SESSION_ID, 1, 1, 0, b"x")
+    assert unpack_prefix(memoryview(segment)[:3]) is None
+    assert unpack_prefix(memoryview(segment)[:SEGMENT_HEADER_SIZE - 1]) is None
+    unknown = bytearray(segment)
+    unknown[0] = 0xff
+    assert unpack_prefix(memoryview(unknown)) is None
+
+
+def test_sack_bitmap_round_trip():
+    buffered = {11, 12, 15, 40}
+    bitmap = sack_bitmap(10, buffered)
+    assert bitmap == 0b1 | 0b10 | 0b10000 | 1 << 29
+    assert list(sacked_sequence_numbers(10, bitmap)) == sorted(buffered)
+
+
+def test_sack_bitmap_covers_the_receive_window():
+    # everything the receiver may buffer past the cumulative ACK is reported
+    buffered = set(range(101, 100 + RECEIVE_WINDOW))
+    bitmap = sack_bitmap(100, buffered)
+    buffer = bytearray(ACK_SIZE)
+    pack_ack_into(buffer, SESSION_ID, 100, bitmap, 0)
+    _, decoded, _ = unpack_ack(memoryview(buffer))
+    assert set(sacked_sequence_numbers(100, decoded)) == buffered
+
+
+def test_sack_bitmap_ignores_what_is_outside():
+    assert sack_bitmap(10, {5, 10, 11 + SACK_BITS}) == 0
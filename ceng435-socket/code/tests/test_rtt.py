@@ -0,0 +1,86 @@
+import socket
+import threading
+import pytest
+from rtt import RTTEstimator
+from packet import pack_control_into, CONTROL_HEADER_SIZE, TYPE_SYN, TYPE_SYNACK
+from udp_client import exchange_control
+
+
+def test_initial_rto():
+    assert RTTEstimator(initial_rto=0.5).rto == 0.5
+
+
+def test_first_sample():
+    estimator = RTTEstimator(min_rto=0.0, max_ack_delay=0.0)
+    estimator.sample(0.1)
+    assert estimator.srtt == pytest.approx(0.1)
+    assert estimator.rttvar == pytest.approx(0.05)
+    assert estimator.rto == pytest.approx(0.1 + 4 * 0.05)
+
+
+def test_later_samples_are_smoothed():
+    estimator = RTTEstimator(min_rto=0.0, max_ack_delay=0.0)
+    estimator.sample(0.1)
+    estimator.sample(0.2)
+    # RFC 6298: RTTVAR is updated with the old SRTT
+    assert estimator.rttvar == pytest.approx(0.75 * 0.05 + 0.25 * 0.1)
+    assert estimator.srtt == pytest.approx(0.875 * 0.1 + 0.125 * 0.2)
+    assert estimator.rto == pytest.approx(estimator.srtt + 4 * estimator.rttvar)
+
+
+def test_max_ack_delay_is_added():
+    estimator = RTTEstimator(min_rto=0.0, max_ack_delay=0.005)
+    estimator.sample(0.1)
+    assert estimator.rto == pytest.approx(0.1 + 4 * 0.05 + 0.005)
+
+
+def test_rto_is_clamped():
+    estimator = RTTEstimator(min_rto=0.02, max_rto=1.0)
+    estimator.sample(0.0001)
+    assert estimator.rto == 0.02
+    estimator.sample(10.0)
+    assert estimator.rto == 1.0
+
+
+def test_backoff_doubles_until_max_and_a_sample_collapses_it():
+    estimator = RTTEstimator(initial_rto=0.5, max_rto=4.0, max_ack_delay=0.0)
+    estimator.backoff()
+    assert estimator.rto == 1.0
+    for _ in range(5):
+        estimator.backoff()
+    assert estimator.rto == 4.0
+    estimator.sample(0.1)
+    assert estimator.rto == pytest.approx(0.3)
+
+
+def answer_control(server_socket, ignore):
+    # Fake server: drops the first `ignore` SYNs and answers the next one with a SYNACK
+    for _ in range(ignore + 1):
+        _, client_address = server_socket.recvfrom(2048)
+    buffer = bytearray(CONTROL_HEADER_SIZE + 2)
+    pack_control_into(buffer, TYPE_SYNACK, 7, b"ok")
+    server_socket.sendto(buffer, client_address)
+
+
+@pytest.mark.parametrize("ignore", [0, 1])
+def test_karns_rule(ignore):
+    # only an answer to a packet that was sent once gives an RTT sample
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server_socket.bind(("127.0.0.1", 0))
+    client_socket.setblocking(False)
+    server = threading.Thread(target=answer_control, args=(server_socket, ignore))
+    server.start()
+    estimator = RTTEstimator(initial_rto=0.1, min_rto=0.01, max_ack_delay=0.0)
+    try:
+        reply = exchange_control(client_socket, server_socket.getsockname(), TYPE_SYN, 7, TYPE_SYNACK, estimator)
+    finally:
+        server.join()
+        server_socket.close()
+        client_socket.close()
+    assert reply == b"ok"
+    if ignore:
+        assert estimator.srtt is None
+        assert estimator.rto == pytest.approx(0.2)
+    else:
+        assert estimator.srtt is not None and estimator.srtt < 0.1
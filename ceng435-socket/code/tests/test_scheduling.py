@@ -0,0 +1,79 @@
+import pytest
+from scheduling import (Stream, schedule, object_order, object_class, parse_priorities, parse_weights, percentile,
+                        completion_report, SCHEDULERS)
+
+
+def streams(sizes, classes=None, priorities=None, weights=None):
+    # one stream per size, its segments are (object id, index) tuples
+    classes = classes or ["small"] * len(sizes)
+    return [Stream(i, iter([(i, n) for n in range(size)]), size, (priorities or {}).get(classes[i], 0),
+                   (weights or {}).get(classes[i], 1.0)) for i, size in enumerate(sizes)]
+
+
+def order(sizes, scheduler, **kwargs):
+    return [object_id for object_id, _ in schedule(streams(sizes, **kwargs), scheduler)]
+
+
+def test_round_robin():
+    assert order([3, 1, 2], "rr") == [0, 1, 2, 0, 2, 0]
+
+
+def test_shortest_remaining_first():
+    assert order([3, 1, 2], "srf") == [1, 2, 2, 0, 0, 0]
+
+
+def test_weighted_fair_queuing():
+    # object 0 has four times the weight, it gets four segments for every one of object 1
+    assert order([8, 2], "wfq", classes=["small", "large"], weights={"small": 4.0, "large": 1.0}) == [0, 0, 0, 0, 1, 0, 0, 0, 0, 1]
+
+
+def test_strict_priority():
+    assert order([2, 2, 2], "priority", classes=["large", "small", "small"],
+                 priorities={"small": 0, "large": 1}) == [1, 2, 1, 2, 0, 0]
+
+
+@pytest.mark.parametrize("scheduler", SCHEDULERS)
+def test_every_segment_once_and_in_order_per_object(scheduler):
+    segments = list(schedule(streams([5, 0, 3, 7]), scheduler))
+    assert sorted(segments) == [(i, n) for i, size in enumerate([5, 0, 3, 7]) for n in range(size)]
+    for object_id in range(4):
+        indexes = [n for i, n in segments if i == object_id]
+        assert indexes == sorted(indexes)
+
+
+@pytest.mark.parametrize("scheduler", SCHEDULERS)
+def test_subsets_keep_their_relative_order(scheduler):
+    # the pipeline readers each schedule a subset of the objects
+    sizes, classes = [4, 9, 2, 6, 3], ["small", "large", "small", "large", "small"]
+    options = dict(classes=classes, priorities={"small": 0, "large": 1}, weights={"small": 4.0, "large": 1.0})
+    whole = list(schedule(streams(sizes, **options), scheduler))
+    subset = [stream for stream in streams(sizes, **options) if stream.object_id % 2]
+    assert list(schedule(subset, scheduler)) == [segment for segment in whole if segment[0] % 2]
+
+
+def test_object_order():
+    sizes, classes = [300, 10, 200, 20], ["large", "small", "large", "small"]
+    objects = streams(sizes, classes, {"small": 0, "large": 1}, {"small": 4.0, "large": 1.0})
+    assert [s.object_id for s in object_order(objects, "rr")] == [0, 1, 2, 3]
+    assert [s.object_id for s in object_order(objects, "srf")] == [1, 3, 2, 0]
+    assert [s.object_id for s in object_order(objects, "wfq")] == [1, 3, 2, 0]
+    assert [s.object_id for s in object_order(objects, "priority")] == [1, 3, 0, 2]
+
+
+def test_classes():
+    assert object_class("../../objects/small-3.obj") == "small"
+    assert parse_priorities("small=0,large=2") == {"small": 0, "large": 2}
+    assert parse_weights("small=4,large=0.5") == {"small": 4.0, "large": 0.5}
+    for text in ("small", "small=x", "=1"):
+        with pytest.raises(ValueError):
+            parse_weights(text)
+    with pytest.raises(ValueError):
+        parse_weights("small=0")
+
+
+def test_completion_report():
+    assert percentile([1.0, 2.0, 3.0], 0.5) == 2.0
+    assert percentile([1.0, 2.0], 0.99) == pytest.approx(1.99)
+    assert completion_report([{"object": "small-0.obj"}]) is None
+    objects = [{"object": "small-0.obj", "completed_seconds": 1.0}, {"object": "large-0.obj", "completed_seconds": 3.0}]
+    assert completion_report(objects) == "p50 2.000 s, p99 2.980 s, large mean 3.000 s, small mean 1.000 s (2 objects)"
@@ -0,0 +1,69 @@
+import os
+import pytest
+import udp_server
+from common import SESSION_HANDOFF_IDLE
+from udp_server import open_flow, hand_over_flows, session_directory, LOCK_SUFFIX
+
+
+class FakeClock:
+    # stands in for the time module of udp_server, the test moves it forward
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(udp_server, "time", clock)
+    return clock
+
+
+def test_resumed_session_waits_for_the_other_worker(tmp_path, clock):
+    output_directory = str(tmp_path)
+    # a lock file left by an earlier run, so the touch below always changes its modification time
+    lock_path = session_directory(output_directory, 0x1111, {}) + LOCK_SUFFIX
+    open(lock_path, 'w').close()
+    os.utime(lock_path, (1, 1))
+    first = open_flow(("127.0.0.1", 5000), 0x1111, {"mode": "SR"}, output_directory)
+    other = open_flow(("127.0.0.1", 5001), 0x3333, {"mode": "SR"}, output_directory)
+    flows = {(first.address, first.session_id): first, (other.address, other.session_id): other}
+    assert not first.lock_requested()
+
+    # the client resumes on the other worker (a second open of the lock file is a second owner)
+    resume = {"mode": "SR", "resume": "00001111"}
+    assert open_flow(("127.0.0.1", 5002), 0x2222, resume, output_directory) is None
+    assert os.stat(lock_path).st_mtime > 1
+    assert first.lock_requested()
+
+    # a session that still got data recently is kept
+    clock.now += SESSION_HANDOFF_IDLE / 2
+    hand_over_flows(flows)
+    assert len(flows) == 2
+
+    # once idle it is handed over, the idle session nobody asked for stays
+    clock.now += SESSION_HANDOFF_IDLE
+    hand_over_flows(flows)
+    assert list(flows.values()) == [other]
+    assert first.lock is None
+
+    # the retransmitted SYN gets the directory now
+    resumed = open_flow(("127.0.0.1", 5002), 0x2222, resume, output_directory)
+    try:
+        assert resumed is not None
+        assert resumed.output_directory == first.output_directory
+        assert not resumed.lock_requested()
+    finally:
+        resumed.close()
+        other.close()
+
+
+def test_closed_flow_releases_its_directory(tmp_path, clock):
+    flow = open_flow(("127.0.0.1", 5000), 0x1111, {"mode": "GBN"}, str(tmp_path))
+    assert open_flow(("127.0.0.1", 5000), 0x1111, {"mode": "GBN"}, str(tmp_path)) is None
+    flow.close()
+    again = open_flow(("127.0.0.1", 5000), 0x1111, {"mode": "GBN"}, str(tmp_path))
+    assert again is not None
+    again.close()
@@ -0,0 +1,242 @@
+import ctypes
+import errno
+import os
+import socket
+import struct
+import sys
+import common  # puts the shared modules (metrics.py) on the path
+from metrics import logger
+
+# Batched datagram I/O.
+# On Linux a whole batch of datagrams is sent with one sendmmsg and received
+# with one recvmmsg system call through ctypes. Everywhere else (or when the
+# calls are missing from libc) the same interface falls back to one
+# sendto / recvfrom_into per datagram. Both paths only use preallocated buffers.
+
+BATCH_SIZE = 64
+
+MSG_DONTWAIT = 0x40
+MSG_WAITFORONE = 0x10000
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(iovec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", msghdr), ("msg_len", ctypes.c_uint)]
+
+
+# struct sockaddr_in is 16 bytes: family (host order), port, IPv4 address, padding
+SOCKADDR_IN_SIZE = 16
+sockaddr_in = ctypes.c_char * SOCKADDR_IN_SIZE
+
+
+def _load_libc():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+        libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+libc = _load_libc()
+HAVE_MMSG = libc is not None
+
+
+def _buffer_address(buffer):
+    # Address of a bytes-like object, the returned ctypes object keeps the buffer pinned
+    try:
+        pinned = (ctypes.c_char * len(buffer)).from_buffer(buffer)
+    except TypeError:
+        # read-only buffer (bytes), fall back to a copy
+        pinned = (ctypes.c_char * len(buffer)).from_buffer_copy(buffer)
+    return ctypes.addressof(pinned), pinned
+
+
+def _encode_sockaddr(address):
+    ip, port = address
+    return struct.pack("=H", socket.AF_INET) + struct.pack("!H", port) + socket.inet_aton(ip) + bytes(8)
+
+
+def _decode_sockaddr(raw):
+    port = struct.unpack_from("!H", raw, 2)[0]
+    return socket.inet_ntoa(raw[4:8]), port
+
+
+class BatchSender:
+    """
+    Queues datagrams and sends them in batches of up to batch_size.
+    add() takes an already encoded datagram, next_buffer() hands out one of
+    the preallocated slot buffers for datagrams that are built on the fly
+    (e.g. ACKs), a slot is valid until the next flush.
+    flush() returns the number of datagrams the kernel accepted, the rest
+    were dropped because the socket buffer was full (dropped counts them all).
+    """
+
+    def __init__(self, udp_socket, batch_size=BATCH_SIZE, slot_size=64, use_mmsg=HAVE_MMSG):
+        self.udp_socket = udp_socket
+        self.batch_size = batch_size
+        self.use_mmsg = use_mmsg
+        self.slots = [bytearray(slot_size) for _ in range(batch_size)]
+        self.next_slot = 0
+        self.queue = []  # (datagram, address)
+        self.dropped = 0  # datagrams not accepted by the kernel
+        self.sockaddrs = {}  # address -> encoded sockaddr_in
+        if use_mmsg:
+            self.iovecs = (iovec * batch_size)()
+            self.messages = (mmsghdr * batch_size)()
+
+    def next_buffer(self):
+        if self.next_slot == len(self.slots):
+            self.flush()
+        slot = self.slots[self.next_slot]
+        self.next_slot += 1
+        return slot
+
+    def add(self, datagram, address):
+        self.queue.append((datagram, address))
+        if len(self.queue) == self.batch_size:
+            self.flush()
+
+    def flush(self):
+        queue = self.queue
+        self.queue = []
+        self.next_slot = 0
+        if not queue:
+            return 0
+        if self.use_mmsg:
+            sent = self._flush_mmsg(queue)
+        else:
+            sent = self._flush_each(queue)
+        self.dropped += len(queue) - sent
+        return sent
+
+    def _flush_each(self, queue):
+        sent = 0
+        for datagram, address in queue:
+            try:
+                self.udp_socket.sendto(datagram, address)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                logger.warning("Error sending datagram: %s", e)
+                continue
+            sent += 1
+        return sent
+
+    def _flush_mmsg(self, queue):
+        pinned = []
+        for i, (datagram, address) in enumerate(queue):
+            base, keep = _buffer_address(datagram)
+            pinned.append(keep)
+            self.iovecs[i].iov_base = base
+            self.iovecs[i].iov_len = len(datagram)
+            if address not in self.sockaddrs:
+                self.sockaddrs[address] = sockaddr_in.from_buffer_copy(_encode_sockaddr(address))
+            header = self.messages[i].msg_hdr
+            header.msg_name = ctypes.addressof(self.sockaddrs[address])
+            header.msg_namelen = SOCKADDR_IN_SIZE
+            header.msg_iov = ctypes.pointer(self.iovecs[i])
+            header.msg_iovlen = 1
+        sent = 0
+        position = 0  # next message to hand to the kernel
+        while position < len(queue):
+            result = libc.sendmmsg(self.udp_socket.fileno(), ctypes.addressof(self.messages) + position * ctypes.sizeof(mmsghdr), len(queue) - position, MSG_DONTWAIT)
+            if result > 0:
+                sent += result
+                position += result
+                continue
+            error = ctypes.get_errno()
+            if result == 0 or error in (errno.EAGAIN, errno.EWOULDBLOCK):
+                # the socket buffer is full, the rest is dropped
+                break
+            if error == errno.EINTR:
+                continue
+            # sendmmsg stops at the first message that fails (EMSGSIZE,
+            # EHOSTUNREACH, ECONNREFUSED...), skip just that one like _flush_each
+            logger.warning("Error sending datagram: %s", os.strerror(error))
+            position += 1
+        return sent
+
+
+class BatchReceiver:
+    """
+    Receives up to batch_size datagrams per call into preallocated buffers.
+    receive() returns a list of (view, address) pairs, the views point into
+    the receiver's buffers and are only valid until the next call.
+    With block=True it waits for the first datagram, then takes whatever
+    else is already queued without blocking again.
+    """
+
+    def __init__(self, udp_socket, batch_size=BATCH_SIZE, buffer_size=65535, use_mmsg=HAVE_MMSG):
+        self.udp_socket = udp_socket
+        self.batch_size = batch_size
+        self.use_mmsg = use_mmsg
+        self.buffers = [bytearray(buffer_size) for _ in range(batch_size)]
+        self.views = [memoryview(buffer) for buffer in self.buffers]
+        if use_mmsg:
+            self.iovecs = (iovec * batch_size)()
+            self.messages = (mmsghdr * batch_size)()
+            self.names = (sockaddr_in * batch_size)()
+            self.pinned = []
+            for i, buffer in enumerate(self.buffers):
+                base, keep = _buffer_address(buffer)
+                self.pinned.append(keep)
+                self.iovecs[i].iov_base = base
+                self.iovecs[i].iov_len = buffer_size
+                header = self.messages[i].msg_hdr
+                header.msg_name = ctypes.addressof(self.names[i])
+                header.msg_iov = ctypes.pointer(self.iovecs[i])
+                header.msg_iovlen = 1
+
+    def receive(self, block=False):
+        if self.use_mmsg:
+            return self._receive_mmsg(block)
+        received = []
+        flags = 0 if block else MSG_DONTWAIT
+        for view in self.views:
+            try:
+                nbytes, address = self.udp_socket.recvfrom_into(view, 0, flags)
+            except BlockingIOError:
+                break
+            except ConnectionRefusedError:
+                # ICMP port unreachable for an earlier datagram
+                continue
+            received.append((view[:nbytes], address))
+            flags = MSG_DONTWAIT
+        return received
+
+    def _receive_mmsg(self, block):
+        for i in range(self.batch_size):
+            self.messages[i].msg_hdr.msg_namelen = SOCKADDR_IN_SIZE
+            self.messages[i].msg_hdr.msg_flags = 0
+        flags = MSG_WAITFORONE if block else MSG_DONTWAIT
+        while True:
+            count = libc.recvmmsg(self.udp_socket.fileno(), ctypes.addressof(self.messages), self.batch_size, flags, None)
+            if count >= 0:
+                break
+            if ctypes.get_errno() == errno.EINTR and block:
+                continue
+            return []
+        received = []
+        for i in range(count):
+            address = _decode_sockaddr(self.names[i].raw)
+            received.append((self.views[i][:self.messages[i].msg_len], address))
+        return received
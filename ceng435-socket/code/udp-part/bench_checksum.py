@@ -0,0 +1,36 @@
+import hashlib
+import os
+import timeit
+from packet import pack_segment, is_not_corrupt, SEGMENT_HEADER_SIZE
+
+# Microbenchmark: cost of checking one received segment with the CRC32 of
+# the wire format against hashing its payload with MD5 as the server used to do.
+
+SEGMENT_SIZE = 10 * 1024
+REPEAT = 5
+NUMBER = 20000
+
+
+def md5_check(view):
+    # the old per-segment path: copy the payload and MD5 it
+    hash_obj = hashlib.md5()
+    hash_obj.update(bytes(view[SEGMENT_HEADER_SIZE:]))
+    return hash_obj.hexdigest()
+
+
+def crc_check(view):
+    # the new path: CRC32 over a view of the receive buffer
+    return is_not_corrupt(view, SEGMENT_HEADER_SIZE)
+
+
+def main():
+    view = memoryview(pack_segment(1, 1, 42, 0, os.urandom(SEGMENT_SIZE)))
+
+    for name, check in (("md5", md5_check), ("crc32", crc_check)):
+        best = min(timeit.repeat(lambda: check(view), repeat=REPEAT, number=NUMBER))
+        per_segment = best / NUMBER
+        print(f"{name:>6}: {per_segment * 1e6:8.2f} us/segment  {SEGMENT_SIZE / per_segment / 1e6:8.1f} MB/s")
+
+
+if __name__ == "__main__":
+    main()
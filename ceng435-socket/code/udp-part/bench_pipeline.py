@@ -0,0 +1,120 @@
+import argparse
+import contextlib
+import io
+import os
+import tempfile
+import time
+from common import DEFAULT_MTU
+from compression import CODECS
+from packet import unpack_segment
+from pmtu import segment_size_for
+from scheduling import Stream
+from udp_client import create_segment_for_file, segment_count, interleave_segments, ReaderPool
+from udp_server import SRFlow, WriterPool
+
+# Benchmark of the pipeline mode: how the data path of the UDP client and
+# of the server scales with the number of worker processes, without the
+# network in between.
+# client: read (and compress) the 20 objects, number and checksum every
+#   segment, as the sender takes them from interleave_segments
+# server: deliver the segments in order to a Selective Repeat flow that
+#   decompresses, writes and verifies them, until its files are closed
+# 0 workers is the single process path. Process CPU time is not reported,
+# with workers most of it is spent in the children.
+
+OBJECT_DIR = "../../objects"
+FILE_COUNT = 10
+REPEAT = 3
+SESSION_ID = 0x0b0b0b0b
+
+
+def object_paths():
+    # in the client's order, so file ids match the server's file names
+    paths = []
+    for i in range(FILE_COUNT):
+        paths.append(os.path.join(OBJECT_DIR, f"small-{i}.obj"))
+        paths.append(os.path.join(OBJECT_DIR, f"large-{i}.obj"))
+    return paths
+
+
+def file_stream(file_id, path, segment_size, codec, readers):
+    stream = Stream(file_id, None, segment_count(path, segment_size))
+    stream.segments = readers.add(stream, path) if readers else create_segment_for_file(path, segment_size, file_id, codec)
+    return stream
+
+
+def client_stage(paths, segment_size, codec, workers):
+    # seconds to encode every segment, and the segments when asked for
+    start = time.perf_counter()
+    readers = ReaderPool(segment_size, codec, workers) if workers else None
+    each_segments = [file_stream(i, path, segment_size, codec, readers) for i, path in enumerate(paths)]
+    if readers:
+        readers.start()
+    wire_bytes = 0
+    for _, segment in interleave_segments(each_segments, SESSION_ID):
+        wire_bytes += len(segment)
+    elapsed = time.perf_counter() - start
+    if readers:
+        each_segments = None
+        readers.close()
+    return elapsed
+
+
+def server_stage(datagrams, codec, workers, output_directory):
+    # seconds to write and verify every file, and the number of verified files
+    writers = WriterPool(workers) if workers else None  # started once per server, not timed
+    flow = SRFlow(("127.0.0.1", 0), SESSION_ID, output_directory)
+    flow.codec = codec
+    if writers:
+        flow.writers = writers
+        flow.writer_session = writers.register(flow)
+    start = time.perf_counter()
+    for datagram in datagrams:
+        view = memoryview(datagram)
+        flow.on_data(view, unpack_segment(view))
+    flow.close()
+    elapsed = time.perf_counter() - start
+    if writers:
+        writers.close()
+    return elapsed, flow.metrics.counters['files_verified']
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scaling of the UDP pipeline mode with the number of worker processes")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="worker counts to compare with the single process path")
+    parser.add_argument("--compress", choices=sorted(CODECS), help="compress the segments (the costly part of the data path)")
+    parser.add_argument("--mtu", type=int, default=DEFAULT_MTU, help="segments are sized for this MTU")
+    parser.add_argument("--repeat", type=int, default=REPEAT, help="best of this many runs")
+    args = parser.parse_args()
+
+    paths = [path for path in object_paths() if os.path.exists(path)]
+    if len(paths) != 2 * FILE_COUNT:
+        print(f"Objects missing in {OBJECT_DIR}, run generateobjects.sh first")
+        return
+    total_bytes = sum(os.path.getsize(path) for path in paths)
+    segment_size = segment_size_for(args.mtu)
+    datagrams = [bytes(segment) for _, segment in interleave_segments(
+        [Stream(i, create_segment_for_file(path, segment_size, i, args.compress), segment_count(path, segment_size))
+         for i, path in enumerate(paths)], SESSION_ID)]
+    print(f"{len(datagrams)} segments of {segment_size} bytes, {total_bytes / 1e6:.1f} MB, "
+          f"compression: {args.compress or 'none'}, {os.cpu_count()} CPUs")
+
+    for stage in ("client", "server"):
+        baseline = None
+        for workers in [0] + args.workers:
+            runs = []
+            for _ in range(args.repeat):
+                with tempfile.TemporaryDirectory() as output_directory, contextlib.redirect_stdout(io.StringIO()):
+                    if stage == "client":
+                        runs.append((client_stage(paths, segment_size, args.compress, workers), len(paths)))
+                    else:
+                        runs.append(server_stage(datagrams, args.compress, workers, output_directory))
+            wall, verified = min(runs)
+            baseline = baseline or wall
+            check = f"  {verified}/{len(paths)} verified" if stage == "server" else ""
+            print(f"{stage:>6} {workers} workers: {wall * 1000:8.1f} ms  {total_bytes / wall / 1e6:8.1f} MB/s  "
+                  f"x{baseline / wall:.2f}{check}")
+
+
+if __name__ == "__main__":
+    main()
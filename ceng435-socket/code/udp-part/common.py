@@ -1,10 +1,59 @@
-WINDOW_SIZE = 2
-TIMEOUT_DURATION = 0.05
-TIMEOUT_SLEEP = 0.05
+import os
+import sys
 
-#FOR DELAY
-# win 2 timeout 0.05 sleep 0.05 = 100 sec
-# win 4 timeout 0.1 sleep 0.1 = 110 sec
+# the modules shared with the TCP part (e.g. compression.py) live one directory up
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-#FOR LOSS
-# win 2 timeout 0.05 sleep 0.05 = 70 sec
\ No newline at end of file
+# Initial congestion window of the sender (segments), the window then
+# grows with congestion control up to MAX_WINDOW_SIZE
+WINDOW_SIZE = 2
+MAX_WINDOW_SIZE = 256
+# Number of segments the receiver buffers, advertised to the sender in every ACK
+# (at most packet.SACK_BITS + 1, so every buffered segment can be selectively acknowledged)
+RECEIVE_WINDOW = 128
+# Delayed ACKs: the receiver acknowledges every ACK_EVERY in-order segments or
+# after ACK_DELAY seconds, whichever comes first (out-of-order segments are
+# acknowledged at once). ACK_DELAY has to stay well below MIN_RTO.
+ACK_EVERY = 2
+ACK_DELAY = 0.005
+# Sessions: the server forgets a session it has not heard from for
+# SESSION_IDLE_TIMEOUT seconds, the client gives up opening or closing a
+# session after CONTROL_RETRIES unanswered attempts
+SESSION_IDLE_TIMEOUT = 30.0
+CONTROL_RETRIES = 10
+# Kernel socket buffer size requested on both ends, large enough for a window burst
+SOCKET_BUFFER_SIZE = 4 * 1024 * 1024
+# Reliable data transfer mode: "GBN" (Go-Back-N) or "SR" (Selective Repeat)
+RDT_MODE = "SR"
+# Retransmission timeout bounds (seconds), the actual timeout is estimated
+# from the measured RTT (see rtt.py) so it does not need tuning per delay setting
+INITIAL_RTO = 0.5
+MIN_RTO = 0.02
+MAX_RTO = 4.0
+# Server workers (--workers): a resumed or delta session may reach another
+# worker than the session it continues. The worker holding the session
+# directory hands it over once that session has been idle for
+# SESSION_HANDOFF_IDLE seconds (a live client sends at least every MAX_RTO),
+# it checks every SESSION_HANDOFF_CHECK seconds whether it was asked to
+SESSION_HANDOFF_IDLE = 2 * MAX_RTO
+SESSION_HANDOFF_CHECK = 1.0
+# Segment payload size: the client sizes its segments so that the datagrams
+# fit the path MTU (see pmtu.py), DEFAULT_MTU is assumed where it cannot be
+# found out. The server sizes its receive buffers for MAX_SEGMENT_SIZE and
+# caps the size a client asks for in its SYN at it.
+DEFAULT_MTU = 1500
+MAX_SEGMENT_SIZE = 10 * 1024
+# Sender pacing (see pacing.py): the pacing rate is the congestion window
+# over the smoothed RTT times PACING_GAIN (PACING_GAIN_SLOW_START in slow
+# start), the token bucket holds PACING_BURST segments or PACING_QUANTUM
+# seconds of sending, whichever is more
+PACING_GAIN = 1.25
+PACING_GAIN_SLOW_START = 2.0
+PACING_BURST = 2
+PACING_QUANTUM = 0.001
+# Pipeline mode (see pipeline.py): every reader process of the client may
+# read PIPELINE_DEPTH segments ahead of the sender (on top of the window
+# whose segments the sender still holds), every writer process of the
+# server buffers up to PIPELINE_SLOTS segments that wait to be written
+PIPELINE_DEPTH = 64
+PIPELINE_SLOTS = 256
@@ -0,0 +1,72 @@
+import time
+from common import WINDOW_SIZE, MAX_WINDOW_SIZE
+
+# number of duplicate ACKs that trigger a fast retransmit
+DUPLICATE_ACK_THRESHOLD = 3
+
+
+class CongestionController:
+    """
+    TCP Reno style congestion window, counted in segments.
+    Slow start until ssthresh, then additive increase of one segment per
+    window, multiplicative decrease on a fast retransmit and a reset to
+    the initial window on a timeout.
+    The usable window is the congestion window limited by the window the
+    receiver advertises in its ACKs.
+    With record_history every change of the window is recorded in history
+    as (seconds since start, congestion window) so it can be plotted, it
+    grows by one entry per ACK so only callers that export it ask for it.
+    The average and the maximum of the window are kept as running totals.
+    """
+
+    def __init__(self, initial_window=WINDOW_SIZE, max_window=MAX_WINDOW_SIZE, record_history=False):
+        self.initial_window = initial_window
+        self.max_window = max_window
+        self.cwnd = float(initial_window)
+        self.ssthresh = float(max_window)
+        self.start_time = time.time()
+        self.history = [(0.0, self.cwnd)] if record_history else None
+        self.max_cwnd = self.cwnd
+        # time weighted sum of the window up to the last change
+        self.window_seconds = 0.0
+        self.last_change = 0.0
+        self.last_cwnd = self.cwnd
+
+    def _record(self):
+        now = time.time() - self.start_time
+        self.window_seconds += self.last_cwnd * (now - self.last_change)
+        self.last_change = now
+        self.last_cwnd = self.cwnd
+        self.max_cwnd = max(self.max_cwnd, self.cwnd)
+        if self.history is not None:
+            self.history.append((now, self.cwnd))
+
+    def window(self, advertised_window):
+        # Number of segments that may be in flight
+        return max(1, min(int(self.cwnd), advertised_window))
+
+    def on_ack(self, newly_acked):
+        # New data was acknowledged
+        for _ in range(newly_acked):
+            if self.cwnd < self.ssthresh:
+                self.cwnd += 1  # slow start
+            else:
+                self.cwnd += 1 / self.cwnd  # congestion avoidance
+        self.cwnd = min(self.cwnd, self.max_window)
+        self._record()
+
+    def on_fast_retransmit(self):
+        # Loss detected by duplicate ACKs: halve the window
+        self.ssthresh = max(self.cwnd / 2, 2)
+        self.cwnd = self.ssthresh
+        self._record()
+
+    def on_timeout(self):
+        # Loss detected by a timeout: back to the initial window
+        self.ssthresh = max(self.cwnd / 2, 2)
+        self.cwnd = float(self.initial_window)
+        self._record()
+
+    def average_window(self):
+        # Time weighted average of the congestion window up to its last change
+        return self.window_seconds / self.last_change if self.last_change > 0 else self.cwnd
@@ -0,0 +1,182 @@
+from packet import pack_parity, unpack_parity
+
+# Forward error correction with XOR parity.
+# The sequence numbers are cut into blocks of k data segments, every block
+# gets m parity segments. Parity segment j of a block is the XOR of the
+# block's segments with index j, j + m, j + 2m, ... (a stripe), so any
+# single loss per stripe is rebuilt at the receiver without a retransmission,
+# in particular every burst of up to m consecutive losses inside a block.
+# Whole encoded datagrams (header and payload) are XORed, zero padded to
+# the longest one, the rebuilt datagram is checked with its own checksum.
+# NumPy is used for the XOR when it is installed, otherwise Python's
+# arbitrary size integers do it, which is also done in C.
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+HAVE_NUMPY = numpy is not None
+
+# the block fields of a parity segment are one byte each
+MAX_BLOCK_SIZE = 255
+
+
+def parse_fec(text):
+    """
+    Parse "K,M" (K data and M parity segments per block) as given on the
+    command line and in the handshake, raises ValueError if it is not valid.
+    """
+    try:
+        block_size, parity_count = (int(value) for value in text.split(","))
+    except ValueError:
+        raise ValueError(f"invalid FEC setting {text!r}, expected K,M")
+    if not 1 <= parity_count <= block_size <= MAX_BLOCK_SIZE:
+        raise ValueError(f"invalid FEC setting {text!r}, need 1 <= M <= K <= {MAX_BLOCK_SIZE}")
+    return block_size, parity_count
+
+
+class XorAccumulator:
+    """
+    XOR of a number of byte strings of different lengths (zero padded),
+    together with the XOR of their lengths.
+    """
+
+    def __init__(self):
+        self.length_xor = 0
+        self.max_length = 0
+        self.count = 0
+        self.value = numpy.zeros(0, dtype=numpy.uint8) if HAVE_NUMPY else 0
+
+    def add(self, data, length_xor=None):
+        # length_xor overrides the length that is XORed in (for parity data,
+        # whose length field is the XOR of the member lengths)
+        length = len(data)
+        self.length_xor ^= length if length_xor is None else length_xor
+        self.count += 1
+        if HAVE_NUMPY:
+            if length > len(self.value):
+                self.value = numpy.concatenate((self.value, numpy.zeros(length - len(self.value), dtype=numpy.uint8)))
+            numpy.bitwise_xor(self.value[:length], numpy.frombuffer(data, dtype=numpy.uint8), out=self.value[:length])
+        else:
+            self.value ^= int.from_bytes(data, 'little')
+        self.max_length = max(self.max_length, length)
+
+    def to_bytes(self, length):
+        if HAVE_NUMPY:
+            return self.value[:length].tobytes().ljust(length, b'\0')
+        return (self.value & ((1 << (8 * length)) - 1)).to_bytes(length, 'little')
+
+
+class FECEncoder:
+    """
+    Sender side: feed every data segment once, on its first transmission,
+    in sequence number order. add() returns the parity datagrams of a block
+    as soon as its last segment went out, finish() those of the last,
+    possibly shorter block.
+    """
+
+    def __init__(self, session_id, block_size, parity_count):
+        self.session_id = session_id
+        self.block_size = block_size
+        self.parity_count = parity_count
+        self.first_seq = 0
+        self.stripes = [XorAccumulator() for _ in range(parity_count)]
+
+    def add(self, seq, datagram):
+        self.stripes[(seq - self.first_seq) % self.parity_count].add(datagram)
+        if seq - self.first_seq + 1 == self.block_size:
+            return self.finish()
+        return []
+
+    def finish(self):
+        # Parity datagrams of the current block, starts the next block
+        block_size = sum(stripe.count for stripe in self.stripes)
+        parity = []
+        if block_size:
+            for index, stripe in enumerate(self.stripes):
+                if stripe.count:
+                    parity.append(pack_parity(self.session_id, self.first_seq, block_size, self.parity_count, index,
+                                              stripe.length_xor, stripe.to_bytes(stripe.max_length)))
+        self.first_seq += block_size
+        self.stripes = [XorAccumulator() for _ in range(self.parity_count)]
+        return parity
+
+
+class FECBlock:
+    # Receive state of one block: received members and parity per stripe
+    def __init__(self, parity_count):
+        self.seen = set()
+        self.members = [XorAccumulator() for _ in range(parity_count)]
+        self.parity = [None] * parity_count
+        self.block_size = None  # known once a parity segment of the block arrived
+
+
+class FECDecoder:
+    """
+    Receiver side: feed every data segment and every parity segment of the
+    session, both return the list of data datagrams that could be rebuilt.
+    A stripe is rebuilt once its parity and all but one of its members are in.
+    Blocks are forgotten once the receiver has delivered past them (forget()).
+    """
+
+    def __init__(self, block_size, parity_count):
+        self.block_size = block_size
+        self.parity_count = parity_count
+        self.blocks = {}  # first sequence number -> FECBlock
+        self.recovered = 0
+
+    def _block(self, first_seq):
+        if first_seq not in self.blocks:
+            self.blocks[first_seq] = FECBlock(self.parity_count)
+        return self.blocks[first_seq]
+
+    def add_data(self, seq, datagram):
+        first_seq = seq - seq % self.block_size
+        block = self._block(first_seq)
+        if seq in block.seen:
+            return []
+        block.seen.add(seq)
+        stripe = (seq - first_seq) % self.parity_count
+        block.members[stripe].add(datagram)
+        return self._rebuild(first_seq, block, stripe)
+
+    def add_parity(self, view):
+        parity = unpack_parity(view)
+        if parity is None:
+            return []
+        first_seq, block_size, parity_count, stripe, length_xor, data = parity
+        if parity_count != self.parity_count or first_seq % self.block_size or stripe >= parity_count:
+            return []
+        block = self._block(first_seq)
+        if block.parity[stripe] is not None:
+            return []
+        block.block_size = block_size
+        accumulator = XorAccumulator()
+        accumulator.add(data, length_xor)
+        block.parity[stripe] = accumulator
+        return self._rebuild(first_seq, block, stripe)
+
+    def _rebuild(self, first_seq, block, stripe):
+        parity = block.parity[stripe]
+        if parity is None:
+            return []
+        members = range(first_seq + stripe, first_seq + block.block_size, self.parity_count)
+        missing = [seq for seq in members if seq not in block.seen]
+        if len(missing) != 1:
+            return []
+        # XOR of the parity and every other member is the missing datagram
+        received = block.members[stripe]
+        length = parity.length_xor ^ received.length_xor
+        if not 0 < length <= max(parity.max_length, received.max_length):
+            return []
+        rebuilt = XorAccumulator()
+        rebuilt.add(parity.to_bytes(length))
+        rebuilt.add(received.to_bytes(length))
+        block.seen.add(missing[0])
+        self.recovered += 1
+        return [rebuilt.to_bytes(length)]
+
+    def forget(self, delivered):
+        # Drop the blocks whose segments are all below delivered
+        for first_seq in [first_seq for first_seq in self.blocks if first_seq + self.block_size <= delivered]:
+            del self.blocks[first_seq]
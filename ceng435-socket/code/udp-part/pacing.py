@@ -0,0 +1,77 @@
+import time
+from common import PACING_GAIN, PACING_GAIN_SLOW_START, PACING_BURST, PACING_QUANTUM
+
+# Sender pacing.
+# Without it a sender puts a whole window on the wire back to back whenever
+# ACKs open it, and a bottleneck queue (tc netem's limit, a router buffer)
+# that is shorter than the burst drops the tail of it: loss the sender
+# caused itself. A token bucket spreads the segments out instead, at either
+# a configured rate or the rate the window allows: congestion window over
+# the smoothed RTT, times a gain so pacing never becomes the bottleneck
+# (larger in slow start, where the window doubles every RTT), like Linux's
+# TCP pacing. The bucket holds PACING_BURST segments or PACING_QUANTUM of
+# sending, whichever is more, so a sender that wakes up late can catch up.
+
+
+class Pacer:
+    """
+    Token bucket of one sender, in bytes. rate is the fixed rate in bytes
+    per second, None to follow the window (see follow_window).
+    wait() tells how long to hold back the next segment, sent() takes
+    its bytes from the bucket (retransmissions too, they may push it into
+    debt). How late the sender sends after a wait is kept in metrics.
+    """
+
+    def __init__(self, segment_size, rate=None, metrics=None):
+        self.segment_size = segment_size
+        self.fixed = rate is not None
+        self.rate = rate  # None until there is an RTT to derive it from
+        self.metrics = metrics
+        self.tokens = segment_size * PACING_BURST
+        self.last_refill = time.time()
+        self.due = None  # when a segment held back by wait() may go
+        self.target_bytes = 0.0  # integral of the rate over the paced time
+        self.paced_time = 0.0
+
+    def follow_window(self, cwnd, srtt, slow_start):
+        # Rate from the congestion window (segments) and the smoothed RTT (seconds)
+        if self.fixed or not srtt:
+            return
+        gain = PACING_GAIN_SLOW_START if slow_start else PACING_GAIN
+        self.rate = gain * cwnd * self.segment_size / srtt
+
+    def _refill(self, now):
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        if self.rate is None:
+            return
+        depth = max(self.segment_size * PACING_BURST, self.rate * PACING_QUANTUM)
+        self.tokens = min(depth, self.tokens + self.rate * elapsed)
+        self.target_bytes += self.rate * elapsed
+        self.paced_time += elapsed
+
+    def wait(self):
+        # Seconds until the next full segment may be sent, 0 if it may go now
+        now = time.time()
+        self._refill(now)
+        if self.rate is None or self.tokens >= self.segment_size:
+            return 0
+        delay = (self.segment_size - self.tokens) / self.rate
+        self.due = now + delay
+        if self.metrics:
+            self.metrics.count('pacing_waits')
+        return delay
+
+    def sent(self, size):
+        now = time.time()
+        self._refill(now)
+        self.tokens -= size
+        if self.due is not None:
+            # how late the segment that had to wait actually went out
+            if self.metrics:
+                self.metrics.observe('pacing_lateness_seconds', max(0.0, now - self.due))
+            self.due = None
+
+    def target_rate(self):
+        # Average rate the pacer allowed, bytes per second
+        return self.target_bytes / self.paced_time if self.paced_time else None
@@ -0,0 +1,267 @@
+import struct
+import zlib
+from common import RECEIVE_WINDOW
+
+# Wire format of the UDP RDT protocol.
+# Every datagram starts with a one byte packet type and the four byte session
+# id of the flow it belongs to, followed by the rest of a fixed size header.
+# Data segments carry their payload right after the header, control packets
+# (handshake, teardown and signatures) may carry a short payload too.
+# All fields are in network byte order.
+# The checksum is a CRC32 over the whole datagram except the checksum field
+# itself, which is always the last field of the header.
+
+TYPE_DATA = 1
+TYPE_ACK = 2
+# a client opens a session with SYN, the server answers with SYNACK,
+# FIN / FINACK close it
+TYPE_SYN = 3
+TYPE_SYNACK = 4
+TYPE_FIN = 5
+TYPE_FINACK = 6
+# forward error correction parity of a block of data segments, see fec.py
+TYPE_PARITY = 7
+# a delta session asks for the block signature of the server's copy of a
+# file piece by piece (see delta.py)
+TYPE_SIGNATURE_REQUEST = 8
+TYPE_SIGNATURE = 9
+CONTROL_TYPES = (TYPE_SYN, TYPE_SYNACK, TYPE_FIN, TYPE_FINACK, TYPE_SIGNATURE_REQUEST, TYPE_SIGNATURE)
+
+# flags of a data segment
+FLAG_LAST_SEGMENT = 0x01
+# the payload is compressed with the codec negotiated for the session
+FLAG_COMPRESSED = 0x02
+# the payload is part of a delta stream against the server's copy of the file
+FLAG_DELTA = 0x04
+
+# type | session id, common to all datagrams
+PREFIX = struct.Struct("!BI")
+# type | session id | file id | sequence number | flags | payload length | checksum
+SEGMENT_HEADER = struct.Struct("!BIHIBHI")
+# type | session id | cumulative ACK | selective ACK bitmap | advertised window | checksum
+# The cumulative ACK is the next sequence number the receiver expects, every
+# segment before it has been received. Bit i of the bitmap is set if segment
+# cumulative ACK + 1 + i is buffered at the receiver.
+SACK_BITS = 128
+ACK_HEADER = struct.Struct(f"!BII{SACK_BITS // 8}sHI")
+# the receiver buffers segments up to RECEIVE_WINDOW - 1 past the cumulative
+# ACK, the bitmap has to cover all of them or buffered segments are resent for nothing
+assert RECEIVE_WINDOW <= SACK_BITS + 1, "the SACK bitmap does not cover the receive window"
+# type | session id | payload length | checksum
+CONTROL_HEADER = struct.Struct("!BIHI")
+# type | session id | first sequence number of the block | data segments in the block |
+# parity segments per block | index of this parity segment | XOR of the lengths | checksum
+PARITY_HEADER = struct.Struct("!BIIBBBHI")
+# payloads of the signature control packets
+# request: file id | index of the first signature entry wanted
+SIGNATURE_REQUEST = struct.Struct("!HI")
+# answer: file id | index of the first entry | number of entries of the whole signature |
+# MD5 digest of the server's copy (zero if it has none), followed by the entries that fit
+SIGNATURE_ANSWER = struct.Struct("!HII16s")
+
+SEGMENT_HEADER_SIZE = SEGMENT_HEADER.size
+ACK_SIZE = ACK_HEADER.size
+CONTROL_HEADER_SIZE = CONTROL_HEADER.size
+PARITY_HEADER_SIZE = PARITY_HEADER.size
+# largest payload of a control packet
+MAX_CONTROL_PAYLOAD = 1024
+
+HEADER_SIZES = {TYPE_DATA: SEGMENT_HEADER_SIZE, TYPE_ACK: ACK_SIZE, TYPE_PARITY: PARITY_HEADER_SIZE}
+HEADER_SIZES.update((packet_type, CONTROL_HEADER_SIZE) for packet_type in CONTROL_TYPES)
+
+# the checksum occupies the last 4 bytes of every header
+CHECKSUM_SIZE = 4
+
+
+def compute_checksum(view, header_size):
+    # CRC32 over the header without its checksum field and everything after the header
+    crc = zlib.crc32(view[:header_size - CHECKSUM_SIZE])
+    return zlib.crc32(view[header_size:], crc)
+
+
+def is_not_corrupt(view, header_size):
+    """
+    Check the checksum of a received datagram given as a memoryview.
+    Works directly on the receive buffer, nothing is copied.
+    """
+    if len(view) < header_size:
+        return False
+    checksum = int.from_bytes(view[header_size - CHECKSUM_SIZE:header_size], 'big')
+    return compute_checksum(view, header_size) == checksum
+
+
+def unpack_prefix(view):
+    """
+    Check and decode the part every datagram starts with.
+    Returns (packet type, session id), or None if the datagram is too short,
+    has an unknown type or a wrong checksum.
+    """
+    if len(view) < PREFIX.size:
+        return None
+    packet_type, session_id = PREFIX.unpack_from(view)
+    header_size = HEADER_SIZES.get(packet_type)
+    if header_size is None or not is_not_corrupt(view, header_size):
+        return None
+    return packet_type, session_id
+
+
+def store_checksum(view, header_size):
+    # Fill in the checksum field of an encoded datagram
+    checksum = compute_checksum(view, header_size)
+    view[header_size - CHECKSUM_SIZE:header_size] = checksum.to_bytes(CHECKSUM_SIZE, 'big')
+
+
+def finish_segment(buffer, session_id, file_id, sequence_number, flags):
+    """
+    Write the header and checksum of a data segment whose payload was already
+    placed right after the header space, e.g. read from the file with readinto.
+    The whole buffer is the segment.
+    """
+    view = memoryview(buffer)
+    SEGMENT_HEADER.pack_into(view, 0, TYPE_DATA, session_id, file_id, sequence_number, flags, len(view) - SEGMENT_HEADER_SIZE, 0)
+    store_checksum(view, SEGMENT_HEADER_SIZE)
+    return buffer
+
+
+def pack_segment_into(buffer, session_id, file_id, sequence_number, flags, payload, offset=0):
+    """
+    Write a data segment (header + payload + checksum) into a preallocated buffer.
+    Returns the number of bytes written.
+    """
+    length = len(payload)
+    start = offset + SEGMENT_HEADER_SIZE
+    view = memoryview(buffer)
+    view[start:start + length] = payload
+    finish_segment(view[offset:start + length], session_id, file_id, sequence_number, flags)
+    return SEGMENT_HEADER_SIZE + length
+
+
+def pack_segment(session_id, file_id, sequence_number, flags, payload):
+    # Encode a data segment into a new buffer of the exact size
+    buffer = bytearray(SEGMENT_HEADER_SIZE + len(payload))
+    pack_segment_into(buffer, session_id, file_id, sequence_number, flags, payload)
+    return buffer
+
+
+def unpack_segment(view):
+    """
+    Decode a data segment from a memoryview of a received datagram.
+    Returns (file_id, sequence_number, flags, payload) where payload is a view
+    into the same buffer, or None if the datagram is not a well formed segment.
+    The checksum has to be verified beforehand, the session id is read with unpack_prefix.
+    """
+    if len(view) < SEGMENT_HEADER_SIZE:
+        return None
+    packet_type, _, file_id, sequence_number, flags, length, _ = SEGMENT_HEADER.unpack_from(view)
+    if packet_type != TYPE_DATA or SEGMENT_HEADER_SIZE + length != len(view):
+        return None
+    return file_id, sequence_number, flags, view[SEGMENT_HEADER_SIZE:]
+
+
+def pack_ack_into(buffer, session_id, cumulative_ack, sack_bitmap, window):
+    """
+    Write an ACK into a preallocated buffer, returns the number of bytes written.
+    window is the number of segments the receiver can still accept.
+    """
+    ACK_HEADER.pack_into(buffer, 0, TYPE_ACK, session_id, cumulative_ack, sack_bitmap.to_bytes(SACK_BITS // 8, 'big'), window, 0)
+    store_checksum(memoryview(buffer)[:ACK_SIZE], ACK_SIZE)
+    return ACK_SIZE
+
+
+def unpack_ack(view):
+    """
+    Decode an ACK, returns (cumulative ACK, selective ACK bitmap, advertised window)
+    or None if malformed.
+    The checksum has to be verified beforehand, the session id is read with unpack_prefix.
+    """
+    if len(view) != ACK_SIZE:
+        return None
+    packet_type, _, cumulative_ack, sack_bitmap, window, _ = ACK_HEADER.unpack_from(view)
+    if packet_type != TYPE_ACK:
+        return None
+    return cumulative_ack, int.from_bytes(sack_bitmap, 'big'), window
+
+
+def pack_control_into(buffer, packet_type, session_id, payload=b""):
+    """
+    Write a control packet (handshake, teardown or signature) into a
+    preallocated buffer, returns the number of bytes written.
+    """
+    length = len(payload)
+    view = memoryview(buffer)
+    view[CONTROL_HEADER_SIZE:CONTROL_HEADER_SIZE + length] = payload
+    CONTROL_HEADER.pack_into(view, 0, packet_type, session_id, length, 0)
+    store_checksum(view[:CONTROL_HEADER_SIZE + length], CONTROL_HEADER_SIZE)
+    return CONTROL_HEADER_SIZE + length
+
+
+def unpack_control(view):
+    """
+    Decode a control packet, returns its payload as a view into the same
+    buffer or None if malformed.
+    The checksum has to be verified beforehand, the session id is read with unpack_prefix.
+    """
+    if len(view) < CONTROL_HEADER_SIZE:
+        return None
+    packet_type, _, length, _ = CONTROL_HEADER.unpack_from(view)
+    if packet_type not in CONTROL_TYPES or CONTROL_HEADER_SIZE + length != len(view):
+        return None
+    return view[CONTROL_HEADER_SIZE:]
+
+
+def pack_parity(session_id, first_seq, block_size, parity_count, index, length_xor, data):
+    # Encode a parity segment into a new buffer of the exact size
+    buffer = bytearray(PARITY_HEADER_SIZE + len(data))
+    buffer[PARITY_HEADER_SIZE:] = data
+    PARITY_HEADER.pack_into(buffer, 0, TYPE_PARITY, session_id, first_seq, block_size, parity_count, index, length_xor, 0)
+    store_checksum(memoryview(buffer), PARITY_HEADER_SIZE)
+    return buffer
+
+
+def unpack_parity(view):
+    """
+    Decode a parity segment, returns (first sequence number, block size,
+    parity count, index, length XOR, data view) or None if malformed.
+    The checksum has to be verified beforehand, the session id is read with unpack_prefix.
+    """
+    if len(view) < PARITY_HEADER_SIZE:
+        return None
+    packet_type, _, first_seq, block_size, parity_count, index, length_xor, _ = PARITY_HEADER.unpack_from(view)
+    if packet_type != TYPE_PARITY or not block_size or not parity_count:
+        return None
+    return first_seq, block_size, parity_count, index, length_xor, view[PARITY_HEADER_SIZE:]
+
+
+def encode_options(options):
+    # Handshake payload: "key=value" pairs separated by ";"
+    return ";".join(f"{key}={value}" for key, value in options.items()).encode()
+
+
+def decode_options(payload):
+    # Inverse of encode_options, malformed pairs are skipped
+    options = {}
+    for pair in bytes(payload).decode(errors='replace').split(";"):
+        key, separator, value = pair.partition("=")
+        if separator:
+            options[key] = value
+    return options
+
+
+def sack_bitmap(cumulative_ack, buffered):
+    # Build the selective ACK bitmap from the buffered sequence numbers
+    bitmap = 0
+    for seq in buffered:
+        bit = seq - cumulative_ack - 1
+        if 0 <= bit < SACK_BITS:
+            bitmap |= 1 << bit
+    return bitmap
+
+
+def sacked_sequence_numbers(cumulative_ack, bitmap):
+    # Sequence numbers selectively acknowledged by a bitmap, in increasing order
+    seq = cumulative_ack + 1
+    while bitmap:
+        if bitmap & 1:
+            yield seq
+        bitmap >>= 1
+        seq += 1
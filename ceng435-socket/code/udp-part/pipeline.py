@@ -0,0 +1,73 @@
+import multiprocessing
+import struct
+from multiprocessing import shared_memory
+
+# Shared memory rings of the pipeline mode.
+# In the pipeline mode the work around the socket loop runs in worker
+# processes, so it is not serialized on one interpreter lock: the client's
+# readers read and compress the files (ReaderPool in udp_client.py), the
+# server's writers decompress, write and verify them (WriterPool in
+# udp_server.py). A SlotRing connects one worker to the socket loop: the
+# segments are read into (or copied once into) a slot of shared memory
+# together with a few fixed size fields, nothing is pickled or sent
+# through a pipe per segment. Two semaphores count the filled and the free
+# slots, they are the only synchronization (and, being futexes, cost no
+# system call unless a side has to wait).
+
+
+class SlotRing:
+    """
+    Single producer, single consumer ring of slots of slot_size bytes in
+    one shared memory block, every slot has a header with the fields of
+    the struct format fields.
+    The producer takes the next free slot (acquire, blocks while all are
+    in use), fills it through view() and hands it over with its fields
+    (publish), the consumer gets the slots in the same order with take()
+    and gives them back, oldest first, with release().
+    Created by the parent, the worker process gets it as an argument.
+    """
+
+    def __init__(self, slots, slot_size, fields):
+        self.slots = slots
+        self.slot_size = slot_size
+        self.fields = struct.Struct(fields)
+        self.stride = self.fields.size + slot_size
+        self.memory = shared_memory.SharedMemory(create=True, size=slots * self.stride)
+        self.filled = multiprocessing.Semaphore(0)
+        self.free = multiprocessing.Semaphore(slots)
+        # each side only uses its own position
+        self.next_write = 0
+        self.next_read = 0
+
+    def acquire(self):
+        self.free.acquire()
+        slot = self.next_write % self.slots
+        self.next_write += 1
+        return slot
+
+    def view(self, slot, length):
+        # the first length bytes of a slot, a view into the shared memory
+        start = slot * self.stride + self.fields.size
+        return self.memory.buf[start:start + length]
+
+    def publish(self, slot, *fields):
+        self.fields.pack_into(self.memory.buf, slot * self.stride, *fields)
+        self.filled.release()
+
+    def take(self):
+        # (slot, fields) of the next published slot, waits for one
+        self.filled.acquire()
+        slot = self.next_read % self.slots
+        self.next_read += 1
+        return slot, self.fields.unpack_from(self.memory.buf, slot * self.stride)
+
+    def release(self):
+        self.free.release()
+
+    def close(self):
+        # Free the shared memory, called by the parent once the worker is done
+        self.memory.unlink()
+        try:
+            self.memory.close()
+        except BufferError:
+            pass  # a view is still referenced somewhere, the mapping goes with it
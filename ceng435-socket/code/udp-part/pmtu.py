@@ -0,0 +1,57 @@
+import socket
+import sys
+from common import DEFAULT_MTU, MAX_SEGMENT_SIZE
+from packet import SEGMENT_HEADER_SIZE, PARITY_HEADER_SIZE
+
+# Segment sizing from the path MTU, so that no datagram is ever fragmented:
+# an IP fragment lost (or dropped by netem) takes the whole datagram with it,
+# so a datagram of n fragments is lost n times as often.
+# On Linux the kernel knows the MTU of the route to the server (and lowers
+# it when an ICMP "fragmentation needed" comes back), a connected socket
+# with path MTU discovery on reports it as IP_MTU. The data is sent with the
+# DF bit set, in the "probe" mode that ignores later PMTU updates so a
+# segment that was sized at the start is never refused with EMSGSIZE.
+# Elsewhere DEFAULT_MTU is assumed.
+
+# <linux/in.h>, the socket module does not export them
+IP_MTU_DISCOVER = 10
+IP_PMTUDISC_DO = 2
+IP_PMTUDISC_PROBE = 3
+IP_MTU = 14
+HAVE_PMTU = sys.platform.startswith("linux")
+
+# IPv4 header without options plus the UDP header
+IP_UDP_HEADER_SIZE = 20 + 8
+
+
+def path_mtu(server_address):
+    # MTU of the path to the server as far as the kernel knows it, DEFAULT_MTU if it cannot tell
+    if not HAVE_PMTU:
+        return DEFAULT_MTU
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+            probe.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_DO)
+            probe.connect(server_address)
+            return probe.getsockopt(socket.IPPROTO_IP, IP_MTU)
+    except OSError:
+        return DEFAULT_MTU
+
+
+def set_dont_fragment(udp_socket):
+    # Set DF on everything the socket sends (Linux only)
+    if HAVE_PMTU:
+        try:
+            udp_socket.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_PROBE)
+        except OSError:
+            pass
+
+
+def segment_size_for(mtu, fec=False):
+    """
+    Largest segment payload whose datagram fits in one IP packet of the
+    given MTU, at most MAX_SEGMENT_SIZE. With forward error correction the
+    parity datagrams are the largest ones, a parity header longer than the
+    segment they protect.
+    """
+    overhead = IP_UDP_HEADER_SIZE + SEGMENT_HEADER_SIZE + (PARITY_HEADER_SIZE if fec else 0)
+    return max(1, min(MAX_SEGMENT_SIZE, mtu - overhead))
@@ -0,0 +1,47 @@
+from common import INITIAL_RTO, MIN_RTO, MAX_RTO, ACK_DELAY
+
+
+class RTTEstimator:
+    """
+    Retransmission timeout estimation as in RFC 6298.
+    SRTT and RTTVAR are smoothed from the RTT samples taken on ACKs,
+    the RTO is doubled on every timeout (exponential backoff) and always
+    kept between MIN_RTO and MAX_RTO.
+    Like QUIC's probe timeout the RTO also allows for the receiver's
+    delayed ACK (max_ack_delay): the samples are mostly taken on ACKs that
+    went out at once, a paced sender then sees its segments acknowledged
+    up to ACK_DELAY later than the estimate and times out spuriously.
+    Callers apply Karn's rule: segments that were retransmitted must not
+    produce RTT samples, their ACK is ambiguous.
+    """
+
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+    K = 4
+
+    def __init__(self, initial_rto=INITIAL_RTO, min_rto=MIN_RTO, max_rto=MAX_RTO, max_ack_delay=ACK_DELAY):
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.max_ack_delay = max_ack_delay
+        self.srtt = None
+        self.rttvar = None
+        self.rto = self._clamp(initial_rto)
+
+    def _clamp(self, rto):
+        return max(self.min_rto, min(self.max_rto, rto))
+
+    def sample(self, rtt):
+        # Update the estimate with a new RTT measurement (seconds)
+        if self.srtt is None:
+            # first measurement
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+        # a fresh sample also collapses any backoff
+        self.rto = self._clamp(self.srtt + self.K * self.rttvar + self.max_ack_delay)
+
+    def backoff(self):
+        # A retransmission timer expired: double the timeout
+        self.rto = self._clamp(self.rto * 2)
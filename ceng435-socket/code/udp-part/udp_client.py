@@ -1,9 +1,38 @@
 import socket
 import os
-import pickle
 import time
 import hashlib
-from common import WINDOW_SIZE, TIMEOUT_DURATION, TIMEOUT_SLEEP
+import heapq
+import selectors
+import multiprocessing
+import signal
+from collections import deque, Counter
+import argparse
+from common import RECEIVE_WINDOW, RDT_MODE, SOCKET_BUFFER_SIZE, CONTROL_RETRIES, MAX_WINDOW_SIZE, PIPELINE_DEPTH
+from rtt import RTTEstimator
+from congestion import CongestionController, DUPLICATE_ACK_THRESHOLD
+from batch_io import BatchSender, BatchReceiver
+from fec import FECEncoder, parse_fec
+from compression import CODECS, compress, shrinks
+from delta import compute_delta, literal_length, SIGNATURE_ENTRY
+from pmtu import path_mtu, set_dont_fragment, segment_size_for
+from pacing import Pacer
+from pipeline import SlotRing
+from scheduling import (Stream, schedule, object_class, parse_priorities, parse_weights, completion_report,
+                        SCHEDULERS, DEFAULT_SCHEDULER, DEFAULT_PRIORITIES, DEFAULT_WEIGHTS)
+from metrics import Metrics, logger, setup_logging, EXPORT_FORMATS, LOG_LEVELS
+from packet import (finish_segment, unpack_prefix, unpack_ack, unpack_control, pack_control_into, sacked_sequence_numbers,
+                    SEGMENT_HEADER_SIZE, CONTROL_HEADER_SIZE, MAX_CONTROL_PAYLOAD, FLAG_LAST_SEGMENT, FLAG_COMPRESSED, FLAG_DELTA,
+                    TYPE_ACK, TYPE_SYN, TYPE_SYNACK, TYPE_FIN, TYPE_FINACK, TYPE_SIGNATURE_REQUEST, TYPE_SIGNATURE,
+                    SIGNATURE_REQUEST, SIGNATURE_ANSWER, encode_options, decode_options)
+
+# counters, histograms and the window over time of the transfer, reported at the end (see metrics.py)
+metrics = Metrics(transport="udp", role="client")
+
+# large enough for any reply of the server: ACKs and handshake / teardown answers
+REPLY_BUFFER_SIZE = CONTROL_HEADER_SIZE + MAX_CONTROL_PAYLOAD
+# fields of a slot of a reader's ring in the pipeline mode: file_id, flags, length of the segment
+READER_FIELDS = "!HBI"
 
 
 def calculate_checksum(data):
@@ -27,149 +56,661 @@ def calculate_checksum(data):
     # Return the hex digest of the data
     return hash_obj.hexdigest()
 
-def create_segment_for_file(file_path, segment_size,file_id):
+def create_segment_for_file(file_path, segment_size,file_id, codec=None, offset=0, allocate=bytearray):
     """
-    this function creates segments for the files
-    each segment is dictonary containts some fields 
-    like file_id, sequence_number, data, is_last_segment
+    this function lazily creates the segments of a file
+    it yields (file_id, buffer, flags) tuples, the payload is read
+    straight into the buffer after the space reserved for the header
+    so only the segments that were asked for are ever in memory
+    an empty file still produces one (empty) last segment
+    with a codec every segment is compressed on its own (so it can still be
+    delivered out of order), unless the first one shows that the file does
+    not compress, then the rest of it is sent as is
+    with an offset only the data from there on is sent (the server has the rest)
+    allocate(size) gives the buffer of each segment, e.g. a slot of shared memory
     """
-    all_segments = []
     # check if the file exists
     if not os.path.exists(file_path):
         print(f"File {file_path} does not exist.")
-        return None
+        return
     # reading the file and creating segments
     with open(file_path, 'rb') as file:
-        sequence_number = 0
+        remaining = max(0, os.fstat(file.fileno()).st_size - offset)
+        file.seek(offset)
         while True:
-            data = file.read(segment_size)
-            if not data:
+            length = min(segment_size, remaining)
+            buffer = allocate(SEGMENT_HEADER_SIZE + length)
+            file.readinto(memoryview(buffer)[SEGMENT_HEADER_SIZE:])
+            remaining -= length
+            flags = FLAG_LAST_SEGMENT if remaining == 0 else 0
+            if codec:
+                packed = compress_segment(buffer, codec)
+                if packed:
+                    buffer = packed
+                    flags |= FLAG_COMPRESSED
+                else:
+                    codec = None  # does not compress, stop trying for this file
+            yield file_id, buffer, flags
+            if remaining == 0:
                 break
-            segment = {
-                'file_id': file_id, # identify the file
-                'sequence_number': sequence_number, # order of the segment
-                'data': data, # actual data
-                'is_last_segment': False, # flag for the last segment
-                # 'checksum': calculate_checksum(data) # checksum of the segment
-            }
-            all_segments.append(segment)
-            sequence_number += 1
-
-    # set the last segment flag to true
-    all_segments[-1]['is_last_segment'] = True
 
-    return all_segments
+def segment_count(file_path, segment_size, offset=0):
+    # number of segments create_segment_for_file makes of a file
+    remaining = max(0, os.path.getsize(file_path) - offset)
+    return max(1, -(-remaining // segment_size))
 
-def interleave_segments(segments):
-    # this function interleaves the segments
-    interleaved_segments = []
+def compress_segment(buffer, codec):
+    # a new segment buffer with the payload compressed, None if that does not make it smaller
+    packed = compress(codec, memoryview(buffer)[SEGMENT_HEADER_SIZE:])
+    if shrinks(len(buffer) - SEGMENT_HEADER_SIZE, len(packed)):
+        return bytearray(SEGMENT_HEADER_SIZE) + packed
+    return None
 
+def create_delta_segments(file_path, segment_size, file_id, signature, codec=None):
+    """
+    the segments (like create_segment_for_file, as a list) of the delta stream
+    that turns the server's copy of the file, whose block signature is given,
+    into this file (see delta.py), they are flagged FLAG_DELTA
+    returns the segments and the number of literal bytes of the file in the delta
+    the delta is computed right away so its cost is not paid in the middle of the transfer
+    """
+    instructions = list(compute_delta(file_path, signature))
+    literal = sum(map(literal_length, instructions))
+    stream = b"".join(instructions)
+    segments = []
+    for start in range(0, len(stream), segment_size):
+        buffer = bytearray(SEGMENT_HEADER_SIZE) + stream[start:start + segment_size]
+        flags = FLAG_DELTA
+        if start + segment_size >= len(stream):
+            flags |= FLAG_LAST_SEGMENT
+        if codec:
+            packed = compress_segment(buffer, codec)
+            if packed:
+                buffer = packed
+                flags |= FLAG_COMPRESSED
+        segments.append((file_id, buffer, flags))
+    return segments, literal
+
+def interleave_segments(streams, session_id, scheduler=DEFAULT_SCHEDULER, progress=None):
+    """
+    this function interleaves the segments of the files
+    streams is a list of scheduling.Stream, one per file, whose segments are
+    per file segment generators, the scheduler picks the file each next
+    segment is taken from (round-robin by default, see scheduling.py) and
+    generators that run out are dropped
+    it yields (sequence_number, encoded segment) with global sequence numbers
+    of the session, each segment is encoded once so resending it needs no serialization
+    progress (ObjectProgress) learns which file every sequence number belongs to
+    """
     global_sequence_number = 0
     # Interleave the segments
-    while any(segments):  # Continue until all segments are empty
-        for i in range(len(segments)):
-            if len(segments[i]) > 0:  # Check if the current segment is not empty
-                segment = segments[i].pop(0)  # Pop the first element of the non-empty segment
-                segment['sequence_number'] = global_sequence_number
-                interleaved_segments.append(segment)
-                global_sequence_number += 1
-
-    return interleaved_segments
-
-def send_segment(udp_socket, segment, server_address):
-    # Serialize and send a segment over UDP
-    try:
-        #  The segment dictionary is serialized with pickle
-        serialized_segment = pickle.dumps(segment)        # Serialize the segment using pickle
-     
-        # The sendto method of the socket
-        udp_socket.sendto(serialized_segment, server_address)           # Send the serialized segment to the server
-        print(f"Segment {segment['sequence_number']} sent.")
-    except Exception as e:
-        print(f"Error sending segment: {e}")
+    for file_id, buffer, flags in schedule(streams, scheduler):
+        if progress:
+            progress.sent(global_sequence_number, file_id, flags)
+        yield global_sequence_number, finish_segment(buffer, session_id, file_id, global_sequence_number, flags)
+        global_sequence_number += 1
 
-def receive_ack(udp_socket, timeout=TIMEOUT_SLEEP):
+def run_reader(ring, files, segment_size, codec, scheduler=DEFAULT_SCHEDULER):
     """
-    Wait for an ACK from the server for a specific segment with a specified timeout.
-    If the expected ACK is received, it returns the ACK.
-    If a timeout occurs, it returns None.
+    Reader process of the pipeline mode: reads (and compresses) its files,
+    (file_id, path, offset, segment count, priority, weight) tuples, in the
+    scheduler's order straight into the slots of its ring and publishes them
+    with the fields READER_FIELDS, in the order the sender will take them
+    (see ReaderPool).
     """
-    try:
-        # Set the socket timeout
-        udp_socket.settimeout(timeout)
-
-        # Try to receive an ACK
-        ack_data, _ = udp_socket.recvfrom(1024)  # buffer size
-        ack = pickle.loads(ack_data)
-
-        # Return the received ACK
-        return ack
-    except socket.timeout:
-        # Handle the timeout case
-        print("Timeout in receiving acknowledgment")
-        return None
-    except Exception as e:
-        # Handle other errors
-        print(f"Error in receiving acknowledgment: {e}")
-        return None
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the client stops its readers
+    slot = None
 
-def is_not_corrupt(segment):
-    return True
+    def allocate(size):
+        nonlocal slot
+        slot = ring.acquire()
+        return ring.view(slot, size)
 
-def has_sequence_number(segment, expected_seq_num):
-    return segment['sequence_number'] == expected_seq_num
+    streams = [Stream(file_id, create_segment_for_file(path, segment_size, file_id, codec, offset, allocate), size, priority, weight)
+               for file_id, path, offset, size, priority, weight in files]
+    for file_id, buffer, flags in schedule(streams, scheduler):
+        if not isinstance(buffer, memoryview):
+            # compressed into a new buffer, which is smaller than the slot
+            ring.view(slot, len(buffer))[:] = buffer
+        ring.publish(slot, file_id, flags, len(buffer))
 
-def GBN_sender(udp_socket,server_address, base, next_seq_num, N, interleaved_segments, timer_start_time, timeout_duration):
+
+class ReaderPool:
+    """
+    Pipeline mode of the client: workers reader processes read and compress
+    the files, the sender loop only numbers the segments and computes their
+    checksum, in place in the shared memory (see pipeline.py).
+    add() deals the files out to the readers in turn and returns the
+    generator of a file's segments, start() starts the readers. Every
+    reader schedules its files like interleave_segments schedules all of
+    them, and a scheduler orders any subset of the files the same way (see
+    scheduling.py), so the sender takes the segments of a reader in the
+    order the reader produced them and a file's generator just takes the
+    next message of its reader.
+    A slot is given back once MAX_WINDOW_SIZE newer segments were handed
+    out: the sender never has more than that many segments in flight, so
+    by then the segment is acknowledged and forgotten. That also gives the
+    slots of every ring back in the order they were filled.
+    """
+
+    def __init__(self, segment_size, codec=None, workers=2, scheduler=DEFAULT_SCHEDULER):
+        self.segment_size = segment_size
+        self.codec = codec
+        self.scheduler = scheduler
+        self.rings = [SlotRing(MAX_WINDOW_SIZE + 1 + PIPELINE_DEPTH, SEGMENT_HEADER_SIZE + segment_size, READER_FIELDS) for _ in range(workers)]
+        self.files = [[] for _ in range(workers)]  # what run_reader needs of the files of every reader
+        self.in_use = deque()  # rings of the segments handed out, oldest first
+        self.processes = []
+
+    def add(self, stream, path, offset=0):
+        # the segments of the file of a Stream
+        reader = sum(map(len, self.files)) % len(self.rings)
+        self.files[reader].append((stream.object_id, path, offset, stream.remaining, stream.priority, stream.weight))
+        return self.segments(self.rings[reader])
+
+    def start(self):
+        for ring, files in zip(self.rings, self.files):
+            process = multiprocessing.Process(target=run_reader, args=(ring, files, self.segment_size, self.codec, self.scheduler), daemon=True)
+            process.start()
+            self.processes.append(process)
+
+    def segments(self, ring):
+        # the segments of a file, like create_segment_for_file, the buffers are views into the shared memory
+        while True:
+            slot, (segment_file_id, flags, length) = ring.take()
+            self.in_use.append(ring)
+            if len(self.in_use) > MAX_WINDOW_SIZE:
+                self.in_use.popleft().release()
+            yield segment_file_id, ring.view(slot, length), flags
+            if flags & FLAG_LAST_SEGMENT:
+                return
+
+    def close(self):
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()  # the transfer was given up
+            process.join()
+        self.in_use.clear()
+        for ring in self.rings:
+            ring.close()
+
+class ObjectProgress:
+    """
+    Completion of the files as the sender sees it: a file is complete once
+    all its segments are acknowledged. The completion time counts from the
+    start of the transfer, so it includes the time the file waited for its
+    turn, which is what the scheduler changes. names maps file_id ->
+    (name, bytes), every completed file goes to the metrics.
+    """
+
+    def __init__(self, names, start_time):
+        self.names = names
+        self.start_time = start_time
+        self.file_of = {}  # sequence number -> file_id, for the unacknowledged segments
+        self.unacked = Counter()  # file_id -> segments sent but not acknowledged
+        self.first_sent = {}  # file_id -> time its first segment was sent
+        self.all_sent = set()  # files whose last segment was sent
+
+    def sent(self, seq, file_id, flags):
+        self.file_of[seq] = file_id
+        self.unacked[file_id] += 1
+        self.first_sent.setdefault(file_id, time.time())
+        if flags & FLAG_LAST_SEGMENT:
+            self.all_sent.add(file_id)
+
+    def acked(self, seq):
+        file_id = self.file_of.pop(seq, None)
+        if file_id is None:
+            return
+        self.unacked[file_id] -= 1
+        if not self.unacked[file_id] and file_id in self.all_sent:
+            now = time.time()
+            name, size = self.names[file_id]
+            metrics.object_done(name, size, now - self.first_sent[file_id], completed=now - self.start_time)
+
+def send_segment(batch_sender, segment, server_address, sequence_number, pacer=None):
+    """
+    Queue an already encoded segment in the batch sender.
+    The queued segments go out together with one system call when the
+    sender flushes, a segment the socket buffer has no room for is treated
+    like a lost segment and recovered by its retransmission timer.
+    With a pacer the segment is taken from its token bucket.
+    """
+    batch_sender.add(segment, server_address)           # Queue the encoded segment for the server
+    if pacer:
+        pacer.sent(len(segment))
+    metrics.count('segments_sent')
+    metrics.count('wire_bytes', len(segment))
+    logger.debug("Segment %d sent.", sequence_number)
+
+def send_parity(batch_sender, parity, server_address, pacer=None):
+    # Queue a parity segment, it is sent once and never acknowledged
+    batch_sender.add(parity, server_address)
+    if pacer:
+        pacer.sent(len(parity))
+    metrics.count('parity_sent')
+    metrics.count('wire_bytes', len(parity))
+
+def receive_acks(batch_receiver, session_id):
+    """
+    Drain every ACK that is already waiting on the non-blocking socket,
+    a batch of datagrams at a time.
+    Yields (cumulative ACK, selective ACK bitmap, advertised window) for each valid ACK
+    of the session and returns as soon as the socket would block.
+    Corrupted ACKs are counted and dropped, so are late handshake answers.
+    """
+    while True:
+        received = batch_receiver.receive()
+        if not received:
+            return
+        for view, _ in received:
+            prefix = unpack_prefix(view)
+            if prefix is None:
+                metrics.count('corrupt_acks')
+                continue
+            if prefix != (TYPE_ACK, session_id):
+                continue
+            ack = unpack_ack(view)
+            if ack != None:
+                metrics.count('acks_received')
+                yield ack
+
+def exchange_control(udp_socket, server_address, packet_type, session_id, reply_type, rtt_estimator, payload=b""):
+    """
+    Send a handshake or teardown packet until the server answers it with reply_type.
+    The packet is resent with exponential backoff of the RTO, an answer to a
+    packet that was sent only once gives an RTT sample (Karn's rule).
+    Returns the payload of the answer, or None if the server did not answer
+    CONTROL_RETRIES attempts.
+    """
+    buffer = bytearray(CONTROL_HEADER_SIZE + len(payload))
+    pack_control_into(buffer, packet_type, session_id, payload)
+    batch_receiver = BatchReceiver(udp_socket, batch_size=8, buffer_size=REPLY_BUFFER_SIZE)
+    selector = selectors.DefaultSelector()
+    selector.register(udp_socket, selectors.EVENT_READ)
+
+    try:
+        for attempt in range(CONTROL_RETRIES):
+            try:
+                udp_socket.sendto(buffer, server_address)
+            except BlockingIOError:
+                pass  # treated like a lost packet
+            sent_time = time.time()
+            deadline = sent_time + rtt_estimator.rto
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0 or not selector.select(remaining):
+                    break
+                for view, _ in batch_receiver.receive():
+                    # anything else (e.g. late ACKs of the session) is ignored
+                    if unpack_prefix(view) != (reply_type, session_id):
+                        continue
+                    reply = unpack_control(view)
+                    if reply is None:
+                        continue
+                    if attempt == 0:
+                        rtt_sample(rtt_estimator, time.time() - sent_time)
+                    return bytes(reply)
+            rtt_estimator.backoff()
+            logger.debug("No answer from the server, resending...")
+        return None
+    finally:
+        selector.close()
+
+def fetch_signature(udp_socket, server_address, session_id, file_id, rtt_estimator):
+    """
+    Get the block signature of the server's copy of a file, as many
+    signature request / answer exchanges as it takes.
+    Returns (MD5 digest of the copy, signature entries), or None if the
+    server stopped answering. A server without a copy answers a zero digest.
+    """
+    entries = bytearray()
+    while True:
+        first = len(entries) // SIGNATURE_ENTRY.size
+        reply = exchange_control(udp_socket, server_address, TYPE_SIGNATURE_REQUEST, session_id, TYPE_SIGNATURE,
+                                 rtt_estimator, SIGNATURE_REQUEST.pack(file_id, first))
+        if reply is None:
+            return None
+        if len(reply) < SIGNATURE_ANSWER.size:
+            continue
+        answer_file_id, answer_first, count, digest = SIGNATURE_ANSWER.unpack_from(reply)
+        if (answer_file_id, answer_first) != (file_id, first):
+            continue  # a late answer to an earlier request
+        entries += reply[SIGNATURE_ANSWER.size:]
+        if len(entries) >= count * SIGNATURE_ENTRY.size:
+            return digest, bytes(entries)
+
+def rtt_sample(rtt_estimator, rtt):
+    # Feed an RTT measurement to the estimator and the RTT histogram
+    rtt_estimator.sample(rtt)
+    metrics.observe('rtt_seconds', rtt)
+
+def transmit(batch_sender, server_address, segments, seq, timers, timer_heap, rto, pacer=None):
+    # Send a segment and (re)arm its retransmission timer in the timer heap.
+    # Older heap entries of the segment become stale because timers[seq] changes.
+    send_segment(batch_sender, segments[seq], server_address, seq, pacer)
+    sent_time = time.time()
+    timers[seq] = sent_time
+    heapq.heappush(timer_heap, (sent_time + rto, seq, sent_time))
+
+def pace(pacer, congestion, rtt_estimator):
+    # Seconds to hold back the next new segment, 0 to send it now (always 0 without a pacer)
+    if not pacer:
+        return 0
+    pacer.follow_window(congestion.cwnd, rtt_estimator.srtt, congestion.cwnd < congestion.ssthresh)
+    return pacer.wait()
+
+def earliest(timeout, pacing_delay):
+    # The selector timeout that also wakes up the sender when the pacer lets the next segment go
+    if not pacing_delay:
+        return timeout
+    return pacing_delay if timeout is None else min(timeout, pacing_delay)
+
+def GBN_sender(udp_socket, server_address, session_id, base, next_seq_num, congestion, interleaved_segments, timer_start_time, rtt_estimator, pacer=None, progress=None):
     
     # 4 states there is 
     # rdt send data
     # timeout
     # rdt receive ack and not corrupted
     # rdt receive ack and corrupted
+    # the window is the congestion window limited by the receiver's advertised window
+    # The loop is event driven: it fills the window in one burst, then sleeps
+    # in the selector until an ACK arrives or the timer expires.
+    # With a pacer (see pacing.py) the window is filled no faster than its rate,
+    # the selector also wakes up when the next segment is due.
+    # interleaved_segments is consumed lazily, only unacknowledged segments are kept
     timer_start_time = None
-
-    while(base < len(interleaved_segments)):
-
-        if(next_seq_num < base + N):
-            # print(next_seq_num)
-            if(next_seq_num == len(interleaved_segments)):
+    segments = {}  # sequence number -> encoded segment, for the segments in flight
+    exhausted = False  # all segments have been taken from interleaved_segments
+    send_times = {}  # sequence number -> time of the first transmission
+    retransmitted = set()  # Karn's rule: no RTT samples from these
+    advertised_window = RECEIVE_WINDOW
+    duplicate_acks = 0
+
+    batch_sender = BatchSender(udp_socket)
+    batch_receiver = BatchReceiver(udp_socket, buffer_size=REPLY_BUFFER_SIZE)
+    selector = selectors.DefaultSelector()
+    selector.register(udp_socket, selectors.EVENT_READ)
+
+    while(not exhausted or base < next_seq_num):
+
+        N = congestion.window(advertised_window)
+        pacing_delay = 0
+        while(next_seq_num < base + N and not exhausted):
+            pacing_delay = pace(pacer, congestion, rtt_estimator)
+            if(pacing_delay):
+                break
+            segment = next(interleaved_segments, None)
+            if(segment is None):
+                exhausted = True
                 break
-            send_segment(udp_socket, interleaved_segments[next_seq_num], server_address)
+            segments[next_seq_num] = segment[1]
+            send_segment(batch_sender, segments[next_seq_num], server_address, next_seq_num, pacer)
+            send_times[next_seq_num] = time.time()
     
             if(base == next_seq_num):
                 timer_start_time = time.time()
-            else:
-                timer_start_time = time.time()
             next_seq_num += 1
-        else:
-            # refuse data
-            pass
 
-        ack = receive_ack(udp_socket)
-        if(ack != None and is_not_corrupt(ack)):
-            base = ack['acknowledged_sequence_number'] + 1
-            if(base == next_seq_num):
-                timer_start_time = None
-            else:
-                timer_start_time = time.time()
+        # the burst (and any retransmissions) leave in batches
+        batch_sender.flush()
+        if(exhausted and base == next_seq_num):
+            # the last ACK came in before the end of the segments was seen
+            break
+
+        if(timer_start_time != None):
+            timeout = max(0, timer_start_time + rtt_estimator.rto - time.time())
+        else:
+            timeout = None
+
+        if(selector.select(earliest(timeout, pacing_delay))):
+            # Go-Back-N only uses the cumulative ACK, its receiver buffers nothing
+            for cumulative_ack, _, advertised_window in receive_acks(batch_receiver, session_id):
+                if(base < cumulative_ack <= next_seq_num):
+                    # only an ACK that moves the window restarts the timer,
+                    # duplicate ACKs for out-of-order segments must not postpone the timeout
+                    if(cumulative_ack - 1 not in retransmitted):
+                        rtt_sample(rtt_estimator, time.time() - send_times[cumulative_ack - 1])
+                    congestion.on_ack(cumulative_ack - base)
+                    # forget the acknowledged segments
+                    for i in range(base, cumulative_ack):
+                        del segments[i]
+                        del send_times[i]
+                        retransmitted.discard(i)
+                        if(progress):
+                            progress.acked(i)
+                    base = cumulative_ack
+                    duplicate_acks = 0
+                    if(base == next_seq_num):
+                        timer_start_time = None
+                    else:
+                        timer_start_time = time.time()
+                elif(cumulative_ack == base and base < next_seq_num):
+                    duplicate_acks += 1
+                    metrics.count('duplicate_acks')
+                    if(duplicate_acks == DUPLICATE_ACK_THRESHOLD):
+                        # fast retransmit: go back to base without waiting for the timeout
+                        congestion.on_fast_retransmit()
+                        timer_start_time = time.time()
+                        for i in range(base, next_seq_num):
+                            send_segment(batch_sender, segments[i], server_address, i, pacer)
+                            retransmitted.add(i)
+                            metrics.count('retransmits_fast')
         
-        if(timer_start_time != None and time.time() - timer_start_time > timeout_duration):
+        if(timer_start_time != None and time.time() - timer_start_time >= rtt_estimator.rto):
             timer_start_time = time.time()
+            rtt_estimator.backoff()
+            congestion.on_timeout()
+            duplicate_acks = 0
+            metrics.count('timeouts')
+
+            for i in range(base, next_seq_num):
+                logger.debug("Segment %d timed out, resending...", i)
+                send_segment(batch_sender, segments[i], server_address, i, pacer)
+                retransmitted.add(i)
+                metrics.count('retransmits_timeout')
+
+    selector.close()
+    metrics.count('local_drops', batch_sender.dropped)
+    print("All segments are sent")
+    return next_seq_num
 
-            for i in range(base-1, next_seq_num):
-                print(f"Segment resending segment...")
-                send_segment(udp_socket, interleaved_segments[i], server_address)
 
-        
+def SR_sender(udp_socket, server_address, session_id, congestion, interleaved_segments, rtt_estimator, fec=None, pacer=None, progress=None):
+    """
+    Selective Repeat sender.
+    Every segment in the window has its own timer and only the segments
+    whose timer expires are resent. ACKs are cumulative with a selective ACK
+    bitmap of the segments the receiver buffered beyond the cumulative ACK.
+    The number of segments in flight is limited by the congestion window and
+    the receiver's advertised window, new segments never go past the
+    receiver's buffer. A missing segment with DUPLICATE_ACK_THRESHOLD
+    acknowledged segments above it is considered lost and fast retransmitted,
+    the window is reduced once per such recovery episode.
+    The loop is event driven: it fills the window in one burst, sleeps in
+    the selector until an ACK arrives or the earliest timer in the timer
+    heap expires, then drains all pending ACKs without blocking.
+    interleaved_segments is consumed lazily, only unacknowledged segments are kept.
+    fec is (data segments, parity segments) per block when forward error
+    correction was negotiated: parity follows every block on its first
+    transmission and a hole waits a block longer before it is fast
+    retransmitted, so the receiver gets the chance to rebuild it first.
+    pacer (see pacing.py) spreads the new segments of the window out instead
+    of sending them in one burst, progress (ObjectProgress) is told about
+    every acknowledged segment.
+    Returns the number of segments sent.
+    """
+    segments = {}  # sequence number -> encoded segment, for the segments in flight
+    exhausted = False  # all segments have been taken from interleaved_segments
+    acked = set()  # acknowledged sequence numbers above send_base
+    timers = {}  # sequence number -> time the segment was last sent
+    timer_heap = []  # (deadline, sequence number, time sent), stale entries are skipped
+    retransmitted = set()  # Karn's rule: no RTT samples from these
+    advertised_window = RECEIVE_WINDOW
+    in_recovery = False  # a loss was detected from the SACK information
+    recovery_point = 0  # the recovery ends when everything below this is acknowledged
+    fec_encoder = FECEncoder(session_id, *fec) if fec else None
+    loss_threshold = DUPLICATE_ACK_THRESHOLD + (fec[0] if fec else 0)
+
+    send_base = 0
+    next_seq_num = 0
+
+    batch_sender = BatchSender(udp_socket)
+    batch_receiver = BatchReceiver(udp_socket, buffer_size=REPLY_BUFFER_SIZE)
+    selector = selectors.DefaultSelector()
+    selector.register(udp_socket, selectors.EVENT_READ)
+
+    while(not exhausted or timers):
+
+        # fill the window
+        N = congestion.window(advertised_window)
+        pacing_delay = 0
+        while(len(timers) < N and next_seq_num < send_base + RECEIVE_WINDOW and not exhausted):
+            pacing_delay = pace(pacer, congestion, rtt_estimator)
+            if(pacing_delay):
+                break
+            segment = next(interleaved_segments, None)
+            if(segment is None):
+                exhausted = True
+                if(fec_encoder):
+                    # parity of the last, shorter block
+                    for parity in fec_encoder.finish():
+                        send_parity(batch_sender, parity, server_address, pacer)
+                break
+            segments[next_seq_num] = segment[1]
+            transmit(batch_sender, server_address, segments, next_seq_num, timers, timer_heap, rtt_estimator.rto, pacer)
+            if(fec_encoder):
+                # parity goes out right after the block
+                for parity in fec_encoder.add(next_seq_num, segment[1]):
+                    send_parity(batch_sender, parity, server_address, pacer)
+            next_seq_num += 1
+
+        # the burst (and any retransmissions) leave in batches
+        batch_sender.flush()
+        if(exhausted and not timers):
+            # the last ACK came in before the end of the segments was seen
+            break
+
+        timeout = max(0, timer_heap[0][0] - time.time()) if timer_heap else None
+
+        if(selector.select(earliest(timeout, pacing_delay))):
+            for cumulative_ack, sack, advertised_window in receive_acks(batch_receiver, session_id):
+                # everything below the cumulative ACK plus the selectively acknowledged segments
+                newly_acked = [seq for seq in range(send_base, min(cumulative_ack, next_seq_num)) if seq not in acked]
+                newly_acked.extend(seq for seq in sacked_sequence_numbers(cumulative_ack, sack)
+                                   if send_base <= seq < next_seq_num and seq not in acked)
+                if(not newly_acked):
+                    metrics.count('duplicate_acks')
+                    continue
+
+                now = time.time()
+                rtt = None
+                for seq in newly_acked:
+                    acked.add(seq)
+                    del segments[seq]
+                    sent_time = timers.pop(seq)
+                    if(seq not in retransmitted):
+                        # the most recently sent segment gives the freshest sample
+                        rtt = now - sent_time if rtt is None else min(rtt, now - sent_time)
+                    retransmitted.discard(seq)
+                    if(progress):
+                        progress.acked(seq)
+                if(rtt is not None):
+                    rtt_sample(rtt_estimator, rtt)
+                congestion.on_ack(len(newly_acked))
+
+                # slide the window over the acknowledged prefix
+                while(send_base in acked):
+                    acked.remove(send_base)
+                    send_base += 1
+                if(in_recovery and send_base >= recovery_point):
+                    in_recovery = False
+
+                # a hole with enough acknowledged segments above it is lost
+                lost = []
+                acked_above = 0
+                for seq in range(max(acked, default=send_base), send_base - 1, -1):
+                    if(seq in acked):
+                        acked_above += 1
+                    elif(acked_above >= loss_threshold and seq not in retransmitted):
+                        lost.append(seq)
+                if(lost):
+                    if(not in_recovery):
+                        congestion.on_fast_retransmit()
+                        in_recovery = True
+                        recovery_point = next_seq_num
+                    for seq in reversed(lost):
+                        # fast retransmit of the missing segment only
+                        logger.debug("Segment %d fast retransmitted...", seq)
+                        transmit(batch_sender, server_address, segments, seq, timers, timer_heap, rtt_estimator.rto, pacer)
+                        retransmitted.add(seq)
+                        metrics.count('retransmits_fast')
+
+        # resend only the segments whose own timer has expired
+        now = time.time()
+        expired = []
+        while(timer_heap and timer_heap[0][0] <= now):
+            _, seq, sent_time = heapq.heappop(timer_heap)
+            # skip timers of segments acknowledged or resent since
+            if(timers.get(seq) == sent_time):
+                expired.append(seq)
+        if(expired):
+            rtt_estimator.backoff()
+            congestion.on_timeout()
+            metrics.count('timeouts')
+        for seq in expired:
+            logger.debug("Segment %d timed out, resending...", seq)
+            transmit(batch_sender, server_address, segments, seq, timers, timer_heap, rtt_estimator.rto, pacer)
+            retransmitted.add(seq)
+            metrics.count('retransmits_timeout')
+
+    selector.close()
+    metrics.count('local_drops', batch_sender.dropped)
     print("All segments are sent")
+    return next_seq_num
 
 
-def start_client(server_ip, server_port, window_size=100):
+def parse_offsets(text):
+    # "file_id:offset,..." from the resume option of the SYNACK
+    offsets = {}
+    for item in text.split(","):
+        file_id, _, offset = item.partition(":")
+        if file_id.isdigit() and offset.isdigit():
+            offsets[int(file_id)] = int(offset)
+    return offsets
+
+def start_client(server_ip, server_port, mode=RDT_MODE, window_log=None, fec=None, codec=None, resume=None, delta=None,
+                 metrics_path=None, metrics_format="json", segment_size=None, mtu=None, pacing=False, rate=None, pipeline=0,
+                 scheduler=DEFAULT_SCHEDULER, priorities=DEFAULT_PRIORITIES, weights=DEFAULT_WEIGHTS):
     # main function for the client
     # It sends file segments to the server, ensuring that the number of unacknowledged
-    # segments does not exceed the window size.
-    server_address = (server_ip, server_port)
+    # segments does not exceed the congestion and advertised windows.
+    # If window_log is given the congestion window over time is written there as CSV.
+    # fec is (data segments, parity segments) per block to ask the server for forward error correction,
+    # codec the compression to ask for (see compression.py).
+    # resume is the session id of an interrupted transfer to continue, the
+    # server tells which files it already has and how much of them.
+    # delta is the session id of an earlier transfer whose files the server
+    # keeps, only what changed since is sent (see delta.py).
+    # metrics_path is the file the metrics of the transfer are appended to,
+    # as JSON lines or a Prometheus text dump (metrics_format).
+    # The segments are sized so their datagrams fit the path MTU (mtu if
+    # given, see pmtu.py) and sent with DF set, unless segment_size asks for
+    # a payload size (which may fragment). The server may lower it in the SYNACK.
+    # pacing spreads the segments out at the rate the congestion window
+    # allows, rate (bits per second) at a fixed rate instead (see pacing.py).
+    # With pipeline > 0 that many reader processes read and compress the files (see ReaderPool).
+    # scheduler picks the order the segments of the files are interleaved in,
+    # with the priorities and weights of the file classes (see scheduling.py).
+    server_address = (socket.gethostbyname(server_ip), server_port)  # resolved once for the batched sends
     udp_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+    udp_socket.setblocking(False)  # the senders wait for events in a selector
+    udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)  # room for whole bursts
+    if segment_size is None:
+        if mtu is None:
+            mtu = path_mtu(server_address)
+        segment_size = segment_size_for(mtu, bool(fec))
+        set_dont_fragment(udp_socket)  # sized to fit, a datagram that does not is a bug
 
     FILE_COUNT = 10
 
@@ -182,37 +723,172 @@ def start_client(server_ip, server_port, window_size=100):
 
 
     # print(file_paths)
-               
-    segment_size = 10 * 1024  # Defining the segment size
-
-    window_size = WINDOW_SIZE # Defining the window size, must be smaller than segment size
 
-    each_segments = []
-    i = 0
-    for file_path in file_paths:
-        each_segments.append(create_segment_for_file(file_path,segment_size,i))
-        i+=1
-
-    
-    interleaved_segments = interleave_segments(each_segments)
+    # a random session id keeps this transfer apart from other clients of the server
+    session_id = int.from_bytes(os.urandom(4), 'big')
 
-    print(len(interleaved_segments))
     base = 0
     next_seq_num = 0
-    N = window_size  # window size
+    congestion = CongestionController(record_history=bool(metrics_path or window_log))  # window size, starts at WINDOW_SIZE segments
 
     # Start timer for the oldest unacknowledged packet
     timer_start_time = None
-    timeout_duration = TIMEOUT_DURATION # Duration after which to consider a timeout has occurred
+    rtt_estimator = RTTEstimator() # Estimates the duration after which to consider a timeout has occurred
 
     start_time = time.time()
 
-    GBN_sender(udp_socket,server_address, base, next_seq_num, N, interleaved_segments, timer_start_time, timeout_duration)
+    # open the session, the SYN tells the server which receiver to run and
+    # which options we would like, the SYNACK lists the options it accepted
+    # and gives the first RTT sample
+    options = {"mode": mode, "segment": segment_size}
+    if fec:
+        options["fec"] = f"{fec[0]},{fec[1]}"
+    if codec:
+        options["compress"] = codec
+    if resume is not None:
+        options["resume"] = f"{resume:08x}"
+    if delta is not None:
+        options["delta"] = f"{delta:08x}"
+    reply = exchange_control(udp_socket, server_address, TYPE_SYN, session_id, TYPE_SYNACK, rtt_estimator, encode_options(options))
+    if reply is None:
+        print("The server did not answer, giving up.")
+        udp_socket.close()
+        return
+    accepted = decode_options(reply)
+    if accepted.get("segment", "").isdigit():
+        segment_size = min(segment_size, int(accepted["segment"]))  # the server's receive buffers may be smaller
+    print(f"Segment size: {segment_size} bytes" + (f" (path MTU {mtu})" if mtu else ""))
+    if fec and "fec" not in accepted:
+        print("The server does not support forward error correction, sending without it.")
+        fec = None
+    if codec and accepted.get("compress") != codec:
+        print(f"The server does not support {codec} compression, sending uncompressed.")
+        codec = None
+    offsets = {}
+    if resume is not None:
+        if "resume" not in accepted:
+            print("The server cannot resume the session, sending everything.")
+        offsets = parse_offsets(accepted.get("resume", ""))
+        print(f"Resuming: {sum(offsets.values())} bytes are already on the server")
+    # the session whose directory on the server this transfer writes to
+    directory_id = session_id
+    if resume is not None:
+        directory_id = resume
+    if delta is not None:
+        directory_id = delta
+    print(f"Session {session_id:08x} opened, if it gets interrupted continue it with --resume {directory_id:08x}")
+
+    # the signatures of the server's copies, for the files it has a copy of
+    signatures = {}
+    if delta is not None:
+        if "delta" not in accepted:
+            print("The server cannot send signatures, sending everything.")
+        else:
+            for i in range(len(file_paths)):
+                signature = fetch_signature(udp_socket, server_address, session_id, i, rtt_estimator)
+                if signature is not None and any(signature[0]):
+                    signatures[i] = signature
+
+    each_segments = []  # a scheduling.Stream per file that is sent
+    names = {}  # file_id -> (name, bytes sent), for the completion of the files
+    readers = ReaderPool(segment_size, codec, pipeline, scheduler) if pipeline else None
+    unchanged = 0
+    i = 0
+    for file_path in file_paths:
+        priority = priorities.get(object_class(file_path), 0)
+        weight = weights.get(object_class(file_path), 1.0)
+        if not os.path.exists(file_path):
+            # nothing to send, create_segment_for_file says so
+            each_segments.append(Stream(i, create_segment_for_file(file_path, segment_size, i), 0))
+        elif i in signatures:
+            basis_digest, entries = signatures[i]
+            with open(file_path, 'rb') as file:
+                if calculate_checksum(file.read()) == basis_digest.hex():
+                    unchanged += 1  # the server has it already
+                else:
+                    segments, literal = create_delta_segments(file_path, segment_size, i, entries, codec)
+                    each_segments.append(Stream(i, iter(segments), len(segments), priority, weight))
+                    names[i] = (os.path.basename(file_path), literal)
+        else:
+            offset = offsets.get(i, 0)
+            stream = Stream(i, None, segment_count(file_path, segment_size, offset), priority, weight)
+            if readers:
+                stream.segments = readers.add(stream, file_path, offset)
+            else:
+                stream.segments = create_segment_for_file(file_path,segment_size,i,codec,offset)
+            each_segments.append(stream)
+            names[i] = (os.path.basename(file_path), max(0, os.path.getsize(file_path) - offset))
+        i+=1
+    if delta is not None:
+        print(f"Delta: {unchanged} files unchanged, {len(signatures) - unchanged} sent as a delta")
+
+    if readers:
+        readers.start()
+        print(f"Pipeline: {pipeline} reader processes")
+
+    # nothing is read yet, the senders pull segments as the window advances
+    progress = ObjectProgress(names, start_time)
+    interleaved_segments = interleave_segments(each_segments, session_id, scheduler, progress)
+
+    pacer = None
+    if pacing or rate:
+        pacer = Pacer(SEGMENT_HEADER_SIZE + segment_size, rate / 8 if rate else None, metrics)
+
+    try:
+        if mode == "SR":
+            total_segments = SR_sender(udp_socket, server_address, session_id, congestion, interleaved_segments, rtt_estimator, fec, pacer, progress)
+        else:
+            total_segments = GBN_sender(udp_socket, server_address, session_id, base, next_seq_num, congestion, interleaved_segments, timer_start_time, rtt_estimator, pacer, progress)
+    finally:
+        if readers:
+            interleaved_segments = each_segments = stream = None  # let go of the last views into the shared memory
+            readers.close()
 
     end_time = time.time()  # End time
     elapsed_time = end_time - start_time
-    print(f"Total time taken for file transfer: {elapsed_time} seconds")
-    print(f"Average throughput: {FILE_COUNT * segment_size * 8 / elapsed_time} bits per second")
+
+    # close the session so the server can free its state right away
+    if exchange_control(udp_socket, server_address, TYPE_FIN, session_id, TYPE_FINACK, rtt_estimator) is None:
+        print("The server did not acknowledge the end of the session, it will expire it.")
+    print(f"Total time taken for file transfer: {elapsed_time} seconds ({total_segments} segments)")
+    # goodput: the file data the server ends up with, per second of the transfer
+    # the object data this session delivered, without what a resume or delta left out
+    payload_bytes = sum(record["bytes"] for record in metrics.objects)
+    print(f"Average goodput: {payload_bytes * 8 / elapsed_time} bits per second")
+    report = completion_report(metrics.objects)
+    if report:
+        print(f"Object completion ({scheduler}): {report}")
+    counters = metrics.counters
+    print(f"Retransmitted segments: {counters['retransmits_fast']} fast, {counters['retransmits_timeout']} after {counters['timeouts']} timeouts")
+    print(f"Corrupted ACKs dropped: {counters['corrupt_acks']}, duplicate ACKs: {counters['duplicate_acks']}")
+    print(f"Payload bytes: {payload_bytes}, wire bytes: {counters['wire_bytes']} ({counters['wire_bytes'] / max(payload_bytes, 1):.2f} of the payload)")
+    if rtt_estimator.srtt is not None:
+        print(f"Smoothed RTT: {rtt_estimator.srtt * 1000:.2f} ms, final RTO: {rtt_estimator.rto * 1000:.2f} ms")
+    print(f"Congestion window: average {congestion.average_window():.1f}, max {congestion.max_cwnd:.1f} segments")
+    # the share of the segments that had to be sent again, self-inflicted burst loss shows up here
+    drop_rate = (counters['retransmits_fast'] + counters['retransmits_timeout']) / max(counters['segments_sent'], 1)
+    metrics.set('drop_rate', drop_rate)
+    metrics.set('achieved_send_bps', counters['wire_bytes'] * 8 / elapsed_time)
+    print(f"Drop rate: {drop_rate * 100:.2f}% of the segments sent, {counters['local_drops']} dropped by the local socket buffer")
+    if pacer and pacer.target_rate():
+        # pacing accuracy: the rate the pacer allowed against the rate that went out
+        metrics.set('pacing_target_bps', pacer.target_rate() * 8)
+        lateness = metrics.histograms.get('pacing_lateness_seconds')
+        print(f"Pacing: target {pacer.target_rate() * 8 / 1e6:.2f} Mbit/s, achieved {counters['wire_bytes'] * 8 / elapsed_time / 1e6:.2f} Mbit/s, "
+              f"{counters['pacing_waits']} waits" + (f", p99 lateness {lateness.quantile(0.99) * 1000:.3f} ms" if lateness else ""))
+
+    if metrics_path:
+        metrics.count('payload_bytes', payload_bytes)
+        metrics.observe('goodput_bps', payload_bytes * 8 / elapsed_time)
+        for t, cwnd in congestion.history:
+            metrics.record('cwnd', cwnd, t)
+        metrics.export(metrics_path, metrics_format)
+
+    if window_log:
+        with open(window_log, 'w') as file:
+            file.write("time,cwnd\n")
+            for t, cwnd in congestion.history:
+                file.write(f"{t:.6f},{cwnd:.3f}\n")
 
 
 
@@ -220,9 +896,47 @@ def start_client(server_ip, server_port, window_size=100):
 
 
 if __name__ == "__main__":
-    # IP = "127.0.0.1"
-    IP = "server"
-    start_client(IP, 8000)
+    parser = argparse.ArgumentParser(description="UDP RDT client")
+    parser.add_argument("--mode", choices=["GBN", "SR"], default=RDT_MODE, help="reliable data transfer mode")
+    parser.add_argument("--window-log", help="write the congestion window over time to this CSV file")
+    parser.add_argument("--compress", choices=sorted(CODECS), help="compress the segments whose file compresses")
+    parser.add_argument("--fec", metavar="K,M", help="forward error correction: M XOR parity segments per K data segments (SR only)")
+    transfer = parser.add_mutually_exclusive_group()
+    transfer.add_argument("--resume", metavar="SESSION", type=lambda text: int(text, 16), help="continue the interrupted session with this (hex) id")
+    transfer.add_argument("--delta", metavar="SESSION", type=lambda text: int(text, 16), help="only send what changed since the session with this (hex) id")
+    parser.add_argument("--server", default="server", help="server host name or address (default: the docker compose host name)")
+    parser.add_argument("--port", type=int, default=8000, help="server port")
+    sizing = parser.add_mutually_exclusive_group()
+    sizing.add_argument("--mtu", type=int, help="size the segments for this MTU instead of the path MTU the kernel reports")
+    sizing.add_argument("--segment-size", type=int, help="segment payload size in bytes, datagrams larger than the MTU are fragmented")
+    pacing = parser.add_mutually_exclusive_group()
+    pacing.add_argument("--pace", action="store_true", help="pace the segments at the rate the congestion window allows instead of sending bursts")
+    pacing.add_argument("--rate", metavar="KBIT/S", type=float, help="pace the segments at this fixed rate")
+    parser.add_argument("--pipeline", metavar="N", type=int, default=0, help="read and compress the files in N reader processes")
+    parser.add_argument("--scheduler", choices=SCHEDULERS, default=DEFAULT_SCHEDULER, help="order the segments of the files are interleaved in")
+    parser.add_argument("--priorities", metavar="CLASS=LEVEL,...", type=parse_priorities, default=DEFAULT_PRIORITIES,
+                        help="priority of every file class for --scheduler priority, lower goes first (default: small=0,large=1)")
+    parser.add_argument("--weights", metavar="CLASS=WEIGHT,...", type=parse_weights, default=DEFAULT_WEIGHTS,
+                        help="share of every file class for --scheduler wfq (default: small=4,large=1)")
+    parser.add_argument("--log-level", choices=LOG_LEVELS, default="info", help="debug also logs every segment, ACK and timeout")
+    parser.add_argument("--metrics", metavar="FILE", help="append the metrics of the transfer to this file")
+    parser.add_argument("--metrics-format", choices=EXPORT_FORMATS, default="json", help="JSON lines or Prometheus text")
+    args = parser.parse_args()
+    setup_logging(args.log_level)
+
+    fec = None
+    if args.fec:
+        try:
+            fec = parse_fec(args.fec)
+        except ValueError as e:
+            parser.error(str(e))
+        if args.mode != "SR":
+            parser.error("--fec needs --mode SR, a Go-Back-N receiver drops the segments after a hole anyway")
+
+    start_client(args.server, args.port, mode=args.mode, window_log=args.window_log, fec=fec, codec=args.compress, resume=args.resume, delta=args.delta,
+                 metrics_path=args.metrics, metrics_format=args.metrics_format, segment_size=args.segment_size, mtu=args.mtu,
+                 pacing=args.pace, rate=args.rate * 1000 if args.rate else None, pipeline=args.pipeline,
+                 scheduler=args.scheduler, priorities=args.priorities, weights=args.weights)
 
 
 # tc qdisc add dev eth0 root netem delay 100ms 50ms
@@ -1,61 +1,139 @@
 import socket
 import os
-import pickle
 import hashlib
-from common import WINDOW_SIZE, TIMEOUT_DURATION, TIMEOUT_SLEEP
-
-
-def process_segment(segment, received_segments):
-    file_id = segment['file_id']
-    if file_id not in received_segments:
-        received_segments[file_id] = {}
-    received_segments[file_id][segment['sequence_number']] = segment
-
-    return segment['is_last_segment']
-
-def send_ack(udp_socket, client_address, sequence_number, checksum):
-    # Send ack back to the client for a received segment.
-    try:
-        # Create an acknowledgment message
-        ack_message = {
-            'acknowledged_sequence_number': sequence_number,
-            'checksum': checksum
-        }
-
-        # Serialize the acknowledgment message using pickle
-        serialized_ack = pickle.dumps(ack_message)
+import argparse
+import time
+import selectors
+import multiprocessing
+import signal
+import sys
+import queue
+import fcntl
+from collections import Counter
+from common import (RECEIVE_WINDOW, RDT_MODE, SOCKET_BUFFER_SIZE, ACK_EVERY, ACK_DELAY, SESSION_IDLE_TIMEOUT, MAX_SEGMENT_SIZE, PIPELINE_SLOTS,
+                    SESSION_HANDOFF_IDLE, SESSION_HANDOFF_CHECK)
+from batch_io import BatchSender, BatchReceiver
+from pipeline import SlotRing
+from packet import (unpack_prefix, unpack_segment, unpack_control, pack_ack_into, pack_control_into, sack_bitmap,
+                    ACK_SIZE, CONTROL_HEADER_SIZE, MAX_CONTROL_PAYLOAD, SEGMENT_HEADER_SIZE, PARITY_HEADER_SIZE, FLAG_LAST_SEGMENT, FLAG_COMPRESSED, FLAG_DELTA,
+                    TYPE_DATA, TYPE_SYN, TYPE_SYNACK, TYPE_FIN, TYPE_FINACK, TYPE_PARITY, TYPE_SIGNATURE_REQUEST,
+                    TYPE_SIGNATURE, SIGNATURE_REQUEST, SIGNATURE_ANSWER, encode_options, decode_options)
+from fec import FECDecoder, parse_fec
+from compression import CODECS, decompress
+from journal import ObjectWriter, read_journal, JOURNAL_SUFFIX
+from delta import DeltaWriter, file_signature, SIGNATURE_ENTRY
+from metrics import Metrics, logger, setup_logging, EXPORT_FORMATS, LOG_LEVELS
+
+# size of each preallocated buffer datagrams are received into: the largest
+# segment, or the parity segment protecting it (a parity header in front)
+SEGMENT_BUFFER_SIZE = PARITY_HEADER_SIZE + SEGMENT_HEADER_SIZE + MAX_SEGMENT_SIZE
+# signature entries sent in one answer to a signature request
+SIGNATURE_ENTRIES_PER_ANSWER = (MAX_CONTROL_PAYLOAD - SIGNATURE_ANSWER.size) // SIGNATURE_ENTRY.size
+
+# Pipeline mode: the fields of a slot of a writer's ring (see run_writer):
+# kind, session number, file_id, flags, resume offset, length of the slot's data
+WRITER_FIELDS = "!BIHBQI"
+WRITE_SEGMENT, WRITE_OPEN, WRITE_CLOSE, WRITE_STOP = range(4)
+
+# a session directory is owned by the worker holding an flock on this file next to it
+LOCK_SUFFIX = ".lock"
+
+# counters of the datagrams no session can be blamed for, every session has its own Metrics
+metrics = Metrics(transport="udp", role="server")
+
+
+def file_name(file_id):
+    # Determine the file type and number based on the file_id
+    if file_id % 2 == 0:
+        file_type = "small"
+    else:
+        file_type = "large"
+    return file_type, file_id // 2
 
-        # Send the acknowledgment back to the client
-        udp_socket.sendto(serialized_ack, client_address)
-        print(f"Acknowledgment sent for segment {sequence_number}")
-    except Exception as e:
-        print(f"Error sending acknowledgment: {e}")
+def file_id_of(name):
+    # Inverse of file_name for a received file name like "large-3.obj", None for anything else
+    file_type, _, rest = name.partition("-")
+    file_number = rest[:-len(".obj")] if rest.endswith(".obj") else ""
+    if file_type not in ("small", "large") or not file_number.isdigit():
+        return None
+    return int(file_number) * 2 + (file_type == "large")
 
-def verify_checksum(file_path, file_type, file_number):
+def process_segment(segment, open_files, output_directory, resume_offsets=None):
     """
-    Compute and verify the MD5 checksum of the given file.
+    Write an in-order segment to its file and feed it to the file's running MD5.
+    a segment is a (file_id, sequence_number, flags, data) tuple, data may be
+    a view into the receive buffer, it is written without being copied.
+    open_files maps file_id -> ObjectWriter for the files being received,
+    resume_offsets file_id -> offset for the files this session continues
+    (their first segment carries the data at that offset).
+    The segments of a file sent as a delta carry the delta stream, which
+    rebuilds the file from the copy already in output_directory.
+    Returns True if this was the last segment of the file.
     """
+    file_id, sequence_number, flags, data = segment
+    if file_id not in open_files:
+        file_type, file_number = file_name(file_id)
+        output_file_path = os.path.join(output_directory, f"{file_type}-{file_number}.obj")
+        digest = expected_checksum(file_type, file_number)
+        if flags & FLAG_DELTA:
+            open_files[file_id] = DeltaWriter(output_file_path, digest)
+        else:
+            offset = resume_offsets.get(file_id, 0) if resume_offsets else 0
+            open_files[file_id] = ObjectWriter(output_file_path, digest, offset)
+    open_files[file_id].write(data)
+
+    return bool(flags & FLAG_LAST_SEGMENT)
+
+def send_ack(batch_sender, client_address, session_id, cumulative_ack, sack=0, window=RECEIVE_WINDOW):
+    # Send ack back to the client: the next expected segment, the selective ACK bitmap
+    # of the buffered segments after it and the free receive window.
+    # The ACK is built in one of the batch sender's slots and leaves with the next flush.
+    ack_buffer = batch_sender.next_buffer()
+    ack_length = pack_ack_into(ack_buffer, session_id, cumulative_ack, sack, window)
+    batch_sender.add(memoryview(ack_buffer)[:ack_length], client_address)
+    logger.debug("Acknowledgment sent up to segment %d", cumulative_ack)
+
+def send_control(batch_sender, packet_type, session_id, client_address, payload=b""):
+    # Answer a handshake or teardown packet, leaves with the next flush like the ACKs
+    buffer = batch_sender.next_buffer()
+    length = pack_control_into(buffer, packet_type, session_id, payload)
+    batch_sender.add(memoryview(buffer)[:length], client_address)
+
+def expected_checksum(file_type, file_number):
     # Read the expected checksum from the corresponding .md5 file
     with open(f"../../objects/{file_type}-{file_number}.obj.md5", 'r') as file:
-        expected_checksum = file.read().strip()
-
-    print(f"Verifying checksum of {file_path}... with expected_checksum: {expected_checksum}")
+        return file.read().strip()
 
-    # Initialize MD5 hasher
-    hasher = hashlib.md5()
-
-    # Read and update hasher with file content
-    with open(file_path, 'rb') as file:
-        buf = file.read()
-        hasher.update(buf)  # Update the hasher with the content of the file
+def verify_checksum(writer):
+    """
+    Close a received file and verify its MD5 checksum.
+    The writer's hasher already saw every byte of the file, so the file is not read again.
+    """
+    logger.debug("Verifying checksum of %s... with expected_checksum: %s", writer.path, writer.digest)
 
     # Compute our checksum
-    our_checksum = hasher.hexdigest()
+    our_checksum = writer.hasher.hexdigest()
 
-    print(f"Checksum of {file_path} is our checksum: {our_checksum}")
+    logger.debug("Checksum of %s is our checksum: %s", writer.path, our_checksum)
 
     # Compare and return the result of checksum verification
-    return our_checksum == expected_checksum
+    return writer.verified()
+
+def resumable_offsets(directory):
+    """
+    file_id -> offset for the files of a session directory that an earlier,
+    interrupted session left behind (see journal.py), files whose journal
+    does not match the expected checksum start over.
+    """
+    offsets = {}
+    for name in os.listdir(directory):
+        file_id = file_id_of(name[:-len(JOURNAL_SUFFIX)]) if name.endswith(JOURNAL_SUFFIX) else None
+        if file_id is None:
+            continue
+        offset = read_journal(os.path.join(directory, name[:-len(JOURNAL_SUFFIX)]), expected_checksum(*file_name(file_id)))
+        if offset:
+            offsets[file_id] = offset
+    return offsets
 
 def calculate_checksum(data):
     # Convert data to bytes if it is not already a bytes-like object
@@ -78,114 +156,706 @@ def calculate_checksum(data):
     # Return the hex digest of the data
     return hash_obj.hexdigest()
 
-def receive_segment(udp_socket):
-    # Receive a segment over UDP and return the deserialized segment.
-    try:
-        # The recvfrom method of the socket
-        # The recvfrom method returns a tuple with the serialized segment and the address of the sender
-        serialized_segment, address = udp_socket.recvfrom(1024)  # buffer size
+def receive_datagrams(batch_receiver):
+    """
+    Receive everything that is queued (up to a batch) into the receiver's
+    preallocated buffers, callers wait for the socket in a selector.
+    Yields (packet type, session id, view, address) for every datagram with
+    a valid checksum, the view points into the receive buffer.
+    Malformed and corrupted datagrams are dropped, corrupted ones are counted.
+    The views are only valid until the next call.
+    """
+    for view, address in batch_receiver.receive():
+        # Verify the checksum and decode the prefix, the payload stays in the buffer
+        prefix = unpack_prefix(view)
+        if prefix is None:
+            metrics.count('corrupt_segments')
+            continue
+        packet_type, session_id = prefix
+        yield packet_type, session_id, view, address
+
+def reassemble_file(open_files, file_id, flow_metrics=None):
+    """
+    Finish a file after its last segment was written.
+    Closes the file and verifies the MD5 checksum computed while it was written.
+    The completion time and goodput of the file go to flow_metrics.
+    """
+    writer = open_files.pop(file_id)
+
+    verified = verify_checksum(writer)
+    report_file(writer.path, writer.delivered(), time.time() - writer.started, verified, flow_metrics)
+
+def report_file(output_file_path, size, seconds, verified, flow_metrics=None):
+    # Count and print the outcome of a finished file, size bytes of it were received in seconds
+    if flow_metrics:
+        flow_metrics.count('files_verified' if verified else 'files_failed')
+        flow_metrics.object_done(os.path.basename(output_file_path), size, seconds, verified)
+    if verified:
+        print(f"File {output_file_path} reassembled, saved, and verified. Corrupted segments dropped so far: {metrics.counters['corrupt_segments']}")
+    else:
+        print(f"File {output_file_path} reassembled and saved, but failed verification.")
+
+def has_sequence_number(segment, expected_seq_num):
+    # Check if the segment has the expected sequence number
+    return segment[1] == expected_seq_num
+
 
-        # Deserialize the segment using pickle
-        segment = pickle.loads(serialized_segment)
+def deliver_segment(segment, open_files, output_directory, resume_offsets=None, flow_metrics=None):
+    # Hand an in-order segment to the application: write it to its file and
+    # verify the file once its last segment has been delivered
+    is_last_segment = process_segment(segment, open_files, output_directory, resume_offsets)
+    if is_last_segment:
+        reassemble_file(open_files, segment[0], flow_metrics)
+        print(f"File {segment[0]} reassembled and saved.")
 
-        # Return the deserialized segment and the address of the sender
-        return segment
-    except Exception as e:
-        print(f"Error receiving segment: {e}")
-        return None, None
 
-def reassemble_file(received_files, output_directory, file_id, total_files):
+def run_writer(ring, results):
     """
-    Reassemble and save the file from its segments after everything is received.
-    Verifies the MD5 checksum of the reassembled file.
+    Writer process of the pipeline mode (see WriterPool).
+    Takes the messages of its ring, fields WRITER_FIELDS: a session is
+    opened (WRITE_OPEN, the slot holds its directory and codec), its
+    in-order segments are decompressed and written to their files straight
+    from the shared memory (WRITE_SEGMENT), its unfinished files are closed
+    (WRITE_CLOSE). A finished file is verified and reported on results as
+    ("done", session, path, size, seconds, verified), a closed session as
+    ("closed", session, payload bytes written for it). WRITE_STOP stops the writer.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the server stops its writers
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    sessions = {}  # session -> (directory, codec, file_id -> writer)
+    payload_bytes = Counter()  # session -> bytes written
+    while True:
+        slot, (kind, session, file_id, flags, offset, length) = ring.take()
+        if kind == WRITE_SEGMENT:
+            directory, codec, open_files = sessions[session]
+            data = ring.view(slot, length)
+            if flags & FLAG_COMPRESSED:
+                data = decompress(codec, data)
+            payload_bytes[session] += len(data)
+            is_last_segment = process_segment((file_id, None, flags, data), open_files, directory, {file_id: offset})
+            del data
+            if is_last_segment:
+                writer = open_files.pop(file_id)
+                results.put(("done", session, writer.path, writer.delivered(),
+                             time.time() - writer.started, verify_checksum(writer)))
+        elif kind == WRITE_OPEN:
+            directory, codec = bytes(ring.view(slot, length)).decode().split("\n")
+            sessions[session] = (directory, codec or None, {})
+        elif kind == WRITE_CLOSE:
+            for writer in sessions.pop(session)[2].values():
+                writer.close()
+            results.put(("closed", session, payload_bytes.pop(session, 0)))
+        ring.release()
+        if kind == WRITE_STOP:
+            break
+    for _, _, open_files in sessions.values():
+        for writer in open_files.values():
+            writer.close()
+
+
+class WriterPool:
+    """
+    Pipeline mode of the server: workers writer processes decompress, write
+    and verify the delivered segments (run_writer), the socket loop only
+    checks, orders and acknowledges them. A segment is copied once, out of
+    the receive buffer into a slot of the writer's ring (see pipeline.py).
+    All segments of a file go to the same writer, so they are written in order.
+    A flow is registered when its session opens and closed (close_session)
+    when it ends, the outcome of its files is counted in its Metrics,
+    poll() picks up what the writers finished.
     """
-    # Determine the file type and number based on the file_id
-    if file_id % 2 == 0:
-        file_type = "small"
-    else:
-        file_type = "large"
-    file_number = file_id // 2
 
-    sorted_segments = sorted(received_files[file_id].values(), key=lambda x: x['sequence_number'])
-    file_data = b''.join(segment['data'] for segment in sorted_segments)
+    def __init__(self, workers=2):
+        self.rings = [SlotRing(PIPELINE_SLOTS, MAX_SEGMENT_SIZE, WRITER_FIELDS) for _ in range(workers)]
+        self.results = multiprocessing.Queue()
+        self.metrics = {}  # session number -> Metrics of the flow
+        self.next_session = 0
+        self.processes = [multiprocessing.Process(target=run_writer, args=(ring, self.results), daemon=True) for ring in self.rings]
+        for process in self.processes:
+            process.start()
+
+    def send(self, ring, kind, session, file_id=0, flags=0, offset=0, data=b""):
+        slot = ring.acquire()
+        ring.view(slot, len(data))[:] = data
+        ring.publish(slot, kind, session, file_id, flags, offset, len(data))
+
+    def register(self, flow):
+        # a session number for the flow, every writer learns its directory and codec
+        session = self.next_session
+        self.next_session += 1
+        self.metrics[session] = flow.metrics
+        for ring in self.rings:
+            self.send(ring, WRITE_OPEN, session, data=f"{flow.output_directory}\n{flow.codec or ''}".encode())
+        return session
+
+    def deliver(self, flow, segment):
+        file_id, _, flags, data = segment
+        ring = self.rings[(flow.writer_session + file_id) % len(self.rings)]
+        self.send(ring, WRITE_SEGMENT, flow.writer_session, file_id, flags, flow.resume_offsets.get(file_id, 0), data)
+
+    def poll(self):
+        while True:
+            try:
+                self.on_result(self.results.get_nowait())
+            except queue.Empty:
+                return
+
+    def on_result(self, result):
+        kind, session, *fields = result
+        flow_metrics = self.metrics.get(session)
+        if kind == "done":
+            report_file(*fields, flow_metrics)
+        elif flow_metrics:
+            flow_metrics.count('payload_bytes', fields[0])
+
+    def close_session(self, session):
+        # Close the unfinished files of a session and wait until every writer has caught up with it
+        for ring in self.rings:
+            self.send(ring, WRITE_CLOSE, session)
+        closed = 0
+        while closed < len(self.rings):
+            try:
+                result = self.results.get(timeout=1.0)
+            except queue.Empty:
+                if not all(process.is_alive() for process in self.processes):
+                    print("A writer process died, the files of the session may be incomplete.")
+                    break
+                continue
+            self.on_result(result)
+            closed += result[:2] == ("closed", session)
+        self.metrics.pop(session, None)
+
+    def close(self):
+        for ring in self.rings:
+            self.send(ring, WRITE_STOP, 0)
+        for process in self.processes:
+            process.join()
+        self.poll()
+        for ring in self.rings:
+            ring.close()
+
+
+class DelayedAck:
+    """
+    ACK coalescing policy of a receiver.
+    In-order segments are acknowledged every ACK_EVERY segments or after
+    ACK_DELAY seconds, a gap (out-of-order or duplicate segment) is
+    acknowledged immediately so the sender learns about it at once.
+    Since ACKs are cumulative one ACK covers everything received before it.
+    """
 
-    output_file_path = os.path.join(output_directory, f"{file_type}-{file_number}.obj")
-    with open(output_file_path, 'wb') as file:
-        file.write(file_data)
+    def __init__(self, every=ACK_EVERY, delay=ACK_DELAY):
+        self.every = every
+        self.delay = delay
+        self.pending = 0  # in-order segments not acknowledged yet
+        self.immediate = False
+        self.deadline = None
 
-    # Assuming the function verify_checksum exists
-    if verify_checksum(output_file_path, file_type, file_number):
-        print(f"File {output_file_path} reassembled, saved, and verified.")
-    else:
-        print(f"File {output_file_path} reassembled and saved, but failed verification.")
+    def in_order(self):
+        self.pending += 1
+        if self.deadline is None:
+            self.deadline = time.time() + self.delay
 
-def is_not_corrupt(segment):
-    # Placeholder function to check if a segment is not corrupt
-    hash_object_data = hashlib.md5()
-    # Update the hash object with the data
-    hash_object_data.update(segment['data'])
-    # Return the hex digest of the data
-    # hash_object_data.hexdigest() == segment['checksum']
-    return True
+    def gap(self):
+        self.immediate = True
 
-def has_sequence_number(segment, expected_seq_num):
-    # Check if the segment has the expected sequence number
-    return segment['sequence_number'] == expected_seq_num
+    def due(self):
+        # Whether an ACK has to be sent now
+        if self.immediate or self.pending >= self.every:
+            return True
+        return self.deadline is not None and time.time() >= self.deadline
 
+    def timeout(self):
+        # Seconds until the delayed ACK is due, None if nothing is pending
+        if self.deadline is None:
+            return None
+        return max(0, self.deadline - time.time())
 
-def GBN_receiver(udp_socket):
+    def sent(self):
+        self.pending = 0
+        self.immediate = False
+        self.deadline = None
 
-    received_segments = {} # Dictionary to store received segments
-    output_directory = "./received_files"  # Define the output directory
 
+class Flow:
+    """
+    Receive state of one client session, the server keeps one per
+    (client address, session id) so concurrent clients never share
+    sequence numbers or files.
+    Each session writes its files to its own directory (see session_directory).
+    """
+
+    def __init__(self, address, session_id, output_directory):
+        self.address = address
+        self.session_id = session_id
+        self.output_directory = output_directory
+        if not os.path.exists(self.output_directory):
+            os.makedirs(self.output_directory)
+        self.open_files = {}  # Files being written: file_id -> ObjectWriter
+        self.resume_offsets = {}  # file_id -> offset the client continues the file from
+        self.delta = False  # files may be sent as a delta against the copies in output_directory
+        self.signatures = {}  # file_id -> (MD5 digest, block signature) of our copy, computed once
+        self.delayed_ack = DelayedAck()
+        self.last_activity = time.time()
+        self.options = {}  # options accepted in the handshake, repeated in every SYNACK
+        self.fec = None  # FECDecoder if forward error correction was negotiated
+        self.codec = None  # compression codec if negotiated
+        # counters of the session: wire_bytes of every datagram, payload_bytes of file data delivered, ...
+        self.metrics = Metrics(transport="udp", role="server", session=f"{session_id:08x}")
+        self.metrics_export = None  # (path, format) the metrics are appended to when the session ends
+        self.writers = None  # WriterPool in the pipeline mode
+        self.writer_session = None  # the flow's session number in the WriterPool
+        self.lock = None  # lock file of output_directory, held while the flow is open (see lock_session_directory)
+        self.lock_mtime = None  # its modification time when it was taken, another worker touches it to ask for it
+
+    def deliver(self, segment):
+        if self.writers:
+            # decompressed, written and verified by a writer process
+            self.writers.deliver(self, segment)
+            return
+        # compressed segments are decompressed one by one as they are delivered
+        file_id, seq, flags, data = segment
+        if flags & FLAG_COMPRESSED:
+            data = decompress(self.codec, data)
+            segment = (file_id, seq, flags, data)
+        self.metrics.count('payload_bytes', len(data))
+        deliver_segment(segment, self.open_files, self.output_directory, self.resume_offsets, self.metrics)
+
+    def on_data(self, view, segment):
+        # A data segment of the session, with FEC it may also complete a stripe
+        self.metrics.count('segments_received')
+        self.on_segment(segment)
+        if self.fec:
+            self.on_rebuilt(self.fec.add_data(segment[1], view))
+
+    def on_parity(self, view):
+        if self.fec:
+            self.on_rebuilt(self.fec.add_parity(view))
+            self.fec.forget(self.delivered())
+
+    def on_rebuilt(self, datagrams):
+        # Segments rebuilt from parity are checked like received ones
+        for datagram in datagrams:
+            view = memoryview(datagram)
+            if unpack_prefix(view) != (TYPE_DATA, self.session_id):
+                continue
+            segment = unpack_segment(view)
+            if segment:
+                logger.debug("Segment %d rebuilt from parity.", segment[1])
+                self.metrics.count('rebuilt_from_parity')
+                self.on_segment(segment)
+
+    def signature_answer(self, file_id, first):
+        # Payload answering a signature request: the block signature of our
+        # copy of the file from entry first on, as much as fits
+        if file_id not in self.signatures:
+            file_type, file_number = file_name(file_id)
+            path = os.path.join(self.output_directory, f"{file_type}-{file_number}.obj")
+            self.signatures[file_id] = file_signature(path) or (bytes(16), b"")  # no copy: zero digest
+        digest, entries = self.signatures[file_id]
+        start = first * SIGNATURE_ENTRY.size
+        answer = SIGNATURE_ANSWER.pack(file_id, first, len(entries) // SIGNATURE_ENTRY.size, digest)
+        return answer + entries[start:start + SIGNATURE_ENTRIES_PER_ANSWER * SIGNATURE_ENTRY.size]
+
+    def close(self):
+        # Close the files of an unfinished transfer, their journals keep how far they got,
+        # and export the metrics of the session
+        for writer in self.open_files.values():
+            writer.close()
+        self.open_files.clear()
+        if self.writers:
+            self.writers.close_session(self.writer_session)
+        if self.metrics_export:
+            self.metrics.export(*self.metrics_export)
+            self.metrics_export = None
+        # only now, with everything flushed, another worker may take the directory
+        if self.lock:
+            self.lock.close()
+            self.lock = None
+
+    def lock_requested(self):
+        # another worker wants to continue this session's directory
+        return self.lock is not None and os.fstat(self.lock.fileno()).st_mtime > self.lock_mtime
+
+
+class GBNFlow(Flow):
+    """
+    Go-Back-N receive state: only the expected segment is accepted,
+    ACKs are cumulative.
+    """
+
+    def __init__(self, address, session_id, output_directory):
+        super().__init__(address, session_id, output_directory)
+        self.expected_seq_num = 0  # Start with expecting the first sequence number
+
+    def on_segment(self, segment):
+        if has_sequence_number(segment, self.expected_seq_num):
+            logger.debug("Segment %d received.", segment[1])
+            self.expected_seq_num += 1  # Increment the expected sequence number
+            self.delayed_ack.in_order()
+            # process the in-order segment straight from the receive buffer
+            self.deliver(segment)
+        else:
+            # duplicate cumulative ACK right away
+            logger.debug("Out-of-order segment received. Expected: %d, got: %d", self.expected_seq_num, segment[1])
+            self.metrics.count('out_of_order_segments' if segment[1] > self.expected_seq_num else 'duplicate_segments')
+            self.delayed_ack.gap()
+        # If the packet is not the one we expect, we do nothing and wait for the next one
+        # The FSM diagram shows no action in the case of default (unexpected packet)
+
+    def ack(self):
+        # (cumulative ACK, selective ACK bitmap, advertised window)
+        return self.expected_seq_num, 0, RECEIVE_WINDOW
+
+    def delivered(self):
+        # every segment below this was delivered
+        return self.expected_seq_num
+
+
+class SRFlow(Flow):
+    """
+    Selective Repeat receive state.
+    Segments inside the receive window are buffered and the in-order prefix
+    is delivered as soon as it is complete.
+    Only out-of-order segments are copied, so memory stays bounded by the window.
+    ACKs carry the next expected sequence number, a selective ACK bitmap of
+    the buffered segments and the free buffer space.
+    """
+
+    def __init__(self, address, session_id, output_directory):
+        super().__init__(address, session_id, output_directory)
+        self.rcv_base = 0  # smallest sequence number not yet delivered
+        self.buffered_segments = {}  # out-of-order segments inside the window
+
+    def on_segment(self, segment):
+        N = RECEIVE_WINDOW
+        file_id, seq, flags, payload = segment
+        if seq == self.rcv_base:
+            # the expected segment is written straight from the receive buffer
+            self.deliver(segment)
+            self.rcv_base += 1
+            if self.buffered_segments:
+                # a gap was filled, tell the sender right away
+                self.delayed_ack.gap()
+            else:
+                self.delayed_ack.in_order()
+            # deliver the buffered segments that are now in order
+            while self.rcv_base in self.buffered_segments:
+                self.deliver(self.buffered_segments.pop(self.rcv_base))
+                self.rcv_base += 1
+        elif self.rcv_base < seq < self.rcv_base + N:
+            if seq not in self.buffered_segments:
+                # copy the payload out of the receive buffer before it is reused
+                self.buffered_segments[seq] = (file_id, seq, flags, bytes(payload))
+                logger.debug("Out-of-order segment %d buffered. Waiting for: %d", seq, self.rcv_base)
+                self.metrics.count('out_of_order_segments')
+            else:
+                self.metrics.count('duplicate_segments')
+            self.delayed_ack.gap()
+        elif self.rcv_base - N <= seq < self.rcv_base:
+            # already delivered, our ACK was lost: acknowledge again
+            self.metrics.count('duplicate_segments')
+            self.delayed_ack.gap()
+        # anything else is outside both windows and is ignored
+
+    def ack(self):
+        # the ACK advertises the buffer space left for out-of-order segments
+        sack = sack_bitmap(self.rcv_base, self.buffered_segments)
+        return self.rcv_base, sack, RECEIVE_WINDOW - len(self.buffered_segments)
+
+    def delivered(self):
+        # every segment below this was delivered
+        return self.rcv_base
+
+
+FLOW_TYPES = {"GBN": GBNFlow, "SR": SRFlow}
+
+
+def continued_session(options):
+    # The earlier session whose directory a SYN asks to continue (hex in the
+    # resume or delta option), None if there is none
+    try:
+        return int(options.get("resume", options.get("delta")), 16)
+    except (TypeError, ValueError):
+        return None
+
+
+def session_directory(output_directory, session_id, options):
+    # Directory of a session's files, a resumed or delta session continues
+    # the directory of the earlier session
+    continued = continued_session(options)
+    return os.path.join(output_directory, f"session-{session_id if continued is None else continued:08x}")
+
+
+def lock_session_directory(directory):
+    """
+    Take the lock that makes this process the only writer of a session
+    directory, an flock on the file directory + LOCK_SUFFIX. Returns the open
+    lock file, or None if another worker holds it: then the lock file is
+    touched, which asks that worker to hand the session over once it is
+    idle (see hand_over_flows).
+    """
+    path = directory + LOCK_SUFFIX
+    lock = open(path, 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        os.utime(path)
+        return None
+    return lock
+
+
+def open_flow(address, session_id, options, output_directory):
+    """
+    Create the receive state of a new session from the options of its SYN.
+    The RDT mode falls back to RDT_MODE, forward error correction is only
+    accepted for Selective Repeat (Go-Back-N drops everything after a hole),
+    compression for the codecs in compression.py.
+    With resume=<session id> the client continues an interrupted session,
+    the SYNACK lists "file_id:offset" for every file it continues.
+    With delta=<session id> the client updates the files of an earlier
+    session, asking for their signatures and sending deltas (see delta.py).
+    The segment size the client asks for is capped at MAX_SEGMENT_SIZE,
+    what the receive buffers hold.
+    The accepted options are stored in flow.options for the SYNACK.
+    Returns None while another worker still holds the session directory.
+    """
+    directory = session_directory(output_directory, session_id, options)
+    lock = lock_session_directory(directory)
+    if lock is None:
+        return None
+    mode = options.get("mode")
+    if mode not in FLOW_TYPES:
+        mode = RDT_MODE
+    flow = FLOW_TYPES[mode](address, session_id, directory)
+    flow.lock = lock
+    flow.lock_mtime = os.fstat(lock.fileno()).st_mtime
+    flow.options["mode"] = mode
+    if options.get("segment", "").isdigit():
+        flow.options["segment"] = min(int(options["segment"]), MAX_SEGMENT_SIZE)
+    if "fec" in options and mode == "SR":
+        try:
+            flow.fec = FECDecoder(*parse_fec(options["fec"]))
+            flow.options["fec"] = options["fec"]
+        except ValueError as e:
+            print(f"Session {session_id:08x}: {e}, continuing without FEC")
+    if options.get("compress") in CODECS:
+        flow.codec = options["compress"]
+        flow.options["compress"] = flow.codec
+    if "resume" in options and continued_session(options) is not None:
+        flow.resume_offsets = resumable_offsets(flow.output_directory)
+        flow.options["resume"] = ",".join(f"{file_id}:{offset}" for file_id, offset in sorted(flow.resume_offsets.items()))
+        print(f"Session {session_id:08x} resumes {options['resume']}, {sum(flow.resume_offsets.values())} bytes already received")
+    elif "delta" in options and continued_session(options) is not None:
+        flow.delta = True
+        flow.options["delta"] = options["delta"]
+        print(f"Session {session_id:08x} updates {options['delta']}")
+    return flow
+
+
+def evict_idle_flows(flows, idle_timeout=SESSION_IDLE_TIMEOUT):
+    # Forget the sessions whose client went away without closing them
+    now = time.time()
+    for key, flow in list(flows.items()):
+        if now - flow.last_activity >= idle_timeout:
+            print(f"Session {flow.session_id:08x} from {flow.address} idle, evicted.")
+            flow.close()
+            del flows[key]
+
+
+def hand_over_flows(flows, idle_timeout=SESSION_HANDOFF_IDLE):
+    # Close the idle sessions whose directory another worker asked for, so
+    # the resumed session there can take it over
+    now = time.time()
+    for key, flow in list(flows.items()):
+        if now - flow.last_activity >= idle_timeout and flow.lock_requested():
+            print(f"Session {flow.session_id:08x} from {flow.address} handed over to another worker.")
+            flow.close()
+            del flows[key]
+
+
+def serve(udp_socket, output_directory="./received_files", metrics_export=None, pipeline=0):
+    """
+    Serve any number of concurrent clients on one socket.
+    Datagrams are demultiplexed on (client address, session id) to the
+    session's Flow. A SYN opens a session with the options in its payload
+    (see open_flow) and is answered with a SYNACK (again for a retransmitted SYN),
+    a FIN closes it and is answered with a FINACK. Segments of unknown
+    sessions are dropped, sessions idle for SESSION_IDLE_TIMEOUT are evicted.
+    Every session directory has one owner (see lock_session_directory): a SYN
+    continuing a directory another worker still holds is not answered, the
+    client's retransmitted SYN gets through once that worker handed it over.
+    After every batch each session with a due delayed ACK gets one ACK.
+    The files of the sessions still open when the server stops are journaled
+    so their clients can resume them.
+    With metrics_export = (path, format) the metrics of every session are
+    appended to path when it ends, those of the server when it stops.
+    With pipeline > 0 the files are written by that many writer processes (see WriterPool).
+    """
     if not os.path.exists(output_directory):
         os.makedirs(output_directory)
 
-    expected_seq_num = 0  # Start with expecting the first sequence number
+    flows = {}  # (client address, session id) -> Flow
 
-    while True:
-        # segment = receive_segment(udp_socket)
-        buffer_size = 1024*10*WINDOW_SIZE
-        bytes_address_pair = udp_socket.recvfrom(buffer_size)
-        segment = pickle.loads(bytes_address_pair[0])  # Deserialize the segment using pickle  
-        address = bytes_address_pair[1]
-        
-
-        if segment and is_not_corrupt(segment):
-            # checksum = calculate_checksum(segment['sequence_number'])  # Replace with actual method to compute checksum
-            checksum = "" 
-            if  has_sequence_number(segment, expected_seq_num):
-                print(f"Segment {segment['sequence_number']} received.")
-                send_ack(udp_socket, address,expected_seq_num, checksum)
-                expected_seq_num += 1  # Increment the expected sequence number
-            else:
-                print(f"Out-of-order segment received. Expected: {expected_seq_num}, got: {segment['sequence_number']}")
-                send_ack(udp_socket, address, expected_seq_num, checksum)
-             # process the segment and send ack
-            
-            is_last_segment = process_segment(segment, received_segments)
-            if is_last_segment:
-                # here reassemble the file and save it
-                reassemble_file(received_segments, output_directory, segment['file_id'],20)
-                print(f"File {segment['file_id']} reassembled and saved.")
+    batch_receiver = BatchReceiver(udp_socket, buffer_size=SEGMENT_BUFFER_SIZE)
+    batch_sender = BatchSender(udp_socket, slot_size=max(ACK_SIZE, CONTROL_HEADER_SIZE + MAX_CONTROL_PAYLOAD))
+    selector = selectors.DefaultSelector()
+    selector.register(udp_socket, selectors.EVENT_READ)
+    next_eviction = time.time() + SESSION_IDLE_TIMEOUT
+    next_handoff = time.time() + SESSION_HANDOFF_CHECK
+    writers = WriterPool(pipeline) if pipeline else None
 
-        # If the packet is not the one we expect, we do nothing and wait for the next one
-        # The FSM diagram shows no action in the case of default (unexpected packet)
+    try:
+        while True:
+            # sleep until a datagram arrives, a delayed ACK is due or it is time to evict
+            timeouts = [flow.delayed_ack.timeout() for flow in flows.values()]
+            timeouts = [timeout for timeout in timeouts if timeout is not None]
+            if flows:
+                timeouts.append(max(0, min(next_eviction, next_handoff) - time.time()))
+            timeout = min(timeouts) if timeouts else None
+
+            if selector.select(timeout):
+                now = time.time()
+                for packet_type, session_id, view, address in receive_datagrams(batch_receiver):
+                    key = (address, session_id)
+                    flow = flows.get(key)
+                    if flow is not None:
+                        flow.metrics.count('wire_bytes', len(view))
+
+                    if packet_type == TYPE_DATA:
+                        segment = unpack_segment(view)
+                        if flow is None or segment is None:
+                            metrics.count('unknown_session')
+                            continue
+                        flow.last_activity = now
+                        flow.on_data(view, segment)
+
+                    elif packet_type == TYPE_PARITY:
+                        if flow is not None:
+                            flow.last_activity = now
+                            flow.on_parity(view)
+
+                    elif packet_type == TYPE_SYN:
+                        payload = unpack_control(view)
+                        if payload is None:
+                            continue
+                        if flow is None:
+                            options = decode_options(payload)
+                            # what is left of a resumed session (its client is gone) is closed
+                            # first, so its journals have the exact offsets
+                            directory = session_directory(output_directory, session_id, options)
+                            for stale_key in [stale_key for stale_key, stale in flows.items() if stale.output_directory == directory]:
+                                flows.pop(stale_key).close()
+                            flow = open_flow(address, session_id, options, output_directory)
+                            if flow is None:
+                                print(f"Session {session_id:08x}: {directory} is still held by another worker, SYN ignored.")
+                                continue
+                            flow.metrics_export = metrics_export
+                            if writers:
+                                flow.writers = writers
+                                flow.writer_session = writers.register(flow)
+                            flows[key] = flow
+                            print(f"Session {session_id:08x} from {address} opened ({type(flow).__name__}), {len(flows)} active.")
+                        flow.last_activity = now
+                        send_control(batch_sender, TYPE_SYNACK, session_id, address, encode_options(flow.options))
+
+                    elif packet_type == TYPE_SIGNATURE_REQUEST:
+                        payload = unpack_control(view)
+                        if flow is None or not flow.delta or payload is None or len(payload) != SIGNATURE_REQUEST.size:
+                            continue
+                        flow.last_activity = now
+                        answer = flow.signature_answer(*SIGNATURE_REQUEST.unpack(payload))
+                        send_control(batch_sender, TYPE_SIGNATURE, session_id, address, answer)
+
+                    elif packet_type == TYPE_FIN:
+                        if flow is not None:
+                            flow.close()
+                            del flows[key]
+                            print(f"Session {session_id:08x} from {address} closed, {len(flows)} active.")
+                            print(f"Payload bytes: {flow.metrics.counters['payload_bytes']}, wire bytes: {flow.metrics.counters['wire_bytes']}")
+                            if flow.fec:
+                                print(f"Segments rebuilt from parity: {flow.fec.recovered}")
+                        # answered even for unknown sessions, our earlier FINACK may have been lost
+                        send_control(batch_sender, TYPE_FINACK, session_id, address)
+
+            # one ACK per session describes its receive state after the whole batch
+            for flow in flows.values():
+                if flow.delayed_ack.due():
+                    send_ack(batch_sender, flow.address, flow.session_id, *flow.ack())
+                    flow.metrics.count('acks_sent')
+                    flow.delayed_ack.sent()
+            batch_sender.flush()
+            if writers:
+                writers.poll()
+
+            if time.time() >= next_eviction:
+                evict_idle_flows(flows)
+                next_eviction = time.time() + SESSION_IDLE_TIMEOUT
+            if time.time() >= next_handoff:
+                hand_over_flows(flows)
+                next_handoff = time.time() + SESSION_HANDOFF_CHECK
+    finally:
+        for flow in flows.values():
+            flow.close()
+        if writers:
+            writers.close()
+        if metrics_export:
+            metrics.export(*metrics_export)
+
+
+def create_server_socket(local_address, reuse_port=False):
+    udp_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+    udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)  # room for whole bursts
+    if reuse_port:
+        # every worker binds its own socket to the same port, the kernel
+        # spreads the clients over them by hashing the address 4-tuple,
+        # so all datagrams of one client reach the same worker
+        udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    udp_socket.bind(local_address)
+    return udp_socket
+
+
+def run_worker(local_address, reuse_port, output_directory="./received_files", metrics_export=None, pipeline=0):
+    # a terminated worker unwinds like an interrupted one, so serve journals the open files
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    udp_socket = create_server_socket(local_address, reuse_port)
+    try:
+        serve(udp_socket, output_directory, metrics_export, pipeline)
+    finally:
+        udp_socket.close()
 
 
-def start_server():
-    local_ip = "server"
+def start_server(workers=1, local_ip="server", local_port=8000, output_directory="./received_files", metrics_export=None, pipeline=0):
     # local_ip = "127.0.0.1"
-    local_port = 8000
-    udp_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
-    udp_socket.bind((local_ip, local_port))
+    local_address = (local_ip, local_port)
 
     print("UDP server up and listening")
 
-    GBN_receiver(udp_socket)
+    if workers == 1:
+        run_worker(local_address, False, output_directory, metrics_export, pipeline)
+        return
 
-    udp_socket.close()
+    # shard the clients over several processes with SO_REUSEPORT
+    processes = [multiprocessing.Process(target=run_worker, args=(local_address, True, output_directory, metrics_export, pipeline)) for _ in range(workers)]
+    for process in processes:
+        process.start()
+    print(f"{workers} workers started")
+    for process in processes:
+        process.join()
 
 
 if __name__ == "__main__":
-    start_server()
+    parser = argparse.ArgumentParser(description="UDP RDT server")
+    parser.add_argument("--workers", type=int, default=1, help="number of worker processes sharing the port with SO_REUSEPORT")
+    parser.add_argument("--host", default="server", help="address to listen on (default: the docker compose host name)")
+    parser.add_argument("--port", type=int, default=8000, help="port to listen on")
+    parser.add_argument("--output", default="./received_files", help="directory the received files are written to")
+    parser.add_argument("--pipeline", metavar="N", type=int, default=0, help="decompress, write and verify the files in N writer processes (per worker)")
+    parser.add_argument("--log-level", choices=LOG_LEVELS, default="info", help="debug also logs every segment and ACK")
+    parser.add_argument("--metrics", metavar="FILE", help="append the metrics of every session to this file")
+    parser.add_argument("--metrics-format", choices=EXPORT_FORMATS, default="json", help="JSON lines or Prometheus text")
+    args = parser.parse_args()
+    setup_logging(args.log_level)
+
+    start_server(args.workers, args.host, args.port, args.output, (args.metrics, args.metrics_format) if args.metrics else None, args.pipeline)